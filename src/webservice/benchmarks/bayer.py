@@ -0,0 +1,110 @@
+"""
+Benchmark of the raw Bayer path on a recorded capture: unpacking the 10 bit
+data (checked against a straightforward reference implementation) and each
+demosaic method.
+
+A fixture is a capture as the camera writes it with bayer=True, the JPEG
+with the raw data appended. Record one once (on a Pi with --backend
+picamera, or from the simulated camera) and benchmark against it:
+
+    python benchmarks/bayer.py --record imx219.raw --backend picamera
+    python benchmarks/bayer.py --fixture imx219.raw --repeat 10
+
+Without --fixture a capture from the simulated camera is used.
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "handlers"))
+
+from imaging import Bayer
+
+
+def record(backend):
+    from cam.Camera import Camera
+    if backend == "simulated":
+        from cam import SimulatedCamera
+        Camera.session.set_camera_module(SimulatedCamera)
+    try:
+        return Camera().capture_raw()[0]
+    finally:
+        Camera.session.close()
+
+
+def detect(data):
+    for revision, raw_format in sorted(Bayer.RAW_FORMATS.items()):
+        start = len(data) - raw_format.size
+        if start >= 0 and data[start:start + 4] == b"BRCM":
+            return revision, raw_format
+    raise ValueError("No raw data found in the capture")
+
+
+def unpack_reference(packed, width):
+    # A byte column at a time, the way it's usually done with picamera
+    data = packed.astype(np.uint16) << 2
+    for byte in range(4):
+        data[:, byte::5] |= (packed[:, 4::5] >> (byte * 2)) & 3
+    return np.delete(data, np.s_[4::5], 1)[:, :width]
+
+
+def best_of(repeat, fn):
+    seconds = []
+    for _ in range(repeat):
+        start = time.time()
+        result = fn()
+        seconds.append(time.time() - start)
+    return min(seconds), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", help="Recorded capture to benchmark against")
+    parser.add_argument("--record", help="Capture a fixture to this file and exit")
+    parser.add_argument("--backend", default="simulated", help="Camera backend to record with, simulated or picamera")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of each step, the fastest is reported")
+    parser.add_argument("--max-unpack-ms", type=float, help="Fail when unpacking takes longer than this")
+    args = parser.parse_args()
+
+    if args.record:
+        data = record(args.backend)
+        with open(args.record, "wb") as f:
+            f.write(data)
+        print "recorded %d bytes to %s" % (len(data), args.record)
+        return
+
+    if args.fixture:
+        with open(args.fixture, "rb") as f:
+            data = f.read()
+    else:
+        data = record("simulated")
+
+    revision, raw_format = detect(data)
+    megapixels = raw_format.width * raw_format.height / 1e6
+    print "sensor: %s, %dx%d (%.1f MP), pattern %s" % (revision, raw_format.width, raw_format.height, megapixels, raw_format.pattern)
+
+    packed = Bayer.extract(data, raw_format)
+    unpack_seconds, raw = best_of(args.repeat, lambda: Bayer.unpack10(Bayer.extract(data, raw_format), raw_format.width))
+    reference_seconds, reference = best_of(args.repeat, lambda: unpack_reference(packed, raw_format.width))
+    print "unpack: %.1f ms (%.0f MP/s), reference %.1f ms (%.0f MP/s)" % (
+        1000 * unpack_seconds, megapixels / unpack_seconds, 1000 * reference_seconds, megapixels / reference_seconds)
+
+    for method in Bayer.DEMOSAIC_METHODS:
+        seconds, rgb = best_of(args.repeat, lambda: Bayer.demosaic(raw, raw_format.pattern, method))
+        print "demosaic %s: %.1f ms (%.0f MP/s), %dx%d" % (method, 1000 * seconds, megapixels / seconds, rgb.shape[1], rgb.shape[0])
+
+    if not np.array_equal(raw, reference):
+        print "FAIL: unpacked data differs from the reference"
+        sys.exit(1)
+    if args.max_unpack_ms is not None and 1000 * unpack_seconds > args.max_unpack_ms:
+        print "FAIL: unpacking took longer than %s ms" % args.max_unpack_ms
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
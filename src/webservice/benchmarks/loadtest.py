@@ -0,0 +1,251 @@
+"""
+Load test of the web service on the simulated camera.
+
+Starts the real Tornado application (main.make_app, with the simulated
+camera backend) in a child process and drives /sayhi, /still and /stream at
+each concurrency level, reporting throughput, p50/p99 latency (time to the
+first byte for /stream) and the server's peak RSS.
+
+Results can be saved and later runs checked against them, failing when
+throughput drops, or p99 latency or peak RSS grow, by more than the
+tolerance:
+
+    python benchmarks/loadtest.py --concurrency 1,4,16 --duration 10 --save baseline.json
+    python benchmarks/loadtest.py --baseline baseline.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import ConfigParser
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, httpclient, ioloop
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WEBSERVICE = os.path.join(HERE, "..")
+
+SCENARIOS = {
+    "sayhi": "/sayhi",
+    "still": "/still?hres=640&vres=480&output=jpeg",
+    "stream": "/stream?hres=640&vres=480"
+}
+
+# Below this a change in p99 latency is put down to noise
+MIN_LATENCY_CHANGE = 0.005
+
+
+def serve(port, workdir):
+    sys.path.insert(0, WEBSERVICE)
+    os.chdir(WEBSERVICE)
+    import main
+    import metrics
+
+    logging.basicConfig(level=logging.WARNING)
+    config = ConfigParser.RawConfigParser()
+    config.read("config.ini")
+    for section, option, value in (("camera", "backend", "simulated"),
+                                   ("sequences", "sequence_dir", os.path.join(workdir, "sequences")),
+                                   ("store", "store_dir", os.path.join(workdir, "store")),
+                                   ("calibration", "calibration_dir", os.path.join(workdir, "calibration")),
+                                   ("static", "static_enabled", "false")):
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+
+    threads = config.getint("global", "server.max_simultaneous_requests")
+    metrics.POOL_SIZE.set(threads)
+    app = main.make_app(config, ThreadPoolExecutor(max_workers=threads))
+    main.serve(app, port, address="127.0.0.1")
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def reset_peak_rss(pid):
+    # Linux only, so each result has the peak of its own run
+    try:
+        with open("/proc/%d/clear_refs" % pid, "w") as f:
+            f.write("5")
+    except IOError:
+        pass
+
+
+def peak_rss_mb(pid):
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+@gen.coroutine
+def wait_for_server(base, timeout=30.0):
+    client = httpclient.AsyncHTTPClient()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        response = yield client.fetch(base + "/sayhi", raise_error=False, request_timeout=1.0)
+        if response.code == 200:
+            return
+        yield gen.sleep(0.2)
+    raise RuntimeError("Server didn't start")
+
+
+@gen.coroutine
+def run_requests(base, path, concurrency, duration):
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = []
+    counts = {"errors": 0, "bytes": 0}
+    end = time.time() + duration
+
+    @gen.coroutine
+    def worker():
+        while time.time() < end:
+            start = time.time()
+            response = yield client.fetch(base + path, raise_error=False, request_timeout=60.0)
+            if response.code == 200:
+                latencies.append(time.time() - start)
+                counts["bytes"] += len(response.body)
+            else:
+                counts["errors"] += 1
+
+    # One request first, so that opening the camera isn't counted
+    yield client.fetch(base + path, raise_error=False, request_timeout=60.0)
+    start = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - start
+    client.close()
+    raise gen.Return({
+        "throughput": len(latencies) / elapsed,
+        "unit": "req/s",
+        "latencies": latencies,
+        "errors": counts["errors"]
+    })
+
+
+@gen.coroutine
+def run_streams(base, path, concurrency, duration):
+    client = httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = []
+    counts = {"errors": 0, "bytes": 0}
+
+    @gen.coroutine
+    def viewer():
+        start = time.time()
+        first = []
+
+        def on_chunk(chunk):
+            if len(first) == 0:
+                first.append(time.time())
+            counts["bytes"] += len(chunk)
+
+        # The stream never ends on its own, the client hangs up after duration
+        yield client.fetch(base + path, streaming_callback=on_chunk, raise_error=False, request_timeout=duration)
+        if len(first) > 0:
+            latencies.append(first[0] - start)
+        else:
+            counts["errors"] += 1
+
+    yield [viewer() for _ in range(concurrency)]
+    client.close()
+    raise gen.Return({
+        "throughput": counts["bytes"] / float(duration) / (1024 * 1024),
+        "unit": "MB/s",
+        "latencies": latencies,
+        "errors": counts["errors"]
+    })
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for key, result in sorted(results.items()):
+        previous = baseline.get(key)
+        if previous is None:
+            continue
+        if result["throughput"] < previous["throughput"] * (1 - tolerance):
+            failures.append("%s throughput %.1f, was %.1f" % (key, result["throughput"], previous["throughput"]))
+        if result["p99"] > max(previous["p99"] * (1 + tolerance), previous["p99"] + MIN_LATENCY_CHANGE):
+            failures.append("%s p99 %.1f ms, was %.1f ms" % (key, 1000 * result["p99"], 1000 * previous["p99"]))
+        if result["rss_mb"] > previous["rss_mb"] * (1 + tolerance):
+            failures.append("%s peak rss %.0f MB, was %.0f MB" % (key, result["rss_mb"], previous["rss_mb"]))
+        if result["errors"] > previous["errors"]:
+            failures.append("%s %d errors, was %d" % (key, result["errors"], previous["errors"]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="sayhi,still,stream", help="Any of %s" % ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma separated numbers of concurrent clients")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds per scenario and concurrency level")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Fail on a regression against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve is not None:
+        serve(args.serve, args.workdir)
+        return
+
+    scenarios = args.scenarios.split(",")
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario '%s'" % name)
+    levels = [int(n) for n in args.concurrency.split(",")]
+
+    port = free_port()
+    base = "http://127.0.0.1:%d" % port
+    workdir = tempfile.mkdtemp(prefix="loadtest")
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve", str(port), "--workdir", workdir])
+    results = {}
+    try:
+        io_loop = ioloop.IOLoop.current()
+        io_loop.run_sync(lambda: wait_for_server(base))
+        print "%-8s %11s %12s %10s %10s %8s %9s" % ("scenario", "concurrency", "throughput", "p50 ms", "p99 ms", "errors", "rss MB")
+        for name in scenarios:
+            for concurrency in levels:
+                run = run_streams if name == "stream" else run_requests
+                reset_peak_rss(server.pid)
+                result = io_loop.run_sync(lambda: run(base, SCENARIOS[name], concurrency, args.duration))
+                latencies = np.array(result.pop("latencies") or [0.0])
+                result["p50"] = float(np.percentile(latencies, 50))
+                result["p99"] = float(np.percentile(latencies, 99))
+                result["rss_mb"] = peak_rss_mb(server.pid)
+                results["%s@%d" % (name, concurrency)] = result
+                print "%-8s %11d %7.1f %-4s %10.1f %10.1f %8d %9.0f" % (name, concurrency, result["throughput"], result["unit"],
+                                                                       1000 * result["p50"], 1000 * result["p99"],
+                                                                       result["errors"], result["rss_mb"])
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print "FAIL: %s" % failure
+        if len(failures) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Synthetic drift benchmark for frame registration and drizzle.
+
+Renders a star field drifting (and optionally rotating) across a series of
+frames with known transforms, then registers and stacks them the way /stack
+does, reporting registration error, timings and peak memory.
+
+    python benchmarks/registration.py --frames 50 --size 3280x2464 --drift 0.37,-0.21 --rotation 0.002 --drizzle 2
+"""
+
+import argparse
+import math
+import os
+import resource
+import sys
+import time
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "handlers"))
+
+from imaging.Registration import Registrar, Drizzle, Transform, warp
+from imaging.Stacking import MeanAccumulator
+
+
+class StarField(object):
+    def __init__(self, shape, stars=800, fwhm=2.5, background=20.0, noise=3.0, seed=1):
+        rng = np.random.RandomState(seed)
+        self.shape = shape
+        self.rng = rng
+        self.sigma = fwhm / 2.3548
+        self.background = background
+        self.noise = noise
+        # Stars well outside the frame so drift brings new ones in
+        margin = 0.1 * max(shape)
+        self.ys = rng.uniform(-margin, shape[0] + margin, stars)
+        self.xs = rng.uniform(-margin, shape[1] + margin, stars)
+        self.flux = rng.pareto(1.5, stars) * 300 + 150
+
+    def render(self, transform):
+        h, w = self.shape
+        frame = np.full(self.shape, self.background, dtype=np.float32)
+        ys, xs = transform.to_frame(self.ys, self.xs)
+        r = int(math.ceil(self.sigma * 4))
+        norm = 1.0 / (2 * math.pi * self.sigma ** 2)
+        for y, x, flux in zip(ys, xs, self.flux):
+            y0, y1 = max(int(y) - r, 0), min(int(y) + r + 1, h)
+            x0, x1 = max(int(x) - r, 0), min(int(x) + r + 1, w)
+            if y1 <= y0 or x1 <= x0:
+                continue
+            py = np.exp(-(np.arange(y0, y1) - y) ** 2 / (2 * self.sigma ** 2))
+            px = np.exp(-(np.arange(x0, x1) - x) ** 2 / (2 * self.sigma ** 2))
+            frame[y0:y1, x0:x1] += flux * norm * np.outer(py, px)
+        frame += self.rng.normal(0, self.noise, self.shape)
+        return np.clip(np.rint(frame), 0, 255).astype(np.uint8)
+
+
+def sharpness(image, field, scale=1.0):
+    # Mean peak over background of the brightest stars, relative to their flux,
+    # higher is sharper
+    ys, xs = field.ys * scale + (scale - 1) / 2.0, field.xs * scale + (scale - 1) / 2.0
+    brightest = np.argsort(field.flux)[::-1]
+    peaks = []
+    for i in brightest:
+        y, x = int(round(ys[i])), int(round(xs[i]))
+        if 3 <= y < image.shape[0] - 3 and 3 <= x < image.shape[1] - 3:
+            patch = image[y - 3:y + 4, x - 3:x + 4]
+            peaks.append((patch.max() - field.background) / field.flux[i])
+        if len(peaks) == 20:
+            break
+    return float(np.mean(peaks))
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--size", default="1640x1232", help="WIDTHxHEIGHT, 3280x2464 is the full 8MP sensor")
+    parser.add_argument("--drift", default="0.37,-0.21", help="Drift per frame in pixels, DY,DX")
+    parser.add_argument("--rotation", type=float, default=0.0, help="Rotation per frame in degrees")
+    parser.add_argument("--drizzle", type=float, default=2.0, help="Drizzle scale, 0 to resample and average instead")
+    parser.add_argument("--downsample", type=int, default=4)
+    parser.add_argument("--roi", type=int, default=256)
+    parser.add_argument("--max-error", type=float, default=0.1, help="Fail when the rms shift error exceeds this many pixels")
+    args = parser.parse_args()
+
+    width, height = [int(v) for v in args.size.split("x")]
+    drift_y, drift_x = [float(v) for v in args.drift.split(",")]
+    shape = (height, width)
+    centre = ((height - 1) / 2.0, (width - 1) / 2.0)
+    field = StarField(shape)
+    rotation = args.rotation != 0
+
+    print "frames: %d, size: %dx%d, drift: %s px/frame, rotation: %s deg/frame" % (args.frames, width, height, args.drift, args.rotation)
+
+    registrar = None
+    naive = MeanAccumulator()
+    if args.drizzle > 0:
+        stack = Drizzle(shape, args.drizzle)
+    else:
+        stack = MeanAccumulator()
+    warped = None
+
+    errors = []
+    angle_errors = []
+    render_seconds = 0.0
+    stack_seconds = 0.0
+    for k in range(args.frames):
+        truth = Transform(drift_y * k, drift_x * k, math.radians(args.rotation * k), centre)
+        start = time.time()
+        frame = field.render(truth)
+        render_seconds += time.time() - start
+
+        if registrar is None:
+            registrar = Registrar(frame, args.downsample, args.roi, rotation)
+        transform = registrar.register(frame)
+        errors.append(math.hypot(transform.dy - truth.dy, transform.dx - truth.dx))
+        angle_errors.append(abs(math.degrees(transform.angle - truth.angle)))
+
+        start = time.time()
+        naive.add(frame)
+        if args.drizzle > 0:
+            stack.add(frame, transform)
+        else:
+            warped = warp(frame, transform, warped)
+            stack.add(warped)
+        stack_seconds += time.time() - start
+
+    stats = registrar.stats()
+    errors = np.array(errors)
+    scale = args.drizzle if args.drizzle > 0 else 1.0
+    reference = field.render(Transform(centre=centre))
+    print "registration: %.1f ms/frame, shift error rms %.3f px (max %.3f), rotation error max %.4f deg, mean peak %.2f" % (
+        1000 * stats["seconds"] / args.frames, math.sqrt(np.mean(errors ** 2)), errors.max(), max(angle_errors), stats["mean_peak"])
+    print "%s: %.1f ms/frame" % ("drizzle x%s" % args.drizzle if args.drizzle > 0 else "resample+mean", 1000 * stack_seconds / args.frames)
+    print "sharpness (peak/flux): single frame %.4f, unregistered mean %.4f, registered %.4f" % (
+        sharpness(reference, field), sharpness(naive.result(), field), sharpness(stack.result(), field, scale))
+    print "peak rss: %.0f MB (render %.1f s)" % (rss_mb(), render_seconds)
+
+    if math.sqrt(np.mean(errors ** 2)) > args.max_error:
+        print "FAIL: rms shift error above %s px" % args.max_error
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import metrics
+from webmodel import BaseHandler, service_handler, ProcessingException, SimpleResults
+from cam.Camera import Camera
+from imaging.Encoders import DEFAULT_ENCODER, parse_format
+from imaging.Exposure import ExposureSearch, MIN_SHUTTER_SPEED
+from StillImageHandler import StillImageResult
+
+
+@service_handler
+class AutoExposeHandlerImpl(BaseHandler):
+    name = "Auto Exposure"
+    path = "/autoexpose"
+    description = "Searches for the shutter speed and ISO that reach a target level using low resolution probes, then captures with them"
+    params = {}
+    singleton = True
+
+    MAX_PROBES = 16
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        target = computeOptions.get_int_arg("target", 118)
+        percentile = computeOptions.get_float_arg("percentile", 50.0)
+        tolerance = computeOptions.get_int_arg("tolerance", 8)
+        max_clipped = computeOptions.get_float_arg("clip", 0.01)
+        max_shutter_speed = computeOptions.get_int_arg("maxss", 6000000)
+        max_iso = computeOptions.get_int_arg("maxiso", 800)
+        max_probes = computeOptions.get_int_arg("probes", 8)
+        capture = computeOptions.get_boolean_arg("capture", True)
+        content_type = parse_format(computeOptions.get_argument("output", None))
+
+        if target < 1 or target > 254:
+            raise ProcessingException("Target level must be between 1 and 254", 400)
+        if percentile < 0 or percentile > 100:
+            raise ProcessingException("Percentile must be between 0 and 100", 400)
+        if tolerance < 0 or max_clipped < 0:
+            raise ProcessingException("Tolerance and clip must not be negative", 400)
+        if max_shutter_speed < MIN_SHUTTER_SPEED:
+            raise ProcessingException("Invalid maximum shutter speed '%s' specified" % max_shutter_speed, 400)
+        if max_iso < 100 or max_iso > 1600:
+            raise ProcessingException("Maximum ISO must be between 100 and 1600", 400)
+        if max_probes < 1 or max_probes > AutoExposeHandlerImpl.MAX_PROBES:
+            raise ProcessingException("Probes must be between 1 and %d" % AutoExposeHandlerImpl.MAX_PROBES, 400)
+
+        search = ExposureSearch(target=target,
+                                percentile=percentile,
+                                tolerance=tolerance,
+                                max_clipped=max_clipped,
+                                max_shutter_speed=max_shutter_speed,
+                                max_iso=max_iso,
+                                max_probes=max_probes,
+                                shutter_speed=computeOptions.get_int_arg("ss", None),
+                                iso=computeOptions.get_int_arg("iso", None))
+
+        camera = Camera()
+        output = camera.autoexpose(search,
+                                   probe_resolution=(computeOptions.get_int_arg("phres", 320), computeOptions.get_int_arg("pvres", 240)),
+                                   resolution=(computeOptions.get_int_arg("hres", 1920), computeOptions.get_int_arg("vres", 1080)) if capture else None,
+                                   awb_mode=computeOptions.get_argument("awb"),
+                                   exposure_mode=computeOptions.get_argument("ex"),
+                                   hflip=computeOptions.get_boolean_arg("hflip", False),
+                                   vflip=computeOptions.get_boolean_arg("vflip", False),
+                                   sensor_mode=computeOptions.get_int_arg("md", 0),
+                                   wait=computeOptions.get_boolean_arg("wait", True),
+                                   priority=computeOptions.get_int_arg("priority", 0),
+                                   timeout=computeOptions.get_float_arg("timeout", None))
+        report = search.report()
+        if output is None:
+            return SimpleResults(report)
+
+        try:
+            with metrics.span("convert"):
+                img = output.to_image()
+        finally:
+            output.release()
+        result = DEFAULT_ENCODER.encode(img, content_type,
+                                        quality=computeOptions.get_int_arg("quality", None),
+                                        compress_level=computeOptions.get_int_arg("compression", None))
+        return AutoExposeResult(result, content_type, report)
+
+
+class AutoExposeResult(StillImageResult):
+    def __init__(self, result, content_type, report):
+        StillImageResult.__init__(self, result, content_type)
+        self.report = report
+
+    def getHeaders(self):
+        headers = StillImageResult.getHeaders(self)
+        headers["X-Exposure-Shutter-Speed"] = str(self.report["ss"])
+        headers["X-Exposure-ISO"] = str(self.report["iso"])
+        headers["X-Exposure-Status"] = self.report["status"]
+        headers["X-Exposure-Level"] = str(self.report["level"])
+        headers["X-Exposure-Probes"] = str(len(self.report["probes"]))
+        headers["X-Exposure-Seconds"] = "%.3f" % self.report["seconds"]
+        return headers
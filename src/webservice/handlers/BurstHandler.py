@@ -0,0 +1,282 @@
+import json
+import logging
+import threading
+import time
+import zipfile
+from tornado import gen
+import metrics
+from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException, AsyncReader
+from cam.Camera import Camera, CameraException
+from imaging.Encoders import DEFAULT_ENCODER, parse_format
+from storage.ImageStore import ImageStore
+
+
+@service_handler
+class BurstHandlerImpl(BaseHandler):
+    name = "Burst"
+    path = "/burst"
+    description = "Captures a burst of consecutive frames from the video port"
+    params = {}
+    singleton = True
+
+    MAX_FRAMES = 100
+    MAX_FRAMERATE = 90
+    CONTAINERS = ("zip", "multipart")
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        count = computeOptions.get_int_arg("n", 10)
+        framerate = computeOptions.get_int_arg("fps", 10)
+        shutter_speed = computeOptions.get_int_arg("ss", None)
+        content_type = parse_format(computeOptions.get_argument("output", None), default=ContentTypes.JPEG)
+        quality = computeOptions.get_int_arg("quality", None)
+        compress_level = computeOptions.get_int_arg("compression", None)
+        container = computeOptions.get_argument("container", "zip")
+
+        if count < 1 or count > BurstHandlerImpl.MAX_FRAMES:
+            raise ProcessingException("Burst length must be between 1 and %d frames" % BurstHandlerImpl.MAX_FRAMES, 400)
+        if framerate <= 0 or framerate > BurstHandlerImpl.MAX_FRAMERATE:
+            raise ProcessingException("Invalid frame rate '%s' specified" % framerate, 400)
+        if shutter_speed is not None and shutter_speed * framerate > 1000000:
+            raise ProcessingException("Shutter speed %d is too long for %d fps" % (shutter_speed, framerate), 400)
+        if container not in BurstHandlerImpl.CONTAINERS:
+            raise ProcessingException("Unsupported container '%s'" % container, 400)
+
+        burst = Burst(count, framerate, content_type, quality, compress_level,
+                      resolution=(computeOptions.get_int_arg("hres", 1920), computeOptions.get_int_arg("vres", 1080)),
+                      shutter_speed=shutter_speed,
+                      iso=computeOptions.get_int_arg("iso", None),
+                      awb_mode=computeOptions.get_argument("awb"),
+                      exposure_mode=computeOptions.get_argument("ex"),
+                      hflip=computeOptions.get_boolean_arg("hflip", False),
+                      vflip=computeOptions.get_boolean_arg("vflip", False),
+                      sensor_mode=computeOptions.get_int_arg("md", 0),
+                      priority=computeOptions.get_int_arg("priority", 0),
+                      timeout=computeOptions.get_float_arg("timeout", None))
+        # Waits for the first frame, so errors up to then get a proper response
+        burst.start()
+        return BurstResult(burst, container, content_type)
+
+
+class Burst(object):
+    """
+    A burst captured on a thread of its own. Every frame is handed to the
+    encoder as soon as it is read, so frames are encoded in parallel with the
+    capture and with each other, and read() gives them out in capture order
+    once encoded, following the protocol of the stream readers.
+    """
+
+    def __init__(self, count, framerate, content_type, quality=None, compress_level=None, **settings):
+        self.count = count
+        self.framerate = framerate
+        self.content_type = content_type
+        self.quality = quality
+        self.compress_level = compress_level
+        self.settings = settings
+        self.error = None
+        self.__cond = threading.Condition()
+        self.__frames = []
+        self.__next = 0
+        self.__finished = False
+        self.__listener = None
+        self.__cancel = threading.Event()
+
+    def start(self):
+        # The spans until start() returns make it into the request's
+        # Server-Timing, later ones only into the histograms
+        thread = threading.Thread(target=metrics.run_timed, args=(metrics.current(), self.__run), name="burst")
+        thread.daemon = True
+        thread.start()
+        with self.__cond:
+            while len(self.__frames) == 0 and not self.__finished:
+                self.__cond.wait()
+            if len(self.__frames) == 0:
+                raise self.error or CameraException("The burst ended without capturing any frames")
+
+    def __run(self):
+        try:
+            Camera().burst(self.count, self.framerate, self.__on_frame, cancel=self.__cancel, **self.settings)
+        except Exception as e:
+            logging.getLogger(__name__).error("Burst capture failed", exc_info=True)
+            self.error = e
+        finally:
+            with self.__cond:
+                self.__finished = True
+                self.__cond.notify_all()
+            self.__notify()
+
+    def __on_frame(self, index, captured, output):
+        if self.__cancel.is_set():
+            # Closed, or cut short by an encoder failure
+            output.release()
+            return
+
+        try:
+            with metrics.span("convert"):
+                img = output.to_image()
+            # The encoder copies the pixels, the buffer can go back to the pool
+            future = DEFAULT_ENCODER.submit(img, self.content_type, quality=self.quality, compress_level=self.compress_level)
+        finally:
+            output.release()
+
+        with self.__cond:
+            if self.__cancel.is_set():
+                return
+            self.__frames.append((index, captured, future))
+            self.__cond.notify_all()
+        future.add_done_callback(lambda f: self.__notify())
+
+    def __notify(self):
+        listener = self.__listener
+        if listener is not None:
+            listener()
+
+    def listen(self, listener):
+        self.__listener = listener
+
+    def read(self, timeout=None):
+        """
+        Returns the (index, captured, data) of the frames encoded since the
+        last read, an empty list if there are none yet and None once all of
+        them have been read.
+        """
+        with self.__cond:
+            frames = []
+            while self.__next < len(self.__frames) and self.__frames[self.__next][2].done():
+                index, captured, future = self.__frames[self.__next]
+                self.__frames[self.__next] = None
+                self.__next += 1
+                if future.exception() is not None:
+                    # The burst ends with the first frame that fails
+                    self.error = future.exception()
+                    self.__cancel.set()
+                    self.__finished = True
+                    self.__frames = self.__frames[:self.__next]
+                    break
+                frames.append((index, captured, future.result()))
+
+            if len(frames) == 0 and self.__finished and self.__next >= len(self.__frames):
+                return None
+            return frames
+
+    def close(self):
+        """
+        Stops capturing, for when nobody is left to read the frames.
+        """
+        self.__cancel.set()
+        self.__listener = None
+
+
+class ZipStream(object):
+    """
+    Builds a ZIP archive as its entries come in, handing back the bytes of
+    each entry as soon as it's added. Entries are stored as is, the images
+    are compressed already.
+    """
+
+    def __init__(self):
+        self.__chunks = []
+        self.__position = 0
+        self.__zip = zipfile.ZipFile(self, "w", zipfile.ZIP_STORED, allowZip64=True)
+
+    def write(self, data):
+        self.__chunks.append(data)
+        self.__position += len(data)
+
+    def tell(self):
+        return self.__position
+
+    def flush(self):
+        pass
+
+    def __drain(self):
+        data = b"".join(self.__chunks)
+        self.__chunks = []
+        return data
+
+    def add(self, name, data, modified):
+        info = zipfile.ZipInfo(name, time.localtime(modified)[:6])
+        info.external_attr = 0o644 << 16
+        self.__zip.writestr(info, data)
+        return self.__drain()
+
+    def close(self):
+        self.__zip.close()
+        return self.__drain()
+
+
+class BurstResult:
+    BOUNDARY = "frame"
+
+    MIME_TYPES = {
+        ContentTypes.PNG: "image/png",
+        ContentTypes.JPEG: "image/jpeg",
+        ContentTypes.WEBP: "image/webp"
+    }
+
+    def __init__(self, burst, container, content_type):
+        self.__burst = burst
+        self.__container = container
+        self.__content_type = content_type
+
+    def isStream(self):
+        return True
+
+    def getContentType(self):
+        return ContentTypes.ZIP
+
+    def getHeaders(self):
+        headers = {"X-Burst-Frames": str(self.__burst.count)}
+        if self.__container == "zip":
+            headers["Content-Disposition"] = "attachment; filename=\"burst.zip\""
+        else:
+            headers["Content-Type"] = "multipart/mixed; boundary=%s" % BurstResult.BOUNDARY
+        return headers
+
+    def __name(self, index):
+        return "frame_%04d.%s" % (index, ImageStore.EXTENSIONS[self.__content_type])
+
+    def __part(self, index, captured, data):
+        return b"--%s\r\nContent-Type: %s\r\nContent-Length: %d\r\nContent-Disposition: inline; filename=\"%s\"\r\nX-Frame-Index: %d\r\nX-Frame-Time: %.6f\r\n\r\n" % (
+            BurstResult.BOUNDARY, BurstResult.MIME_TYPES[self.__content_type], len(data), self.__name(index), index, captured) + data + b"\r\n"
+
+    @gen.coroutine
+    def stream(self, writable):
+        reader = AsyncReader(self.__burst)
+        archive = ZipStream() if self.__container == "zip" else None
+        manifest = []
+        try:
+            while not writable.client_closed:
+                frames = yield reader.read(timeout=1.0)
+                if frames is None:
+                    break
+                for index, captured, data in frames:
+                    if archive is not None:
+                        manifest.append({"name": self.__name(index), "index": index, "captured": captured})
+                        writable.write(archive.add(self.__name(index), data, captured))
+                    else:
+                        writable.write(self.__part(index, captured, data))
+                if len(frames) > 0:
+                    yield writable.flush()
+
+            if writable.client_closed:
+                return
+            # A burst cut short by an error still ends with a valid archive
+            if archive is not None:
+                writable.write(archive.add("manifest.json", json.dumps({
+                    "frames": manifest,
+                    "fps": self.__burst.framerate,
+                    "error": str(self.__burst.error) if self.__burst.error is not None else None
+                }, indent=4), time.time()))
+                writable.write(archive.close())
+            else:
+                writable.write(b"--%s--\r\n" % BurstResult.BOUNDARY)
+            yield writable.flush()
+        finally:
+            reader.close()
+            self.__burst.close()
+
+    def toJson(self):
+        raise ProcessingException("JSON not supported for burst")
@@ -0,0 +1,237 @@
+import time
+import metrics
+from webmodel import BaseHandler, service_handler, service_initializer, ProcessingException, SimpleResults
+from cam.Camera import Camera
+from cam.FrameCache import FrameCache
+from imaging import Stacking, Calibration
+from storage.CalibrationLibrary import CalibrationLibrary
+
+
+class CalibrationHandler(BaseHandler):
+    # Set up by CalibrationInitializer once the configuration has been loaded
+    library = None
+
+    # Prepared calibrations, by the masters they were made from
+    cache = FrameCache(128 * 1024 * 1024)
+
+    # What bias frames are exposed for, in microseconds
+    BIAS_SHUTTER_SPEED = 100
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def _library():
+        if CalibrationHandler.library is None:
+            raise ProcessingException("The calibration library is not available", 503)
+        return CalibrationHandler.library
+
+    @staticmethod
+    def _offset(library, bias, dark, shutter_speed):
+        """
+        The dark (or failing that the bias) for shutter_speed, scaling the
+        dark current of a dark taken at another shutter speed.
+        """
+        if dark is not None and dark["ss"] == shutter_speed:
+            master, hot = library.load(dark)
+            return master, hot
+        if dark is not None and bias is not None:
+            master, hot = library.load(dark)
+            offset, _ = library.load(bias)
+            master -= offset
+            master *= shutter_speed / float(dark["ss"])
+            master += offset
+            return master, hot
+        if bias is not None:
+            return library.load(bias)[0], None
+        return None, None
+
+    @staticmethod
+    def _masters(library, settings, temperature):
+        bias = library.find("bias", settings, temperature)
+        dark = None
+        if settings.get("ss") is not None:
+            dark = library.find("dark", settings, temperature, ss=settings["ss"])
+            if dark is not None and dark["ss"] != settings["ss"] and bias is None:
+                # It can't be scaled without knowing its bias
+                dark = None
+        return bias, dark
+
+    @staticmethod
+    def calibration(settings, temperature=None):
+        """
+        The prepared Calibration for frames captured with settings (iso, ss,
+        md, hres, vres, hflip and vflip), or None without any matching
+        masters.
+        """
+        library = CalibrationHandler.library
+        if library is None:
+            return None
+        bias, dark = CalibrationHandler._masters(library, settings, temperature)
+        flat = library.find("flat", settings, temperature)
+        if bias is None and dark is None and flat is None:
+            return None
+
+        key = ("calibration", settings.get("ss")) + tuple(m["id"] if m is not None else None for m in (bias, dark, flat))
+        cached = CalibrationHandler.cache.get(key, float("inf"))
+        if cached is not None:
+            return cached[0]
+
+        offset, hot = CalibrationHandler._offset(library, bias, dark, settings.get("ss"))
+        calibration = Calibration.Calibration((settings["vres"], settings["hres"], 3),
+                                              offset=offset,
+                                              flat=library.load(flat)[0] if flat is not None else None,
+                                              hot=hot)
+        CalibrationHandler.cache.put(key, calibration)
+        return calibration
+
+    @staticmethod
+    def calibrate(output, settings):
+        """
+        Corrects a freshly captured (and not yet shared) FrameBuffer in place
+        with the masters that match its settings, if there are any.
+        """
+        calibration = CalibrationHandler.calibration(settings, Camera.temperature())
+        if calibration is None:
+            return False
+        with metrics.span("calibrate"):
+            calibration.apply(output.view)
+        metrics.CALIBRATED_FRAMES.inc()
+        return True
+
+
+@service_initializer
+class CalibrationInitializer(object):
+    def init(self, config):
+        directory = "calibration"
+        if config.has_option("calibration", "calibration_dir"):
+            directory = config.get("calibration", "calibration_dir")
+        if config.has_option("calibration", "cache_mb"):
+            CalibrationHandler.cache.max_bytes = config.getint("calibration", "cache_mb") * 1024 * 1024
+        CalibrationHandler.library = CalibrationLibrary(directory)
+
+
+@service_handler
+class CalibrationBuildHandlerImpl(CalibrationHandler):
+    name = "Build Calibration Master"
+    path = "/calibration/build"
+    description = "Captures and combines a series of bias, dark or flat frames into a master for calibrating captures"
+    params = {}
+    singleton = True
+
+    MAX_FRAMES = 256
+
+    def handle(self, computeOptions, **args):
+        kind = computeOptions.get_argument("kind", None)
+        n = computeOptions.get_int_arg("n", 16)
+        method = computeOptions.get_argument("method", "sigmaclip")
+        kappa = computeOptions.get_float_arg("kappa", 3.0)
+        sigma = computeOptions.get_float_arg("sigma", 5.0)
+        shutter_speed = computeOptions.get_int_arg("ss", None)
+        settings = {
+            "iso": computeOptions.get_int_arg("iso", None),
+            "md": computeOptions.get_int_arg("md", 0),
+            "hres": computeOptions.get_int_arg("hres", 1920),
+            "vres": computeOptions.get_int_arg("vres", 1080),
+            "hflip": computeOptions.get_boolean_arg("hflip", False),
+            "vflip": computeOptions.get_boolean_arg("vflip", False)
+        }
+
+        if kind not in Calibration.KINDS:
+            raise ProcessingException("Calibration kind must be one of %s" % ", ".join(Calibration.KINDS), 400)
+        if n < 1 or n > CalibrationBuildHandlerImpl.MAX_FRAMES:
+            raise ProcessingException("Frame count must be between 1 and %s" % CalibrationBuildHandlerImpl.MAX_FRAMES, 400)
+        if method not in Stacking.METHODS:
+            raise ProcessingException("Invalid stacking method '%s'" % method, 400)
+        if kappa <= 0 or sigma <= 0:
+            raise ProcessingException("Invalid kappa or sigma", 400)
+        if kind == "dark" and shutter_speed is None:
+            raise ProcessingException("Darks need the shutter speed they are for, pass ss", 400)
+        if kind == "bias":
+            shutter_speed = shutter_speed or CalibrationHandler.BIAS_SHUTTER_SPEED
+        settings["ss"] = shutter_speed
+        library = CalibrationHandler._library()
+
+        if method == "sigmaclip":
+            accumulator = Stacking.SigmaClipAccumulator(kappa)
+        else:
+            accumulator = Stacking.METHODS[method]()
+
+        start = time.time()
+        temperatures = []
+        camera = Camera()
+        for _ in range(n):
+            output = camera.capture(vflip=settings["vflip"],
+                                    hflip=settings["hflip"],
+                                    iso=settings["iso"],
+                                    shutter_speed=shutter_speed,
+                                    resolution=(settings["hres"], settings["vres"]),
+                                    exposure_mode=computeOptions.get_argument("ex"),
+                                    awb_mode=computeOptions.get_argument("awb"),
+                                    settle_time=computeOptions.get_int_arg("st", 0),
+                                    sensor_mode=settings["md"],
+                                    priority=computeOptions.get_int_arg("priority", 0),
+                                    timeout=computeOptions.get_float_arg("timeout", None))
+            temperatures.append(Camera.temperature())
+            try:
+                accumulator.add(output.view)
+            finally:
+                output.release()
+        master = accumulator.result()
+
+        hot = None
+        if kind == "dark":
+            hot = Calibration.hot_pixels(master, sigma)
+        elif kind == "flat":
+            bias, dark = CalibrationHandler._masters(library, settings, None)
+            offset, _ = CalibrationHandler._offset(library, bias, dark, shutter_speed)
+            master = Calibration.normalize_flat(master, offset)
+
+        temperatures = [t for t in temperatures if t is not None]
+        metadata = dict(settings)
+        metadata.update({
+            "temperature": sum(temperatures) / len(temperatures) if len(temperatures) > 0 else None,
+            "frames": n,
+            "method": method
+        })
+        record = library.put(kind, master, metadata, hot)
+        record["seconds"] = time.time() - start
+        return SimpleResults(record)
+
+
+@service_handler
+class CalibrationQueryHandlerImpl(CalibrationHandler):
+    name = "Query Calibration Masters"
+    path = "/calibration/query"
+    description = "Lists the calibration masters and the settings they were captured with"
+    params = {}
+    singleton = True
+
+    FILTERS = (
+        ("id", None),
+        ("kind", None),
+        ("iso", int),
+        ("ss", int),
+        ("md", int),
+        ("hres", int),
+        ("vres", int)
+    )
+
+    def handle(self, computeOptions, **args):
+        filters = {}
+        for name, convert in CalibrationQueryHandlerImpl.FILTERS:
+            value = computeOptions.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                filters[name] = convert(value) if convert is not None else value
+            except ValueError:
+                raise ProcessingException("Invalid value for '%s'" % name, 400)
+
+        limit = computeOptions.get_int_arg("limit", 100)
+        offset = computeOptions.get_int_arg("offset", 0)
+        if limit < 1 or offset < 0:
+            raise ProcessingException("Invalid limit or offset", 400)
+
+        total, masters = CalibrationHandler._library().query(filters, limit=limit, offset=offset)
+        return SimpleResults({"total": total, "masters": masters})
@@ -0,0 +1,23 @@
+from webmodel import service_initializer
+from cam.Camera import Camera
+from cam import SimulatedCamera
+
+
+@service_initializer
+class CameraBackendInitializer(object):
+    # None leaves the session to import picamera on first use
+    BACKENDS = {
+        "picamera": None,
+        "simulated": SimulatedCamera
+    }
+
+    def init(self, config):
+        backend = "picamera"
+        if config.has_option("camera", "backend"):
+            backend = config.get("camera", "backend")
+        if backend not in CameraBackendInitializer.BACKENDS:
+            raise ValueError("Unknown camera backend '%s'" % backend)
+        Camera.session.set_camera_module(CameraBackendInitializer.BACKENDS[backend])
+
+        if config.has_option("camera", "reorder_window"):
+            Camera.scheduler.window = config.getint("camera", "reorder_window")
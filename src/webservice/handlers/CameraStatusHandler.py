@@ -0,0 +1,46 @@
+from webmodel import BaseHandler, service_handler, SimpleResults
+from cam.Camera import Camera
+from StillImageHandler import StillImageHandlerImpl
+from StreamHandler import StreamHandlerImpl
+from MjpegStreamHandler import MjpegStreamHandlerImpl
+from SequenceHandler import SequenceHandler
+from StoreHandler import StoreHandler
+from CalibrationHandler import CalibrationHandler
+from TileHandler import TileHandler
+from imaging.Encoders import DEFAULT_ENCODER
+from imaging.Annotation import DEFAULT_LAYERS
+
+
+@service_handler
+class CameraStatusHandlerImpl(BaseHandler):
+    name = "Camera Status"
+    path = "/status"
+    description = "Reports the camera job queue and session state"
+    params = {}
+    singleton = True
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def status():
+        return {
+            "queue": Camera.scheduler.stats(),
+            "session": Camera.session.stats(),
+            "buffers": Camera.buffers.stats(),
+            "still_captures": StillImageHandlerImpl.captures.stats(),
+            "still_cache": StillImageHandlerImpl.cache.stats(),
+            "encoder": DEFAULT_ENCODER.stats(),
+            "annotation_layers": DEFAULT_LAYERS.stats(),
+            "stream": StreamHandlerImpl.broadcaster.stats(),
+            "mjpeg": MjpegStreamHandlerImpl.broadcaster.stats(),
+            "sequences": SequenceHandler.sequencer.stats() if SequenceHandler.sequencer is not None else None,
+            "store": StoreHandler.store.stats() if StoreHandler.store is not None else None,
+            "calibration_masters": CalibrationHandler.library.stats() if CalibrationHandler.library is not None else None,
+            "calibration_cache": CalibrationHandler.cache.stats(),
+            "tile_pyramids": TileHandler.pyramids.stats(),
+            "tiles": TileHandler.tiles.stats()
+        }
+
+    def handle(self, computeOptions, **args):
+        return SimpleResults(CameraStatusHandlerImpl.status())
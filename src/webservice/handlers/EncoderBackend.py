@@ -0,0 +1,14 @@
+from webmodel import service_initializer
+from imaging.Encoders import DEFAULT_ENCODER
+
+
+@service_initializer
+class EncoderInitializer(object):
+    def init(self, config):
+        if config.has_option("encoder", "processes"):
+            DEFAULT_ENCODER.processes = config.getint("encoder", "processes")
+        # Before the server listens, so the workers don't inherit its sockets
+        DEFAULT_ENCODER.start()
+
+    def shutdown(self):
+        DEFAULT_ENCODER.shutdown()
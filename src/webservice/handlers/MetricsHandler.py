@@ -0,0 +1,35 @@
+import metrics
+from webmodel import BaseHandler, service_handler, ContentTypes
+from CameraStatusHandler import CameraStatusHandlerImpl
+
+# Everything /status reports is exported alongside the timings
+metrics.REGISTRY.collector("camera_status", CameraStatusHandlerImpl.status)
+
+
+@service_handler
+class MetricsHandlerImpl(BaseHandler):
+    name = "Metrics"
+    path = "/metrics"
+    description = "Reports stage timings, queue and thread pool metrics in the Prometheus text format"
+    params = {}
+    singleton = True
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        return MetricsResult(metrics.REGISTRY.render())
+
+
+class MetricsResult:
+    def __init__(self, result):
+        self.result = result
+
+    def isStream(self):
+        return False
+
+    def getContentType(self):
+        return ContentTypes.TEXT
+
+    def toText(self):
+        return self.result
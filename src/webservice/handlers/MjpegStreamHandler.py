@@ -0,0 +1,90 @@
+import time
+from tornado import gen
+from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException, AsyncReader
+from cam.MjpegBroadcaster import MjpegBroadcaster
+
+
+@service_handler
+class MjpegStreamHandlerImpl(BaseHandler):
+    name = "MJPEG Stream"
+    path = "/mjpeg"
+    description = "Streams JPEG frames from the camera as multipart/x-mixed-replace"
+    params = {}
+    singleton = True
+
+    # One encoder shared by every viewer
+    broadcaster = MjpegBroadcaster()
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        hres = computeOptions.get_int_arg("hres", 640)
+        vres = computeOptions.get_int_arg("vres", 480)
+        framerate = computeOptions.get_int_arg("fps", 15)
+        quality = computeOptions.get_int_arg("quality", 80)
+        sensor_mode = computeOptions.get_int_arg("md", 0)
+        priority = computeOptions.get_int_arg("priority", 0)
+        timeout = computeOptions.get_float_arg("timeout", None)
+
+        if framerate <= 0:
+            raise ProcessingException("Invalid frame rate '%s' specified" % framerate, 400)
+
+        reader = MjpegStreamHandlerImpl.broadcaster.subscribe(resolution=(hres, vres),
+                                                              framerate=framerate,
+                                                              quality=quality,
+                                                              sensor_mode=sensor_mode,
+                                                              priority=priority,
+                                                              timeout=timeout)
+        return MjpegStreamResult(MjpegStreamHandlerImpl.broadcaster, reader, framerate)
+
+
+class MjpegStreamResult:
+    BOUNDARY = "frame"
+
+    def __init__(self, broadcaster, reader, framerate):
+        self.__broadcaster = broadcaster
+        self.__reader = reader
+        self.__interval = 1.0 / min(framerate, MjpegBroadcaster.MAX_FRAMERATE)
+
+    def isStream(self):
+        return True
+
+    def getContentType(self):
+        return ContentTypes.MJPEG
+
+    def getHeaders(self):
+        return {"Content-Type": "multipart/x-mixed-replace; boundary=%s" % MjpegStreamResult.BOUNDARY}
+
+    @gen.coroutine
+    def stream(self, writable):
+        reader = AsyncReader(self.__reader)
+        next_frame = 0
+        try:
+            while not writable.client_closed:
+                # Throttle to this client's frame rate; whatever frame is newest
+                # once it's due is the one that gets sent
+                delay = next_frame - time.time()
+                if delay > 0:
+                    yield gen.sleep(delay)
+
+                frames = yield reader.read(timeout=1.0)
+                if frames is None:
+                    break
+                if len(frames) == 0:
+                    continue
+
+                next_frame = time.time() + self.__interval
+                writable.write(b"--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n" % (MjpegStreamResult.BOUNDARY, len(frames[0])))
+                writable.write(frames[0])
+                writable.write(b"\r\n")
+                yield writable.flush()
+        finally:
+            reader.close()
+            self.__broadcaster.unsubscribe(self.__reader)
+
+    def toJson(self):
+        raise ProcessingException("JSON not supported for stream")
+
+    def toImage(self):
+        raise ProcessingException("Images not supported for stream")
@@ -0,0 +1,113 @@
+import itertools
+from datetime import datetime
+import metrics
+from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException
+from cam.Camera import Camera
+from imaging import Bayer, ArrayFormats
+
+
+@service_handler
+class RawHandlerImpl(BaseHandler):
+    name = "Raw Capture"
+    path = "/raw"
+    description = "Captures the sensor's raw 10 bit Bayer data, optionally demosaiced, as 16 bit FITS or NPY"
+    params = {}
+    singleton = True
+
+    OUTPUTS = (ContentTypes.FITS, ContentTypes.NPY)
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        vflip = computeOptions.get_boolean_arg("vflip", False)
+        hflip = computeOptions.get_boolean_arg("hflip", False)
+        iso = computeOptions.get_int_arg("iso", None)
+        shutter_speed = computeOptions.get_int_arg("ss", None)
+        method = computeOptions.get_argument("demosaic", None)
+        content_type = computeOptions.get_argument("output", ContentTypes.FITS).upper()
+
+        if method is not None and method not in Bayer.DEMOSAIC_METHODS:
+            raise ProcessingException("Unsupported demosaic method '%s'" % method, 400)
+        if content_type not in RawHandlerImpl.OUTPUTS:
+            raise ProcessingException("Unsupported output format '%s'" % content_type, 400)
+
+        camera = Camera()
+        data, revision = camera.capture_raw(vflip=vflip,
+                                            hflip=hflip,
+                                            iso=iso,
+                                            shutter_speed=shutter_speed,
+                                            exposure_mode=computeOptions.get_argument("ex"),
+                                            awb_mode=computeOptions.get_argument("awb"),
+                                            settle_time=computeOptions.get_int_arg("st", 0),
+                                            sensor_mode=computeOptions.get_int_arg("md", 0),
+                                            wait=computeOptions.get_boolean_arg("wait", True),
+                                            priority=computeOptions.get_int_arg("priority", 0),
+                                            timeout=computeOptions.get_float_arg("timeout", None))
+        captured = datetime.utcnow()
+
+        raw_format = Bayer.RAW_FORMATS.get(revision)
+        if raw_format is None:
+            raise ProcessingException("Raw capture isn't supported for the %s sensor" % revision, 501)
+
+        with metrics.span("unpack"):
+            array = Bayer.unpack10(Bayer.extract(data, raw_format), raw_format.width)
+        del data
+
+        pattern = Bayer.flip_pattern(raw_format.pattern, hflip, vflip)
+        if method is not None:
+            with metrics.span("demosaic"):
+                array = Bayer.demosaic(array, pattern, method)
+
+        headers = {
+            "X-Raw-Sensor": revision,
+            "X-Raw-Bit-Depth": str(Bayer.BIT_DEPTH)
+        }
+        cards = [("DATE-OBS", captured.strftime("%Y-%m-%dT%H:%M:%S.%f"), "UTC start of capture"),
+                 ("INSTRUME", revision, "Camera sensor"),
+                 ("BITDEPTH", Bayer.BIT_DEPTH, "Bits per pixel from the sensor"),
+                 ("DATAMAX", (1 << Bayer.BIT_DEPTH) - 1)]
+        if shutter_speed is not None:
+            cards.append(("EXPTIME", shutter_speed / 1000000.0, "Exposure time in seconds"))
+        if iso is not None:
+            cards.append(("ISO", iso))
+        if method is None:
+            headers["X-Raw-Bayer-Pattern"] = pattern
+            cards.extend([("BAYERPAT", pattern, "Colour filter pattern"), ("XBAYROFF", 0), ("YBAYROFF", 0)])
+        else:
+            headers["X-Raw-Demosaic"] = method
+            cards.append(("DEMOSAIC", method))
+        return RawResult(array, content_type, headers, cards)
+
+
+class RawResult:
+    def __init__(self, array, content_type, headers, cards):
+        self.array = array
+        self.content_type = content_type
+        self.headers = headers
+        if content_type == ContentTypes.FITS:
+            self.header = ArrayFormats.fits_header(array, cards)
+            self.trailer = ArrayFormats.fits_padding(array)
+        else:
+            self.header = ArrayFormats.npy_header(array)
+            self.trailer = b""
+
+    def getContentType(self):
+        return self.content_type
+
+    def getHeaders(self):
+        extension = "fits" if self.content_type == ContentTypes.FITS else "npy"
+        headers = dict(self.headers)
+        headers["Content-Length"] = str(len(self.header) + self.array.size * 2 + len(self.trailer))
+        headers["Content-Disposition"] = "attachment; filename=\"raw.%s\"" % extension
+        return headers
+
+    def iterChunks(self):
+        if self.content_type == ContentTypes.FITS:
+            chunks = ArrayFormats.fits_chunks(self.array)
+        else:
+            chunks = ArrayFormats.npy_chunks(self.array)
+        return itertools.chain([self.header], chunks, [self.trailer])
+
+    def toJson(self):
+        raise ProcessingException("JSON not supported for raw captures")
@@ -0,0 +1,265 @@
+import itertools
+import json
+import PIL.Image as Image
+from tornado import gen
+from webmodel import BaseHandler, service_handler, service_initializer, ContentTypes, ProcessingException, SimpleResults, AsyncReader
+from cam.Camera import Camera
+from cam.Sequencer import Sequencer
+from imaging.Encoders import DEFAULT_ENCODER, parse_format
+from imaging.Pipeline import Pipeline
+from StillImageHandler import StillImageResult
+from CalibrationHandler import CalibrationHandler
+
+
+def capture_exposure(sequence, slot, exposure):
+    spec = sequence.spec
+    camera = Camera()
+    frame = camera.capture(resolution=(spec["hres"], spec["vres"]),
+                           shutter_speed=exposure["ss"],
+                           iso=exposure["iso"],
+                           awb_mode=spec["awb"],
+                           exposure_mode=spec["ex"],
+                           settle_time=spec["st"],
+                           hflip=spec["hflip"],
+                           vflip=spec["vflip"],
+                           sensor_mode=spec["md"],
+                           priority=spec["priority"],
+                           # Not worth waiting for beyond the next slot
+                           timeout=spec["interval"] if spec["interval"] > 0 else None)
+    try:
+        # Sequences submitted before calibration existed have no say in it
+        if spec.get("calibrate", True):
+            CalibrationHandler.calibrate(frame, {"iso": exposure["iso"], "ss": exposure["ss"], "md": spec["md"],
+                                                 "hres": spec["hres"], "vres": spec["vres"],
+                                                 "hflip": spec["hflip"], "vflip": spec["vflip"]})
+        data = Pipeline(Pipeline.parse(spec["pipeline"])).run(frame.view)
+        img = frame.to_image() if data is frame.view else Image.fromarray(data)
+    finally:
+        frame.release()
+
+    encoded = DEFAULT_ENCODER.encode(img, spec["output"], quality=spec["quality"], compress_level=spec["compression"])
+    return encoded, spec["output"].lower()
+
+
+class SequenceHandler(BaseHandler):
+    # Set up by SequenceInitializer once the configuration has been loaded
+    sequencer = None
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def _sequencer():
+        if SequenceHandler.sequencer is None:
+            raise ProcessingException("Sequences are not available", 503)
+        return SequenceHandler.sequencer
+
+    @staticmethod
+    def _sequence_id(computeOptions):
+        sequence_id = computeOptions.get_argument("id", None)
+        if sequence_id is None:
+            raise ProcessingException("Missing sequence id", 400)
+        return sequence_id
+
+    @staticmethod
+    def _list_arg(computeOptions, name, convert):
+        value = computeOptions.get_argument(name, None)
+        if value is None or len(value) == 0:
+            return [None]
+        try:
+            return [convert(v) for v in value.split(",")]
+        except ValueError:
+            raise ProcessingException("Invalid value for '%s'" % name, 400)
+
+
+@service_initializer
+class SequenceInitializer(object):
+    def init(self, config):
+        directory = "sequences"
+        if config.has_option("sequences", "sequence_dir"):
+            directory = config.get("sequences", "sequence_dir")
+        SequenceHandler.sequencer = Sequencer(directory, capture_exposure)
+        SequenceHandler.sequencer.resume()
+
+
+@service_handler
+class SequenceSubmitHandlerImpl(SequenceHandler):
+    name = "Submit Sequence"
+    path = "/sequence/submit"
+    description = "Starts a server side sequence of timed, optionally bracketed, captures"
+    params = {}
+    singleton = True
+
+    MAX_FRAMES = 100000
+    MAX_BRACKETS = 16
+
+    def handle(self, computeOptions, **args):
+        isos = SequenceHandler._list_arg(computeOptions, "iso", int)
+        shutter_speeds = SequenceHandler._list_arg(computeOptions, "ss", int)
+        spec = {
+            "frames": computeOptions.get_int_arg("frames", 1),
+            "interval": computeOptions.get_float_arg("interval", 0.0),
+            "delay": computeOptions.get_float_arg("delay", 0.0),
+            "brackets": [{"iso": iso, "ss": ss} for iso, ss in itertools.product(isos, shutter_speeds)],
+            "hres": computeOptions.get_int_arg("hres", 1920),
+            "vres": computeOptions.get_int_arg("vres", 1080),
+            "st": computeOptions.get_int_arg("st", 0),
+            "ex": computeOptions.get_argument("ex"),
+            "awb": computeOptions.get_argument("awb"),
+            "md": computeOptions.get_int_arg("md", 0),
+            "hflip": computeOptions.get_boolean_arg("hflip", False),
+            "vflip": computeOptions.get_boolean_arg("vflip", False),
+            "pipeline": computeOptions.get_argument("pipeline", None),
+            "output": parse_format(computeOptions.get_argument("format", None)),
+            "quality": computeOptions.get_int_arg("quality", None),
+            "compression": computeOptions.get_int_arg("compression", None),
+            "priority": computeOptions.get_int_arg("priority", 0),
+            "calibrate": computeOptions.get_boolean_arg("calibrate", True)
+        }
+
+        if spec["frames"] < 1 or spec["frames"] > SequenceSubmitHandlerImpl.MAX_FRAMES:
+            raise ProcessingException("Frame count must be between 1 and %s" % SequenceSubmitHandlerImpl.MAX_FRAMES, 400)
+        if spec["interval"] < 0 or spec["delay"] < 0:
+            raise ProcessingException("Interval and delay can't be negative", 400)
+        if len(spec["brackets"]) > SequenceSubmitHandlerImpl.MAX_BRACKETS:
+            raise ProcessingException("At most %s bracketed exposures per frame" % SequenceSubmitHandlerImpl.MAX_BRACKETS, 400)
+        # Fail now rather than on the first capture
+        Pipeline.parse(spec["pipeline"])
+
+        sequence = SequenceHandler._sequencer().submit(spec)
+        if sequence is None:
+            raise ProcessingException("Too many active sequences", 503)
+        return SimpleResults(SequenceHandler._sequencer().get(sequence.id))
+
+
+@service_handler
+class SequenceStatusHandlerImpl(SequenceHandler):
+    name = "Sequence Status"
+    path = "/sequence/status"
+    description = "Reports the progress of a sequence"
+    params = {}
+    singleton = True
+
+    def handle(self, computeOptions, **args):
+        status = SequenceHandler._sequencer().get(SequenceHandler._sequence_id(computeOptions))
+        if status is None:
+            raise ProcessingException("Unknown sequence", 404)
+        return SimpleResults(status)
+
+
+@service_handler
+class SequenceCancelHandlerImpl(SequenceHandler):
+    name = "Cancel Sequence"
+    path = "/sequence/cancel"
+    description = "Cancels a running sequence"
+    params = {}
+    singleton = True
+
+    def handle(self, computeOptions, **args):
+        sequence_id = SequenceHandler._sequence_id(computeOptions)
+        if SequenceHandler._sequencer().cancel(sequence_id) is None:
+            raise ProcessingException("Unknown sequence", 404)
+        return SimpleResults(SequenceHandler._sequencer().get(sequence_id))
+
+
+@service_handler
+class SequenceListHandlerImpl(SequenceHandler):
+    name = "List Sequences"
+    path = "/sequence/list"
+    description = "Lists all known sequences"
+    params = {}
+    singleton = True
+
+    def handle(self, computeOptions, **args):
+        return SimpleResults(SequenceHandler._sequencer().list())
+
+
+@service_handler
+class SequenceFrameHandlerImpl(SequenceHandler):
+    name = "Sequence Frame"
+    path = "/sequence/frame"
+    description = "Returns a file captured by a sequence"
+    params = {}
+    singleton = True
+
+    CONTENT_TYPES = {
+        "png": ContentTypes.PNG,
+        "jpeg": ContentTypes.JPEG,
+        "webp": ContentTypes.WEBP
+    }
+
+    def handle(self, computeOptions, **args):
+        name = computeOptions.get_argument("name", "")
+        path = SequenceHandler._sequencer().file_path(SequenceHandler._sequence_id(computeOptions), name)
+        if path is None:
+            raise ProcessingException("Unknown sequence file", 404)
+        with open(path, "rb") as f:
+            data = f.read()
+        return StillImageResult(data, SequenceFrameHandlerImpl.CONTENT_TYPES[name.rsplit(".", 1)[-1]])
+
+
+@service_handler
+class SequenceEventsHandlerImpl(SequenceHandler):
+    name = "Sequence Events"
+    path = "/sequence/events"
+    description = "Streams sequence progress as server-sent events"
+    params = {}
+    singleton = True
+
+    def handle(self, computeOptions, **args):
+        sequencer = SequenceHandler._sequencer()
+        sequence_id = computeOptions.get_argument("id", None)
+        # Subscribe before taking the snapshot so no change falls in between
+        events = sequencer.events(sequence_id)
+        if sequence_id is not None:
+            snapshot = sequencer.get(sequence_id, details=False)
+            if snapshot is None:
+                raise ProcessingException("Unknown sequence", 404)
+            snapshot = [snapshot]
+        else:
+            snapshot = sequencer.list()
+        return SequenceEventsResult(events, snapshot)
+
+
+class SequenceEventsResult:
+    KEEPALIVE = 15.0
+
+    def __init__(self, events, snapshot):
+        self.__events = events
+        self.__snapshot = snapshot
+
+    def isStream(self):
+        return True
+
+    def getContentType(self):
+        return ContentTypes.EVENTS
+
+    @staticmethod
+    def __write(writable, event):
+        writable.write(b"data: %s\n\n" % json.dumps(event))
+
+    @gen.coroutine
+    def stream(self, writable):
+        reader = AsyncReader(self.__events)
+        try:
+            for event in self.__snapshot:
+                SequenceEventsResult.__write(writable, event)
+            yield writable.flush()
+
+            while not writable.client_closed:
+                events = yield reader.read(timeout=SequenceEventsResult.KEEPALIVE)
+                if events is None:
+                    break
+                if len(events) == 0:
+                    writable.write(b": keepalive\n\n")
+                for event in events:
+                    SequenceEventsResult.__write(writable, event)
+                yield writable.flush()
+        finally:
+            reader.close()
+
+    def toJson(self):
+        raise ProcessingException("JSON not supported for stream")
+
+    def toImage(self):
+        raise ProcessingException("Images not supported for stream")
@@ -0,0 +1,243 @@
+import itertools
+import threading
+import time
+import Queue
+import PIL.Image as Image
+import numpy as np
+import metrics
+from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException
+from cam.Camera import Camera
+from cam.BufferPool import FrameBuffer
+from imaging.Encoders import DEFAULT_ENCODER
+from imaging.Pipeline import Pipeline, Channel, Grey
+from imaging import Stacking, ArrayFormats
+from imaging.Registration import Registrar, Drizzle, warp
+from CalibrationHandler import CalibrationHandler
+
+
+@service_handler
+class StackHandlerImpl(BaseHandler):
+    name = "Frame Stack"
+    path = "/stack"
+    description = "Captures a series of frames and combines them into a single 16 bit or floating point image"
+    params = {}
+    singleton = True
+
+    MAX_FRAMES = 1024
+    MAX_DRIZZLE_SCALE = 4.0
+
+    # Captured frames waiting to be accumulated, bounds how far capture can
+    # run ahead of the stacking
+    QUEUE_DEPTH = 1
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def __produce(capture, n, frames, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    frames.put(item, timeout=0.5)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        try:
+            for _ in range(n):
+                if stop.is_set():
+                    return
+                frame = capture()
+                if not put(frame):
+                    frame.release()
+        except Exception as ex:
+            put(ex)
+
+    @staticmethod
+    def __drain(frames):
+        while True:
+            try:
+                frame = frames.get_nowait()
+            except Queue.Empty:
+                return
+            if isinstance(frame, FrameBuffer):
+                frame.release()
+
+    def handle(self, computeOptions, **args):
+        vflip = computeOptions.get_boolean_arg("vflip", False)
+        hflip = computeOptions.get_boolean_arg("hflip", False)
+        iso = computeOptions.get_int_arg("iso", None)
+        shutter_speed = computeOptions.get_int_arg("ss", None)
+        settle_time = computeOptions.get_int_arg("st", 0)
+        hres = computeOptions.get_int_arg("hres", 1920)
+        vres = computeOptions.get_int_arg("vres", 1080)
+        exposure_mode = computeOptions.get_argument("ex")
+        awb_mode = computeOptions.get_argument("awb")
+        channel = computeOptions.get_argument("channel")
+        grey = computeOptions.get_boolean_arg("grey", False)
+        sensor_mode = computeOptions.get_int_arg("md", 0)
+        priority = computeOptions.get_int_arg("priority", 0)
+        timeout = computeOptions.get_float_arg("timeout", None)
+        n = computeOptions.get_int_arg("n", 16)
+        method = computeOptions.get_argument("method", "mean")
+        kappa = computeOptions.get_float_arg("kappa", 3.0)
+        content_type = computeOptions.get_argument("output", ContentTypes.NPY).upper()
+        dtype = computeOptions.get_argument("dtype", "float32")
+        align = computeOptions.get_boolean_arg("align", False)
+        rotation = computeOptions.get_boolean_arg("rotation", False)
+        drizzle_scale = computeOptions.get_float_arg("drizzle", None)
+        roi_size = computeOptions.get_int_arg("roi", 256)
+        downsample = computeOptions.get_int_arg("downsample", 4)
+        calibrate = computeOptions.get_boolean_arg("calibrate", True)
+
+        if n < 1 or n > StackHandlerImpl.MAX_FRAMES:
+            raise ProcessingException("Frame count must be between 1 and %s" % StackHandlerImpl.MAX_FRAMES, 400)
+        if method not in Stacking.METHODS:
+            raise ProcessingException("Invalid stacking method '%s'" % method, 400)
+        if kappa <= 0:
+            raise ProcessingException("Invalid kappa '%s'" % kappa, 400)
+        if content_type not in (ContentTypes.NPY, ContentTypes.PNG):
+            raise ProcessingException("Unsupported stack format '%s'" % content_type, 400)
+        if dtype not in ("float32", "uint16"):
+            raise ProcessingException("Invalid stack data type '%s'" % dtype, 400)
+        if content_type == ContentTypes.PNG and channel is None and grey is not True:
+            raise ProcessingException("16 bit PNG output needs a single channel, pass channel or grey", 400)
+        if drizzle_scale is not None:
+            if method != "mean":
+                raise ProcessingException("Drizzle combines frames by their mean, it can't be used with '%s'" % method, 400)
+            if drizzle_scale < 1 or drizzle_scale > StackHandlerImpl.MAX_DRIZZLE_SCALE:
+                raise ProcessingException("Drizzle scale must be between 1 and %s" % StackHandlerImpl.MAX_DRIZZLE_SCALE, 400)
+            align = True
+        if roi_size < 32 or downsample < 1:
+            raise ProcessingException("Invalid registration roi or downsample", 400)
+
+        # Band reduction happens per frame, ahead of the (float) accumulators
+        stages = []
+        if channel is not None:
+            stages.append(Channel(channel))
+        if grey is True:
+            stages.append(Grey())
+        pipeline = Pipeline(stages)
+
+        if method == "sigmaclip":
+            accumulator = Stacking.SigmaClipAccumulator(kappa)
+        else:
+            accumulator = Stacking.METHODS[method]()
+
+        def capture():
+            camera = Camera()
+            output = camera.capture(vflip=vflip,
+                                    hflip=hflip,
+                                    iso=iso,
+                                    shutter_speed=shutter_speed,
+                                    resolution=(hres, vres),
+                                    exposure_mode=exposure_mode,
+                                    awb_mode=awb_mode,
+                                    settle_time=settle_time,
+                                    sensor_mode=sensor_mode,
+                                    priority=priority,
+                                    timeout=timeout)
+            if calibrate:
+                # On the capture thread, so it overlaps the accumulation
+                try:
+                    CalibrationHandler.calibrate(output, {"iso": iso, "ss": shutter_speed, "md": sensor_mode,
+                                                          "hres": hres, "vres": vres, "hflip": hflip, "vflip": vflip})
+                except:
+                    output.release()
+                    raise
+            return output
+
+        # Each frame is its own camera job, captured on a separate thread so
+        # frame k+1 is exposing while frame k is being accumulated
+        start = time.time()
+        frames = Queue.Queue(maxsize=StackHandlerImpl.QUEUE_DEPTH)
+        stop = threading.Event()
+        # Its spans count towards the request's Server-Timing like the rest
+        producer = threading.Thread(target=metrics.run_timed,
+                                    args=(metrics.current(), StackHandlerImpl.__produce, capture, n, frames, stop),
+                                    name="stack-capture")
+        producer.daemon = True
+        producer.start()
+
+        # With alignment every frame is registered against the first one and
+        # either drizzled or resampled onto its grid before accumulating
+        registrar = None
+        warped = None
+        try:
+            for _ in range(n):
+                frame = frames.get()
+                if isinstance(frame, Exception):
+                    raise frame
+                try:
+                    data = pipeline.run(frame.view)
+                    if not align:
+                        accumulator.add(data)
+                        continue
+
+                    if registrar is None:
+                        registrar = Registrar(data, downsample, roi_size, rotation)
+                        if drizzle_scale is not None:
+                            accumulator = Drizzle(data.shape, drizzle_scale)
+                    transform = registrar.register(data)
+                    if drizzle_scale is not None:
+                        accumulator.add(data, transform)
+                    else:
+                        warped = warp(data, transform, warped)
+                        accumulator.add(warped)
+                finally:
+                    frame.release()
+        finally:
+            stop.set()
+            producer.join()
+            StackHandlerImpl.__drain(frames)
+
+        stacked = accumulator.result()
+        if content_type == ContentTypes.PNG or dtype == "uint16":
+            # 8 bit units scaled to the full 16 bit range
+            stacked = np.clip(np.rint(stacked * 257.0), 0, 65535).astype(np.uint16)
+
+        if content_type == ContentTypes.PNG:
+            result = DEFAULT_ENCODER.encode(Image.fromarray(stacked), ContentTypes.PNG)
+        else:
+            # Written out straight from the array
+            result = stacked
+
+        headers = {
+            "X-Stack-Method": method,
+            "X-Stack-Seconds": "%.3f" % (time.time() - start)
+        }
+        for name, value in accumulator.stats().items():
+            headers["X-Stack-%s" % name.capitalize()] = str(value)
+        if registrar is not None:
+            stats = registrar.stats()
+            headers["X-Stack-Max-Shift"] = "%.2f" % stats["max_shift"]
+            headers["X-Stack-Max-Rotation"] = "%.3f" % stats["max_angle"]
+            headers["X-Stack-Registration-Seconds"] = "%.3f" % stats["seconds"]
+        return StackResult(result, content_type, headers)
+
+
+class StackResult:
+    def __init__(self, result, content_type, headers):
+        self.result = result
+        self.content_type = content_type
+        self.headers = headers
+
+    def getHeaders(self):
+        if self.content_type != ContentTypes.NPY:
+            return self.headers
+        headers = dict(self.headers)
+        headers["Content-Length"] = str(len(ArrayFormats.npy_header(self.result)) + self.result.nbytes)
+        headers["Content-Disposition"] = "filename=\"stack.npy\""
+        return headers
+
+    def getContentType(self):
+        return self.content_type
+
+    def iterChunks(self):
+        if self.content_type == ContentTypes.NPY:
+            return itertools.chain([ArrayFormats.npy_header(self.result)], ArrayFormats.npy_chunks(self.result))
+        return memoryview(self.result)
+
+    def toImage(self):
+        return self.result
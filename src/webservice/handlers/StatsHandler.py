@@ -0,0 +1,66 @@
+import metrics
+from webmodel import BaseHandler, service_handler, ProcessingException, SimpleResults
+from cam.Camera import Camera
+from imaging.Pipeline import bin_array
+from imaging import Statistics
+
+
+@service_handler
+class StatsHandlerImpl(BaseHandler):
+    name = "Exposure Statistics"
+    path = "/stats"
+    description = "Captures a frame and returns its histograms and exposure statistics, without encoding an image"
+    params = {}
+    singleton = True
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    def handle(self, computeOptions, **args):
+        hres = computeOptions.get_int_arg("hres", 640)
+        vres = computeOptions.get_int_arg("vres", 480)
+        factor = computeOptions.get_int_arg("bin", 1)
+        include_histograms = computeOptions.get_boolean_arg("histogram", True)
+        percentiles = computeOptions.get_argument("percentiles", "1,5,50,95,99")
+
+        if factor < 1:
+            raise ProcessingException("Invalid bin factor '%s' specified" % factor, 400)
+        try:
+            percentiles = [float(p) for p in percentiles.split(",")]
+        except ValueError:
+            raise ProcessingException("Invalid percentiles '%s' specified" % percentiles, 400)
+        if any(p < 0 or p > 100 for p in percentiles):
+            raise ProcessingException("Percentiles must be between 0 and 100", 400)
+
+        camera = Camera()
+        output = camera.capture(vflip=computeOptions.get_boolean_arg("vflip", False),
+                                hflip=computeOptions.get_boolean_arg("hflip", False),
+                                iso=computeOptions.get_int_arg("iso", None),
+                                shutter_speed=computeOptions.get_int_arg("ss", None),
+                                resolution=(hres, vres),
+                                exposure_mode=computeOptions.get_argument("ex"),
+                                awb_mode=computeOptions.get_argument("awb"),
+                                settle_time=computeOptions.get_int_arg("st", 0),
+                                sensor_mode=computeOptions.get_int_arg("md", 0),
+                                wait=computeOptions.get_boolean_arg("wait", True),
+                                priority=computeOptions.get_int_arg("priority", 0),
+                                timeout=computeOptions.get_float_arg("timeout", None))
+        try:
+            with metrics.span("histogram"):
+                data = bin_array(output.view, factor)
+                counts = Statistics.histograms(data)
+        finally:
+            output.release()
+
+        channels = {}
+        for name, histogram in zip(Statistics.CHANNELS + ("luma", ), counts):
+            channels[name] = Statistics.summarize(histogram, percentiles)
+            if include_histograms:
+                channels[name]["histogram"] = histogram.tolist()
+
+        # Compact, the histograms would otherwise take a line per bin
+        return SimpleResults({
+            "resolution": [data.shape[1], data.shape[0]],
+            "pixels": data.shape[0] * data.shape[1],
+            "channels": channels
+        }, indent=None)
@@ -1,7 +1,6 @@
 
 
 import time
-import picamera
 import PIL.Image as Image
 from PIL import ImageFont
 from PIL import ImageDraw
@@ -9,10 +8,17 @@ import numpy as np
 import os
 import sys
 from io import BytesIO
+import metrics
 from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException
 from time import sleep
 from fractions import Fraction
 from cam.Camera import Camera
+from cam.SingleFlight import SingleFlight
+from cam.FrameCache import FrameCache
+from imaging.Encoders import DEFAULT_ENCODER, parse_format
+from imaging.Pipeline import Pipeline, Channel, Grey, Annotate
+from StoreHandler import StoreHandler
+from CalibrationHandler import CalibrationHandler
 from datetime import datetime
 
 @service_handler
@@ -23,41 +29,14 @@ class StillImageHandlerImpl(BaseHandler):
     params = {}
     singleton = True
 
-    def __init__(self):
-        BaseHandler.__init__(self)
-
-    @staticmethod
-    def __annotate(img, text, size=16, color="white", time_format="%Y-%m-%d %H:%M:%S", **args):
-        if text is None:
-            return
-
-        now = datetime.now()
-        args["time"] = now.strftime(time_format)
-
-        text = text.format(**args)
+    # Identical captures that are requested concurrently share one exposure
+    captures = SingleFlight()
 
-        draw = ImageDraw.Draw(img)
-        font = ImageFont.truetype("LiberationSans-Regular.ttf", size)
-        draw.text((0, 0), text, color, font=font)
+    # Recent frames and encoded images, served to requests that pass maxage
+    cache = FrameCache()
 
-    @staticmethod
-    def __split(img, channel):
-        if channel is not None:
-            r, g, b = img.split()
-            if channel == 'r':
-                img = r
-            elif channel == 'g':
-                img = g
-            elif channel == 'b':
-                img = b
-            else:
-                raise ProcessingException("Invalid image color channel '%s' specified"%channel)
-        return img
-
-    @staticmethod
-    def __grey(img):
-        img = img.convert(mode='L')
-        return img
+    def __init__(self):
+        BaseHandler.__init__(self)
 
     def handle(self, computeOptions, **args):
 
@@ -78,57 +57,143 @@ class StillImageHandlerImpl(BaseHandler):
         text_color = computeOptions.get_argument("textcolor", "white")
         time_format = computeOptions.get_argument("time_format", "%Y-%m-%d %H:%M:%S")
         wait = computeOptions.get_boolean_arg("wait", True)
-
-        camera = Camera()
-        output = camera.capture(vflip=vflip,
-                                hflip=hflip,
-                                iso=iso,
-                                shutter_speed=shutter_speed,
-                                resolution=(hres, vres),
-                                exposure_mode=exposure_mode,
-                                awb_mode=awb_mode,
-                                settle_time=settle_time,
-                                sensor_mode=sensor_mode,
-                                wait=wait)
-
-        img = Image.fromarray(output)
-
-        if annotate is not None:
-            StillImageHandlerImpl.__annotate(img,
-                                             annotate,
-                                             text_size,
-                                             text_color,
-                                             time_format=time_format,
-                                             st=settle_time,
-                                             iso=iso,
-                                             vflip=vflip,
-                                             hflip=hflip,
-                                             ss=shutter_speed,
-                                             hres=hres,
-                                             vres=vres,
-                                             ex=exposure_mode,
-                                             awb_mode=awb_mode,
-                                             channel=channel,
-                                             grey=grey,
-                                             md=sensor_mode)
-
+        priority = computeOptions.get_int_arg("priority", 0)
+        timeout = computeOptions.get_float_arg("timeout", None)
+        max_age = computeOptions.get_float_arg("maxage", None)
+        content_type = parse_format(computeOptions.get_argument("output", None))
+        quality = computeOptions.get_int_arg("quality", None)
+        compress_level = computeOptions.get_int_arg("compression", None)
+        pipeline_spec = computeOptions.get_argument("pipeline", None)
+        store = computeOptions.get_boolean_arg("store", False)
+        calibrate = computeOptions.get_boolean_arg("calibrate", True)
+        if store:
+            # Fail before capturing rather than after
+            StoreHandler._store()
+
+        stages = Pipeline.parse(pipeline_spec)
         if channel is not None:
-            img = StillImageHandlerImpl.__split(img, channel)
-
+            stages.append(Channel(channel))
         if grey is True:
-            img = StillImageHandlerImpl.__grey(img)
-
-        img_bytes = BytesIO()
-        img.save(img_bytes, "PNG")
-        return StillImageResult(img_bytes.getvalue())
+            stages.append(Grey())
+        if annotate is not None:
+            stages.append(Annotate(annotate, text_size, text_color, time_format))
+        pipeline = Pipeline(stages)
+
+        capture_key = (iso, shutter_speed, settle_time, hres, vres, exposure_mode, awb_mode, sensor_mode, hflip, vflip, calibrate)
+        image_key = ("image", capture_key, pipeline.key(), content_type, quality, compress_level)
+
+        def respond(result, age=None):
+            if not store:
+                return StillImageResult(result, content_type, age=age)
+            # Band and text options are folded into the recorded pipeline
+            steps = [pipeline_spec] if pipeline_spec else []
+            if channel is not None:
+                steps.append("channel:%s" % channel)
+            if grey is True:
+                steps.append("grey")
+            if annotate is not None:
+                steps.append("text")
+            stored = StoreHandler._store().put(result, content_type, {
+                "iso": iso,
+                "ss": shutter_speed,
+                "awb": awb_mode,
+                "ex": exposure_mode,
+                "md": sensor_mode,
+                "hres": hres,
+                "vres": vres,
+                "hflip": hflip,
+                "vflip": vflip,
+                "pipeline": "|".join(steps) or None,
+                "source": "still"
+            })
+            return StillImageResult(result, content_type, age=age, stored=stored)
+
+        if max_age is not None:
+            cached = StillImageHandlerImpl.cache.get(image_key, max_age)
+            if cached is not None:
+                return respond(cached[0], age=cached[1])
+
+        def capture():
+            camera = Camera()
+            output = camera.capture(vflip=vflip,
+                                    hflip=hflip,
+                                    iso=iso,
+                                    shutter_speed=shutter_speed,
+                                    resolution=(hres, vres),
+                                    exposure_mode=exposure_mode,
+                                    awb_mode=awb_mode,
+                                    settle_time=settle_time,
+                                    sensor_mode=sensor_mode,
+                                    wait=wait,
+                                    priority=priority,
+                                    timeout=timeout)
+            if calibrate:
+                try:
+                    CalibrationHandler.calibrate(output, {"iso": iso, "ss": shutter_speed, "md": sensor_mode,
+                                                          "hres": hres, "vres": vres, "hflip": hflip, "vflip": vflip})
+                except:
+                    output.release()
+                    raise
+            # The frame may be handed to several requests, none of them may modify it
+            output.view.flags.writeable = False
+            StillImageHandlerImpl.cache.put(("frame", capture_key), output)
+            return output
+
+        cached = None
+        if max_age is not None:
+            cached = StillImageHandlerImpl.cache.get(("frame", capture_key), max_age)
+
+        if cached is not None:
+            output = cached[0]
+        else:
+            output = StillImageHandlerImpl.captures.do(capture_key, capture, share=lambda frame: frame.retain())
+
+        try:
+            data = pipeline.run(output.view, {
+                "st": settle_time,
+                "iso": iso,
+                "vflip": vflip,
+                "hflip": hflip,
+                "ss": shutter_speed,
+                "hres": hres,
+                "vres": vres,
+                "ex": exposure_mode,
+                "awb_mode": awb_mode,
+                "channel": channel,
+                "grey": grey,
+                "md": sensor_mode
+            })
+            with metrics.span("convert"):
+                img = output.to_image() if data is output.view else Image.fromarray(data)
+        finally:
+            output.release()
+
+        result = DEFAULT_ENCODER.encode(img, content_type, quality=quality, compress_level=compress_level)
+        StillImageHandlerImpl.cache.put(image_key, result)
+        return respond(result)
 
 
 class StillImageResult:
-    def __init__(self, result):
+    def __init__(self, result, content_type=ContentTypes.PNG, age=None, stored=None):
         self.result = result
+        self.content_type = content_type
+        self.age = age
+        self.stored = stored
+
+    def getHeaders(self):
+        headers = {}
+        if self.age is not None:
+            headers["Age"] = str(int(self.age))
+        if self.stored is not None:
+            headers["X-Store-Id"] = self.stored["id"]
+            headers["Content-Location"] = StoreHandler.url(self.stored)
+        return headers
 
     def getContentType(self):
-        return ContentTypes.PNG
+        return self.content_type
+
+    def iterChunks(self):
+        return memoryview(self.result)
 
     def toImage(self):
         return self.result
@@ -0,0 +1,225 @@
+import calendar
+import mmap
+import re
+from tornado import gen
+from webmodel import BaseHandler, service_handler, service_initializer, ContentTypes, ProcessingException, SimpleResults
+from storage.ImageStore import ImageStore
+
+
+class StoreHandler(BaseHandler):
+    # Set up by StoreInitializer once the configuration has been loaded
+    store = None
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def _store():
+        if StoreHandler.store is None:
+            raise ProcessingException("The image store is not available", 503)
+        return StoreHandler.store
+
+    @staticmethod
+    def url(record):
+        return "/store/image?id=%s" % record["id"]
+
+
+@service_initializer
+class StoreInitializer(object):
+    def init(self, config):
+        directory = "store"
+        if config.has_option("store", "store_dir"):
+            directory = config.get("store", "store_dir")
+        StoreHandler.store = ImageStore(directory)
+
+
+@service_handler
+class StoreQueryHandlerImpl(StoreHandler):
+    name = "Query Image Store"
+    path = "/store/query"
+    description = "Lists stored images by capture time and exposure settings"
+    params = {}
+    singleton = True
+
+    FILTERS = (
+        ("id", None),
+        ("iso", int),
+        ("ss", int),
+        ("awb", None),
+        ("ex", None),
+        ("md", int),
+        ("hres", int),
+        ("vres", int),
+        ("pipeline", None),
+        ("source", None)
+    )
+
+    @staticmethod
+    def __timestamp(computeOptions, name):
+        try:
+            value = computeOptions.get_datetime_arg(name, None)
+        except ValueError:
+            raise ProcessingException("Invalid time for '%s'" % name, 400)
+        return calendar.timegm(value.utctimetuple()) if value is not None else None
+
+    def handle(self, computeOptions, **args):
+        filters = {}
+        for name, convert in StoreQueryHandlerImpl.FILTERS:
+            value = computeOptions.get_argument(name, None)
+            if value is None:
+                continue
+            try:
+                filters[name] = convert(value) if convert is not None else value
+            except ValueError:
+                raise ProcessingException("Invalid value for '%s'" % name, 400)
+        content_type = computeOptions.get_argument("format", None)
+        if content_type is not None:
+            filters["content_type"] = content_type.upper()
+
+        limit = computeOptions.get_int_arg("limit", 100)
+        offset = computeOptions.get_int_arg("offset", 0)
+        if limit < 1 or offset < 0:
+            raise ProcessingException("Invalid limit or offset", 400)
+
+        total, images = StoreHandler._store().query(filters,
+                                                    since=StoreQueryHandlerImpl.__timestamp(computeOptions, "since"),
+                                                    until=StoreQueryHandlerImpl.__timestamp(computeOptions, "until"),
+                                                    limit=limit,
+                                                    offset=offset,
+                                                    newest_first=computeOptions.get_argument("order", "desc") != "asc")
+        for image in images:
+            image["url"] = StoreHandler.url(image)
+        return SimpleResults({"total": total, "images": images})
+
+
+@service_handler
+class StoreImageHandlerImpl(StoreHandler):
+    name = "Stored Image"
+    path = "/store/image"
+    description = "Returns a stored image, supporting conditional and range requests"
+    params = {}
+    singleton = True
+
+    RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    @staticmethod
+    def etag_matches(header, etag):
+        if header is None:
+            return False
+        for tag in header.split(","):
+            tag = tag.strip()
+            if tag == "*" or (tag[2:] if tag.startswith("W/") else tag) == etag:
+                return True
+        return False
+
+    @staticmethod
+    def parse_range(header, size):
+        """
+        Returns the (first, last) byte of a single range request, None when
+        the whole file should be sent instead (no, or multiple, ranges) or
+        raises a 416 when the range is outside of the file.
+        """
+        match = StoreImageHandlerImpl.RANGE.match(header.replace(" ", "")) if header is not None else None
+        if match is None or match.group(1) == match.group(2) == "":
+            return None
+        if match.group(1) == "":
+            # Suffix range, the last n bytes
+            if int(match.group(2)) == 0:
+                raise StoreImageHandlerImpl.__unsatisfiable(size)
+            return max(size - int(match.group(2)), 0), size - 1
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) != "" else size - 1
+        if last < first and match.group(2) != "":
+            return None
+        if first >= size:
+            raise StoreImageHandlerImpl.__unsatisfiable(size)
+        return first, min(last, size - 1)
+
+    @staticmethod
+    def __unsatisfiable(size):
+        return ProcessingException("Requested range not satisfiable", 416, {"Content-Range": "bytes */%s" % size})
+
+    def handle(self, computeOptions, **args):
+        image_id = computeOptions.get_argument("id", None)
+        if image_id is None:
+            raise ProcessingException("Missing image id", 400)
+        store = StoreHandler._store()
+        record = store.get(image_id)
+        if record is None:
+            raise ProcessingException("Unknown image", 404)
+
+        etag = '"%s"' % record["id"]
+        if StoreImageHandlerImpl.etag_matches(computeOptions.get_header("If-None-Match"), etag):
+            return StoredImageResult(store.path(record), record, etag, 304)
+
+        byte_range = StoreImageHandlerImpl.parse_range(computeOptions.get_header("Range"), record["size"])
+        if_range = computeOptions.get_header("If-Range")
+        if byte_range is not None and if_range is not None and if_range != etag:
+            byte_range = None
+        if byte_range is not None:
+            return StoredImageResult(store.path(record), record, etag, 206, byte_range)
+        return StoredImageResult(store.path(record), record, etag)
+
+
+class StoredImageResult:
+    CHUNK_SIZE = 256 * 1024
+
+    CONTENT_TYPES = {
+        ContentTypes.PNG: "image/png",
+        ContentTypes.JPEG: "image/jpeg",
+        ContentTypes.WEBP: "image/webp"
+    }
+
+    def __init__(self, path, record, etag, status_code=200, byte_range=None):
+        self.path = path
+        self.record = record
+        self.etag = etag
+        self.status_code = status_code
+        self.byte_range = byte_range if byte_range is not None else (0, record["size"] - 1)
+
+    def isStream(self):
+        return True
+
+    def getContentType(self):
+        return self.record["content_type"]
+
+    def getHeaders(self):
+        headers = {
+            "ETag": self.etag,
+            # Content addressed, the image behind a url never changes
+            "Cache-Control": "public, max-age=31536000, immutable",
+            "Accept-Ranges": "bytes"
+        }
+        if self.status_code == 304:
+            return headers
+        first, last = self.byte_range
+        headers["Content-Type"] = StoredImageResult.CONTENT_TYPES.get(self.record["content_type"], "application/octet-stream")
+        headers["Content-Length"] = str(last - first + 1)
+        if self.status_code == 206:
+            headers["Content-Range"] = "bytes %s-%s/%s" % (first, last, self.record["size"])
+        return headers
+
+    @gen.coroutine
+    def stream(self, writable):
+        if self.status_code == 304:
+            return
+        first, last = self.byte_range
+        # Pages are faulted in from the page cache as the slices are written,
+        # the file is never read into memory as a whole
+        with open(self.path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                position = first
+                while position <= last and not writable.client_closed:
+                    end = min(position + StoredImageResult.CHUNK_SIZE, last + 1)
+                    writable.write(data[position:end])
+                    position = end
+                    yield writable.flush()
+            finally:
+                data.close()
+
+    def toJson(self):
+        raise ProcessingException("JSON not supported for stream")
+
+    def toImage(self):
+        raise ProcessingException("Images not supported for stream")
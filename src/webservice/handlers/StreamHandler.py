@@ -1,6 +1,5 @@
 
 import time
-import picamera
 import PIL.Image as Image
 from PIL import ImageFont
 from PIL import ImageDraw
@@ -8,34 +7,51 @@ import numpy as np
 import os
 import sys
 from io import BytesIO
-from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException, SimpleResults
+from tornado import gen
+from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException, SimpleResults, AsyncReader
 from time import sleep
 from fractions import Fraction
 from cam.Camera import Camera
+from cam.VideoBroadcaster import VideoBroadcaster
 from datetime import datetime
 
 @service_handler
-class StillImageHandlerImpl(BaseHandler):
+class StreamHandlerImpl(BaseHandler):
     name = "Video Stream"
     path = "/stream"
     description = "Streams video from the camera"
     params = {}
     singleton = True
 
+    # One encoder shared by every connected client
+    broadcaster = VideoBroadcaster()
+
     def __init__(self):
         BaseHandler.__init__(self)
 
     def handle(self, computeOptions, **args):
-        stream = BytesIO()
-        camera = Camera()
-        camera.record(stream)
-        return VideoStreamResult(stream)
+        hres = computeOptions.get_int_arg("hres", 640)
+        vres = computeOptions.get_int_arg("vres", 480)
+        framerate = computeOptions.get_int_arg("fps", 24)
+        quality = computeOptions.get_int_arg("quality", 23)
+        sensor_mode = computeOptions.get_int_arg("md", 0)
+        priority = computeOptions.get_int_arg("priority", 0)
+        timeout = computeOptions.get_float_arg("timeout", None)
+
+        reader = StreamHandlerImpl.broadcaster.subscribe(resolution=(hres, vres),
+                                                         framerate=framerate,
+                                                         quality=quality,
+                                                         sensor_mode=sensor_mode,
+                                                         priority=priority,
+                                                         timeout=timeout)
+        return VideoStreamResult(StreamHandlerImpl.broadcaster, reader)
 
 
 
 class VideoStreamResult:
-    def __init__(self, stream):
-        self.__stream = stream
+    def __init__(self, broadcaster, reader):
+        self.__broadcaster = broadcaster
+        self.__reader = reader
 
     def isStream(self):
         return True
@@ -43,22 +59,25 @@ class VideoStreamResult:
     def getContentType(self):
         return ContentTypes.H264
 
+    @gen.coroutine
     def stream(self, writable):
-        data_written = False
-        while self.__stream.readable() is True:
-            bytes = self.__stream.read(1024)
-            if len(bytes) > 0:
-                data_written = True
-                writable.write("%s\r\n%s\r\n"%(hex(len(bytes))[2:], bytes))
-                writable.flush()
-
-            elif data_written is True:
-                writable.write("0\r\n\r\n")
-                writable.flush()
-                break
+        reader = AsyncReader(self.__reader)
+        try:
+            while not writable.client_closed:
+                chunks = yield reader.read(timeout=1.0)
+                if chunks is None:
+                    break
+                if len(chunks) > 0:
+                    writable.write(b"".join(chunks))
+                    # Hold off until the client has taken the data, meanwhile the
+                    # buffer moves on and we skip ahead if we've fallen behind
+                    yield writable.flush()
+        finally:
+            reader.close()
+            self.__broadcaster.unsubscribe(self.__reader)
 
     def toJson(self):
         raise ProcessingException("JSON not supported for stream")
 
     def toImage(self):
-        raise ProcessingException("Images not supported for stream")
\ No newline at end of file
+        raise ProcessingException("Images not supported for stream")
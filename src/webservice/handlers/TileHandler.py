@@ -0,0 +1,140 @@
+import PIL.Image as Image
+import numpy as np
+from tornado import gen
+from webmodel import BaseHandler, service_handler, ContentTypes, ProcessingException, SimpleResults
+from cam.SingleFlight import SingleFlight
+from cam.FrameCache import FrameCache
+from imaging.Encoders import DEFAULT_ENCODER, parse_format
+from imaging.Pyramid import Pyramid
+from StoreHandler import StoreHandler, StoreImageHandlerImpl
+
+
+class TileHandler(BaseHandler):
+    TILE_SIZE = 256
+
+    # Pyramids are built on the first request for one of their tiles, by
+    # one request however many arrive at once, and kept while memory allows
+    builds = SingleFlight()
+    pyramids = FrameCache(max_bytes=128 * 1024 * 1024)
+    tiles = FrameCache(max_bytes=16 * 1024 * 1024)
+
+    def __init__(self):
+        BaseHandler.__init__(self)
+
+    @staticmethod
+    def _pyramid(image_id):
+        cached = TileHandler.pyramids.get(image_id, float("inf"))
+        if cached is not None:
+            return cached[0]
+
+        store = StoreHandler._store()
+        record = store.get(image_id)
+        if record is None:
+            raise ProcessingException("Unknown image", 404)
+        if record["content_type"] not in (ContentTypes.PNG, ContentTypes.JPEG, ContentTypes.WEBP):
+            raise ProcessingException("Tiles are only available for images", 400)
+
+        def build():
+            img = Image.open(store.path(record))
+            if img.mode not in ("L", "RGB"):
+                img = img.convert("RGB")
+            pyramid = Pyramid(np.asarray(img), TileHandler.TILE_SIZE)
+            TileHandler.pyramids.put(image_id, pyramid)
+            return pyramid
+
+        return TileHandler.builds.do(image_id, build)
+
+
+@service_handler
+class TileInfoHandlerImpl(TileHandler):
+    name = "Tile Pyramid"
+    path = r"/tiles/(?P<image_id>[0-9a-f]{64})"
+    description = "Describes the levels and tiles of a stored image's pyramid"
+    params = {}
+    singleton = True
+
+    def handle(self, computeOptions, image_id=None, **args):
+        info = TileHandler._pyramid(image_id).info()
+        info["url"] = "/tiles/%s/{z}/{x}/{y}" % image_id
+        return SimpleResults(info)
+
+
+@service_handler
+class TileImageHandlerImpl(TileHandler):
+    name = "Tile"
+    path = r"/tiles/(?P<image_id>[0-9a-f]{64})/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)(?:\.(?P<extension>\w+))?"
+    description = "Returns a tile of a stored image at one of its power of two zoom levels"
+    params = {}
+    singleton = True
+
+    def handle(self, computeOptions, image_id=None, z=None, x=None, y=None, extension=None, **args):
+        z, x, y = int(z), int(x), int(y)
+        content_type = extension if extension is not None else computeOptions.get_argument("output", None)
+        quality = computeOptions.get_int_arg("quality", None)
+
+        if content_type is None:
+            record = StoreHandler._store().get(image_id)
+            if record is None:
+                raise ProcessingException("Unknown image", 404)
+            content_type = record["content_type"]
+        content_type = parse_format(content_type)
+
+        # Tiles never change, there is nothing to do for a client that has this one
+        etag = '"%s-%s-%s-%s-%s-%s"' % (image_id, z, x, y, content_type.lower(), quality)
+        if StoreImageHandlerImpl.etag_matches(computeOptions.get_header("If-None-Match"), etag):
+            return TileResult(None, content_type, etag, 304)
+
+        key = (image_id, z, x, y, content_type, quality)
+        cached = TileHandler.tiles.get(key, float("inf"))
+        if cached is not None:
+            return TileResult(cached[0], content_type, etag)
+
+        tile = TileHandler._pyramid(image_id).tile(z, x, y)
+        if tile is None:
+            raise ProcessingException("No such tile", 404)
+        encoded = DEFAULT_ENCODER.encode(Image.fromarray(np.ascontiguousarray(tile)), content_type, quality=quality)
+        TileHandler.tiles.put(key, encoded)
+        return TileResult(encoded, content_type, etag)
+
+
+class TileResult:
+    CONTENT_TYPES = {
+        ContentTypes.PNG: "image/png",
+        ContentTypes.JPEG: "image/jpeg",
+        ContentTypes.WEBP: "image/webp"
+    }
+
+    def __init__(self, result, content_type, etag, status_code=200):
+        self.result = result
+        self.content_type = content_type
+        self.etag = etag
+        self.status_code = status_code
+
+    # Streamed only so that a 304 goes out without a body
+    def isStream(self):
+        return True
+
+    def getContentType(self):
+        return self.content_type
+
+    def getHeaders(self):
+        headers = {
+            "ETag": self.etag,
+            "Cache-Control": "public, max-age=31536000, immutable"
+        }
+        if self.status_code != 304:
+            headers["Content-Type"] = TileResult.CONTENT_TYPES[self.content_type]
+            headers["Content-Length"] = str(len(self.result))
+        return headers
+
+    @gen.coroutine
+    def stream(self, writable):
+        if self.result is not None:
+            writable.write(self.result)
+            yield writable.flush()
+
+    def toJson(self):
+        raise ProcessingException("JSON not supported for stream")
+
+    def toImage(self):
+        return self.result
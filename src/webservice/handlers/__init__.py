@@ -3,6 +3,20 @@ Copyright (c) 2017 Jet Propulsion Laboratory,
 California Institute of Technology.  All rights reserved
 """
 
+import CameraBackend
+import EncoderBackend
 import StillImageHandler
+import BurstHandler
+import RawHandler
+import CalibrationHandler
+import StatsHandler
+import AutoExposeHandler
 import StreamHandler
-import SayHiHandler
\ No newline at end of file
+import MjpegStreamHandler
+import StackHandler
+import SequenceHandler
+import StoreHandler
+import TileHandler
+import SayHiHandler
+import CameraStatusHandler
+import MetricsHandler
\ No newline at end of file
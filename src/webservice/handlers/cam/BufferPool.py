@@ -0,0 +1,135 @@
+import math
+import threading
+import numpy as np
+import PIL.Image as Image
+
+
+def padded_resolution(resolution):
+    """
+    The camera writes rows padded to a multiple of 32 pixels and the frame
+    padded to a multiple of 16 rows.
+    """
+    w = int(math.ceil(float(resolution[0]) / 32.0) * 32.0)
+    h = int(math.ceil(float(resolution[1]) / 16.0) * 16.0)
+    return w, h
+
+
+class FrameBuffer(object):
+    """
+    A reference counted capture buffer borrowed from a BufferPool. `array` is
+    the flat, padded buffer the camera writes into and `view` the zero-copy
+    (strided) view of the unpadded frame. Every holder calls release() once
+    it's done; the last release hands the buffer back to the pool.
+    """
+
+    def __init__(self, pool, key, array):
+        self.__pool = pool
+        self.__lock = threading.Lock()
+        self.__refs = 1
+        self.key = key
+        self.array = array
+        self.view = None
+        self.resolution = None
+
+    def _reset(self, resolution):
+        w, h, channels = self.key
+        self.__refs = 1
+        self.resolution = tuple(resolution)
+        self.view = self.array.reshape((h, w, channels))[:resolution[1], :resolution[0], :]
+        return self
+
+    @property
+    def nbytes(self):
+        return self.array.nbytes
+
+    def retain(self):
+        with self.__lock:
+            if self.__refs <= 0:
+                raise ValueError("Frame buffer has already been released")
+            self.__refs += 1
+        return self
+
+    def release(self):
+        with self.__lock:
+            self.__refs -= 1
+            refs = self.__refs
+        if refs == 0:
+            self.view = None
+            self.__pool._recycle(self)
+
+    def to_image(self):
+        """
+        Copies the frame into a new PIL image, unpacking it straight from the
+        padded buffer in a single copy (Image.fromarray() would first make a
+        contiguous copy of the strided view). The image owns its pixels, so it
+        outlives release().
+        """
+        w, h, channels = self.key
+        mode = "RGB" if channels == 3 else "L"
+        return Image.frombytes(mode, self.resolution, self.array, "raw", mode, w * channels, 1)
+
+
+class BufferPool(object):
+    """
+    Hands out preallocated, 64 byte aligned capture buffers keyed by padded
+    resolution, and keeps a bounded number of released ones around for reuse
+    so steady state captures don't allocate.
+    """
+
+    ALIGNMENT = 64
+
+    def __init__(self, max_free_bytes=128 * 1024 * 1024, max_free_per_key=2):
+        self.max_free_bytes = max_free_bytes
+        self.max_free_per_key = max_free_per_key
+        self.__lock = threading.Lock()
+        self.__free = {}
+        self.__free_bytes = 0
+        self.allocated = 0
+        self.reused = 0
+        self.outstanding = 0
+
+    @staticmethod
+    def __allocate(size):
+        raw = np.empty(size + BufferPool.ALIGNMENT, dtype=np.uint8)
+        offset = -raw.ctypes.data % BufferPool.ALIGNMENT
+        return raw[offset:offset + size]
+
+    def acquire(self, resolution, channels=3):
+        w, h = padded_resolution(resolution)
+        key = (w, h, channels)
+
+        with self.__lock:
+            self.outstanding += 1
+            free = self.__free.get(key)
+            if free:
+                buf = free.pop()
+                self.__free_bytes -= buf.nbytes
+                self.reused += 1
+                return buf._reset(resolution)
+            self.allocated += 1
+
+        return FrameBuffer(self, key, BufferPool.__allocate(w * h * channels))._reset(resolution)
+
+    def _recycle(self, buf):
+        with self.__lock:
+            self.outstanding -= 1
+            free = self.__free.setdefault(buf.key, [])
+            if len(free) >= self.max_free_per_key or self.__free_bytes + buf.nbytes > self.max_free_bytes:
+                return
+            free.append(buf)
+            self.__free_bytes += buf.nbytes
+
+    def clear(self):
+        with self.__lock:
+            self.__free = {}
+            self.__free_bytes = 0
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "allocated": self.allocated,
+                "reused": self.reused,
+                "outstanding": self.outstanding,
+                "free": sum(len(free) for free in self.__free.values()),
+                "free_bytes": self.__free_bytes
+            }
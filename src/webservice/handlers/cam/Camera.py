@@ -1,106 +1,295 @@
 import os
 import sys
-import picamera
 import PIL.Image as Image
 import numpy as np
 import os
 import sys
 from io import BytesIO
-from threading import Lock
 from time import sleep
 from fractions import Fraction
 import math
-from thread import start_new_thread
-
-class CameraNotAvailableException(Exception):
-    def __init__(self):
-        Exception.__init__(self)
-
+import threading
+import time
+import metrics
+from CameraSession import CameraSession
+from BufferPool import BufferPool
+from Scheduler import CameraScheduler, CameraNotAvailableException
+from webmodel import ProcessingException
 
 class CameraException(Exception):
     def __init__(self, msg):
         Exception.__init__(self, msg)
 
 
-def record_thread(camera, length):
-    camera.wait_recording(length)
+class CameraSettingsException(ProcessingException):
+    def __init__(self, msg):
+        ProcessingException.__init__(self, msg, 400)
+
 
 class Camera:
 
-    mutex = Lock()
+    # Rough fixed cost of a still capture on top of the exposure itself
+    CAPTURE_OVERHEAD = 0.5
+
+    # The raw data always covers the whole sensor, but only comes from the
+    # full sensor mode, so raw captures are taken at the sensor's resolution.
+    # Until the camera has been opened that's assumed to be the v2 module's.
+    RAW_RESOLUTION = (3280, 2464)
+    RAW_JPEG_QUALITY = 10
+
+    THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+
+    session = CameraSession()
+    scheduler = CameraScheduler(reconfigure_cost=lambda: Camera.session.reconfigure_seconds)
+    buffers = BufferPool()
 
     def __init__(self):
         pass
 
-    def record(self, stream, resolution=(640, 480), length=15, quality=23, wait=True):
-        if not self.mutex.acquire(wait):
-            raise CameraNotAvailableException()
+    @staticmethod
+    def estimate(shutter_speed=None, settle_time=None):
+        estimate = Camera.CAPTURE_OVERHEAD
+        if shutter_speed is not None:
+            estimate += shutter_speed / 1000000.0
+        if settle_time is not None:
+            estimate += settle_time
+        return estimate
+
+    @staticmethod
+    def frame_rate(shutter_speed=None):
+        if shutter_speed is not None:
+            return Fraction(1, int(math.ceil((shutter_speed / 1000000.0))))
+        return 24
 
+    @staticmethod
+    def temperature():
+        """
+        The board's temperature in degrees C, or None where it can't be read.
+        The sensor has no thermometer of its own, but sits close enough to
+        follow it.
+        """
         try:
-            with picamera.PiCamera(resolution=resolution) as camera:
-                camera.start_recording("/home/pi/foo.h264", format='h264', quality=quality)
-                print "Starting Video Recording..."
-                start_new_thread(record_thread, (camera, length))
-                camera.wait_recording(length)
-                camera.stop_recording()
-                stream.seek(0)
-                print "Stopped Video Recording"
-        except:
-            raise CameraException("Error capturing from camera")
-        finally:
-            self.mutex.release()
-
-
-    def capture(self, resolution=(3264, 2464), shutter_speed=None, iso=None, awb_mode=None, exposure_mode=None, settle_time=None, hflip=False, vflip=False, sensor_mode=0, wait=True):
-        if not self.mutex.acquire(wait):
-            raise CameraNotAvailableException()
+            with open(Camera.THERMAL_ZONE) as f:
+                return int(f.read().strip()) / 1000.0
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def failed(e):
+        """
+        The exception to raise for a camera error. Requests the session
+        refuses and settings picamera rejects (its value errors) leave the
+        device as it was, anything else may have left it broken so it is
+        reopened on next use.
+        """
+        if isinstance(e, ProcessingException):
+            return e
+        if isinstance(e, ValueError):
+            return CameraSettingsException("Invalid camera settings: %s" % e)
+        Camera.session.invalidate()
+        return CameraException("Error capturing from camera")
 
+    def capture(self, resolution=(3264, 2464), shutter_speed=None, iso=None, awb_mode=None, exposure_mode=None, settle_time=None, hflip=False, vflip=False, sensor_mode=0, wait=True, priority=0, timeout=None):
+        """
+        Returns a pooled FrameBuffer holding the capture, the caller must
+        release() it once done with it.
+        """
+        frame_rate = Camera.frame_rate(shutter_speed)
+        return Camera.scheduler.run(lambda: self.__capture(resolution, shutter_speed, iso, awb_mode, exposure_mode, settle_time, hflip, vflip, sensor_mode, frame_rate),
+                                    priority=priority,
+                                    timeout=timeout,
+                                    estimate=Camera.estimate(shutter_speed, settle_time),
+                                    wait=wait,
+                                    name="capture",
+                                    config=(sensor_mode, tuple(resolution), frame_rate))
+
+    def __capture(self, resolution, shutter_speed, iso, awb_mode, exposure_mode, settle_time, hflip, vflip, sensor_mode, frame_rate):
         try:
+            with metrics.span("configure"):
+                camera = Camera.session.configure(resolution=resolution,
+                                                  framerate=frame_rate,
+                                                  sensor_mode=sensor_mode,
+                                                  hflip=hflip,
+                                                  vflip=vflip,
+                                                  iso=iso,
+                                                  shutter_speed=shutter_speed,
+                                                  awb_mode=awb_mode,
+                                                  exposure_mode=exposure_mode)
 
-            if shutter_speed is not None:
-                frame_rate = Fraction(1, int(math.ceil((shutter_speed / 1000000.0))))
-            else:
-                frame_rate = 24
-
-            with picamera.PiCamera(resolution=resolution, framerate=frame_rate, sensor_mode=sensor_mode) as camera:
-                camera.hflip = vflip
-                camera.vflip = hflip
-                if iso is not None:
-                    print "Setting ISO to", iso
-                    camera.iso = iso
-                if shutter_speed is not None:
-                    print "Setting Shutter Speed to", shutter_speed
-                    camera.shutter_speed = shutter_speed
-                if awb_mode is not None:
-                    print "Setting AWB mode to", awb_mode
-                    camera.awb_mode = awb_mode
-
-                if settle_time is not None:
-                    print "Allowing gains to settle..."
+            if settle_time is not None and settle_time > 0:
+                with metrics.span("settle"):
                     sleep(settle_time)
 
-                if exposure_mode is not None:
-                    print "Setting exposure mode to", exposure_mode
-                    camera.exposure_mode = exposure_mode
+            output = Camera.buffers.acquire(resolution)
+        except Exception as e:
+            raise Camera.failed(e)
+
+        try:
+            with metrics.span("capture"):
+                if Camera.session.recording():
+                    # While an encoder is running stills have to come from the video
+                    # port, scaled from whatever resolution the camera is streaming at
+                    camera.capture(output.array, 'rgb', use_video_port=True, resize=resolution)
+                else:
+                    camera.capture(output.array, 'rgb')
+
+            return output
+
+        except Exception as e:
+            output.release()
+            raise Camera.failed(e)
+
+    def capture_raw(self, shutter_speed=None, iso=None, awb_mode=None, exposure_mode=None, settle_time=None, hflip=False, vflip=False, sensor_mode=0, wait=True, priority=0, timeout=None):
+        """
+        Captures through the still port with the sensor's raw Bayer data,
+        returning (data, revision): the JPEG with the raw data appended and
+        the camera revision that determines its layout.
+        """
+        frame_rate = Camera.frame_rate(shutter_speed)
+        return Camera.scheduler.run(lambda: self.__capture_raw(shutter_speed, iso, awb_mode, exposure_mode, settle_time, hflip, vflip, sensor_mode, frame_rate),
+                                    priority=priority,
+                                    timeout=timeout,
+                                    estimate=Camera.estimate(shutter_speed, settle_time),
+                                    wait=wait,
+                                    name="raw",
+                                    config=(sensor_mode, Camera.session.max_resolution(probe=False) or Camera.RAW_RESOLUTION, frame_rate))
+
+    def __capture_raw(self, shutter_speed, iso, awb_mode, exposure_mode, settle_time, hflip, vflip, sensor_mode, frame_rate):
+        try:
+            with metrics.span("configure"):
+                camera = Camera.session.configure(resolution=Camera.session.max_resolution(),
+                                                  exact_resolution=True,
+                                                  framerate=frame_rate,
+                                                  sensor_mode=sensor_mode,
+                                                  hflip=hflip,
+                                                  vflip=vflip,
+                                                  iso=iso,
+                                                  shutter_speed=shutter_speed,
+                                                  awb_mode=awb_mode,
+                                                  exposure_mode=exposure_mode)
+
+            if settle_time is not None and settle_time > 0:
+                with metrics.span("settle"):
+                    sleep(settle_time)
+
+            output = BytesIO()
+            with metrics.span("capture"):
+                # Only the raw data is of use, the JPEG is kept cheap
+                camera.capture(output, 'jpeg', bayer=True, quality=Camera.RAW_JPEG_QUALITY, thumbnail=None)
+            return output.getvalue(), camera.revision
+        except Exception as e:
+            raise Camera.failed(e)
+
+    def burst(self, count, framerate, on_frame, resolution=(1920, 1080), shutter_speed=None, iso=None, awb_mode=None, exposure_mode=None, hflip=False, vflip=False, sensor_mode=0, priority=0, timeout=None, cancel=None):
+        """
+        Captures count consecutive frames from the video port, framerate apart,
+        in a single camera job so the camera is configured only once. Each
+        frame is passed to on_frame(index, captured, buffer) as soon as it is
+        read; on_frame must release() the pooled FrameBuffer. Setting cancel
+        (a threading.Event) stops the burst before its next frame.
+        """
+        return Camera.scheduler.run(lambda: self.__burst(count, framerate, on_frame, resolution, shutter_speed, iso, awb_mode, exposure_mode, hflip, vflip, sensor_mode, cancel),
+                                    priority=priority,
+                                    timeout=timeout,
+                                    estimate=Camera.CAPTURE_OVERHEAD + count / float(framerate),
+                                    name="burst",
+                                    config=(sensor_mode, tuple(resolution), framerate))
+
+    def __burst(self, count, framerate, on_frame, resolution, shutter_speed, iso, awb_mode, exposure_mode, hflip, vflip, sensor_mode, cancel):
+        if cancel is None:
+            cancel = threading.Event()
+        if cancel.is_set():
+            return
+
+        try:
+            with metrics.span("configure"):
+                camera = Camera.session.configure(resolution=resolution,
+                                                  framerate=framerate,
+                                                  min_framerate=framerate,
+                                                  sensor_mode=sensor_mode,
+                                                  hflip=hflip,
+                                                  vflip=vflip,
+                                                  iso=iso,
+                                                  shutter_speed=shutter_speed,
+                                                  awb_mode=awb_mode,
+                                                  exposure_mode=exposure_mode)
+        except Exception as e:
+            raise Camera.failed(e)
 
-                h = resolution[1]
-                h = int(math.ceil(float(h) / 16.0) * 16.0)
+        # As for stills, a running encoder keeps the pipeline at its resolution
+        options = {"resize": resolution} if Camera.session.recording() else {}
+        start = time.time()
+        for index in range(count):
+            delay = start + index / float(framerate) - time.time()
+            if delay > 0:
+                cancel.wait(delay)
+            if cancel.is_set():
+                return
 
-                w = resolution[0]
-                w = int(math.ceil(float(w) / 32.0) * 32.0)
+            output = Camera.buffers.acquire(resolution)
+            try:
+                with metrics.span("capture"):
+                    camera.capture(output.array, 'rgb', use_video_port=True, **options)
+            except Exception as e:
+                output.release()
+                raise Camera.failed(e)
+            on_frame(index, time.time(), output)
 
-                output = np.empty((w * h * 3, ), dtype=np.uint8)
+    def autoexpose(self, search, probe_resolution=(320, 240), resolution=None, awb_mode=None, exposure_mode=None, hflip=False, vflip=False, sensor_mode=0, wait=True, priority=0, timeout=None):
+        """
+        Runs an exposure search in a single camera job: after search.start(),
+        probe frames taken at probe_resolution with the settings search.probe()
+        asks for are passed to search.update(frame) until it returns True. If a
+        resolution is given, the final capture with search.settings() follows
+        in the same job and is returned as a pooled FrameBuffer the caller must
+        release().
+        """
+        estimate = Camera.CAPTURE_OVERHEAD * (search.max_probes + 1) + search.max_shutter_speed / 1000000.0
+        return Camera.scheduler.run(lambda: self.__autoexpose(search, probe_resolution, resolution, awb_mode, exposure_mode, hflip, vflip, sensor_mode),
+                                    priority=priority,
+                                    timeout=timeout,
+                                    estimate=estimate,
+                                    wait=wait,
+                                    name="autoexpose",
+                                    config=(sensor_mode, tuple(probe_resolution), Camera.frame_rate(search.probe()[0])))
 
-                print "Starting Capture..."
-                camera.capture(output, 'rgb')
-                print "Stopping Capture"
+    def __autoexpose(self, search, probe_resolution, resolution, awb_mode, exposure_mode, hflip, vflip, sensor_mode):
+        search.start()
+        done = False
+        while not done:
+            shutter_speed, iso = search.probe()
+            try:
+                with metrics.span("configure"):
+                    camera = Camera.session.configure(resolution=probe_resolution,
+                                                      framerate=Camera.frame_rate(shutter_speed),
+                                                      sensor_mode=sensor_mode,
+                                                      hflip=hflip,
+                                                      vflip=vflip,
+                                                      iso=iso,
+                                                      shutter_speed=shutter_speed,
+                                                      awb_mode=awb_mode,
+                                                      exposure_mode=exposure_mode)
+                output = Camera.buffers.acquire(probe_resolution)
+            except Exception as e:
+                raise Camera.failed(e)
 
-                output = output.reshape((h, w, 3))
-                output = output[:resolution[1], :resolution[0], :]
+            try:
+                with metrics.span("probe"):
+                    if Camera.session.recording():
+                        camera.capture(output.array, 'rgb', use_video_port=True, resize=probe_resolution)
+                    else:
+                        camera.capture(output.array, 'rgb')
+            except Exception as e:
+                output.release()
+                raise Camera.failed(e)
 
-                return output
+            try:
+                done = search.update(output.view)
+            finally:
+                output.release()
+            metrics.AUTOEXPOSE_PROBES.inc()
 
-        except:
-            raise CameraException("Error capturing from camera")
-        finally:
-            self.mutex.release()
\ No newline at end of file
+        if resolution is None:
+            return None
+        shutter_speed, iso = search.settings()
+        return self.__capture(resolution, shutter_speed, iso, awb_mode, exposure_mode, None, hflip, vflip, sensor_mode, Camera.frame_rate(shutter_speed))
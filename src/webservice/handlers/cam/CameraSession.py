@@ -0,0 +1,240 @@
+import threading
+import importlib
+import time
+import metrics
+from webmodel import ProcessingException
+
+
+class CameraPipelineLockedException(ProcessingException):
+    def __init__(self, reason):
+        ProcessingException.__init__(self, reason, 409)
+
+
+class CameraSession(object):
+    """
+    Owns a long-lived camera device and applies only the settings that differ
+    from what is currently configured on it. Opening the sensor (and letting
+    its gains converge) is by far the most expensive part of a capture, so the
+    device is opened once and kept warm between requests.
+
+    The camera module is pluggable (anything exposing a picamera compatible
+    PiCamera class) so the session can be driven by a fake module.
+    """
+
+    # Changing any of these restarts the camera's MMAL pipeline
+    PIPELINE_SETTINGS = ("sensor_mode", "framerate", "resolution")
+
+    # Cheap control settings. A value of None resets it to the camera default
+    # so that one request's settings don't leak into the next one.
+    CONTROL_DEFAULTS = (
+        ("hflip", False),
+        ("vflip", False),
+        ("iso", 0),
+        ("shutter_speed", 0),
+        ("awb_mode", "auto"),
+        ("exposure_mode", "auto")
+    )
+
+    # What a pipeline restart is assumed to cost until one has been timed
+    RECONFIGURE_ESTIMATE = 0.5
+
+    # What the camera is opened at just to find out its full resolution
+    PROBE_RESOLUTION = (640, 480)
+
+    def __init__(self, camera_module=None):
+        self.__module = camera_module
+        self.__camera = None
+        self.__state = {}
+        self.__recordings = {}
+        self.__max_resolution = None
+        self.__lock = threading.RLock()
+        self.opens = 0
+        self.reconfigures = 0
+        self.updates = 0
+        self.reconfigure_seconds = CameraSession.RECONFIGURE_ESTIMATE
+
+    def camera_module(self):
+        if self.__module is None:
+            self.__module = importlib.import_module("picamera")
+        return self.__module
+
+    def set_camera_module(self, camera_module):
+        """
+        Switches to another camera module, closing the current device.
+        """
+        with self.__lock:
+            self.close()
+            self.__module = camera_module
+            self.__max_resolution = None
+
+    def is_open(self):
+        return self.__camera is not None and not getattr(self.__camera, "closed", False)
+
+    def __open(self, resolution, framerate, sensor_mode):
+        self.close()
+        print "Opening camera..."
+        with metrics.span("open"):
+            self.__camera = self.camera_module().PiCamera(resolution=resolution,
+                                                            framerate=framerate,
+                                                            sensor_mode=sensor_mode)
+        self.__state = {
+            "resolution": tuple(resolution),
+            "framerate": framerate,
+            "sensor_mode": sensor_mode
+        }
+        self.__state.update(CameraSession.CONTROL_DEFAULTS)
+        self.__max_resolution = tuple(self.__camera.MAX_RESOLUTION)
+        self.opens += 1
+
+    def __reconfigure(self, pipeline):
+        changed = [name for name in CameraSession.PIPELINE_SETTINGS if self.__state.get(name) != pipeline[name]]
+        if len(changed) == 0:
+            return
+
+        if self.recording():
+            # The pipeline is locked while an encoder runs, callers have to
+            # make do with the current one (e.g. by resizing on the video
+            # port), __check_locked() has refused what can't be done with it
+            return
+
+        print "Reconfiguring camera", ", ".join(changed)
+        start = time.time()
+        with metrics.span("reconfigure"):
+            for name in changed:
+                setattr(self.__camera, name, pipeline[name])
+                self.__state[name] = pipeline[name]
+        # A moving average, for the scheduler's estimates
+        self.reconfigure_seconds += 0.2 * (time.time() - start - self.reconfigure_seconds)
+        self.reconfigures += 1
+        metrics.RECONFIGURES.inc()
+
+    def __update_controls(self, controls):
+        for name, default in CameraSession.CONTROL_DEFAULTS:
+            value = controls.get(name)
+            if value is None:
+                value = default
+            if name in self.__state and self.__state[name] == value:
+                continue
+
+            print "Setting", name, "to", value
+            setattr(self.__camera, name, value)
+            self.__state[name] = value
+            self.updates += 1
+
+    def __check_locked(self, pipeline, controls, exact_resolution, min_framerate):
+        running = self.__state
+        streaming = "The camera is streaming at %dx%d, %g fps" % (running["resolution"][0], running["resolution"][1],
+                                                                  float(running["framerate"]))
+        if pipeline["sensor_mode"] != 0 and pipeline["sensor_mode"] != running["sensor_mode"]:
+            raise CameraPipelineLockedException("%s in sensor mode %d, sensor mode %d isn't available until it stops"
+                                                % (streaming, running["sensor_mode"], pipeline["sensor_mode"]))
+        if exact_resolution and pipeline["resolution"] != running["resolution"]:
+            raise CameraPipelineLockedException("%s, %dx%d isn't available until it stops"
+                                                % ((streaming, ) + pipeline["resolution"]))
+        if min_framerate is not None and float(min_framerate) > float(running["framerate"]):
+            raise CameraPipelineLockedException("%s, %g fps isn't available until it stops" % (streaming, float(min_framerate)))
+        # Exposures are limited to the frame period
+        shutter_speed = controls.get("shutter_speed")
+        if shutter_speed and shutter_speed > 1000000 / float(running["framerate"]):
+            raise CameraPipelineLockedException("%s, exposures longer than %dus aren't available until it stops"
+                                                % (streaming, 1000000 / float(running["framerate"])))
+
+    def configure(self, resolution=(3264, 2464), framerate=24, sensor_mode=0, exact_resolution=False, min_framerate=None, **controls):
+        """
+        Returns the open camera device with the requested settings applied,
+        opening it on first use (or after it has been invalidated).
+
+        While an encoder is recording the pipeline can't be changed and the
+        camera is returned at the running resolution and framerate. A
+        CameraPipelineLockedException (409) is raised instead if the request
+        needs what those can't deliver: another (non automatic) sensor mode,
+        a shutter speed longer than a frame, with exact_resolution the
+        resolution asked for, or a framerate of at least min_framerate.
+        """
+        with self.__lock:
+            pipeline = {
+                "resolution": tuple(resolution),
+                "framerate": framerate,
+                "sensor_mode": sensor_mode
+            }
+
+            if not self.is_open():
+                self.__open(**pipeline)
+            else:
+                if self.recording():
+                    self.__check_locked(pipeline, controls, exact_resolution, min_framerate)
+                self.__reconfigure(pipeline)
+
+            self.__update_controls(controls)
+            return self.__camera
+
+    def start_recording(self, output, splitter_port=1, **kwargs):
+        """
+        Starts an encoder on the given splitter port of the (already
+        configured) camera. While any encoder is running, pipeline settings
+        passed to configure() are not applied.
+        """
+        with self.__lock:
+            self.__camera.start_recording(output, splitter_port=splitter_port, **kwargs)
+            self.__recordings[splitter_port] = output
+
+    def stop_recording(self, splitter_port=1):
+        with self.__lock:
+            if splitter_port not in self.__recordings:
+                return
+            del self.__recordings[splitter_port]
+            if self.is_open():
+                self.__camera.stop_recording(splitter_port=splitter_port)
+
+    def recording(self):
+        with self.__lock:
+            return len(self.__recordings) > 0
+
+    def resolution(self):
+        with self.__lock:
+            return self.__state.get("resolution")
+
+    def max_resolution(self, probe=True):
+        """
+        The full resolution of the sensor, which depends on the camera module.
+        It's only known once the camera has been opened, so unless probe is
+        False the camera is opened to find out.
+        """
+        with self.__lock:
+            if self.__max_resolution is None and probe:
+                self.configure(resolution=CameraSession.PROBE_RESOLUTION)
+            return self.__max_resolution
+
+    def invalidate(self):
+        """
+        Drops the device after a failure so that the next configure() starts
+        from a freshly opened camera.
+        """
+        with self.__lock:
+            self.close()
+
+    def close(self):
+        with self.__lock:
+            for output in self.__recordings.values():
+                close_op = getattr(output, "close", None)
+                if callable(close_op):
+                    close_op()
+
+            if self.__camera is not None:
+                try:
+                    self.__camera.close()
+                except:
+                    pass
+            self.__camera = None
+            self.__state = {}
+            self.__recordings = {}
+
+    def stats(self):
+        return {
+            "open": self.is_open(),
+            "recording": sorted(self.__recordings.keys()),
+            "opens": self.opens,
+            "reconfigures": self.reconfigures,
+            "updates": self.updates,
+            "reconfigure_seconds": self.reconfigure_seconds
+        }
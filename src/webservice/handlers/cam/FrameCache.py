@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from BufferPool import FrameBuffer
+
+
+class FrameCache(object):
+    """
+    A memory bounded LRU cache of captured frames and encoded images. Entries
+    don't expire on their own; instead each lookup states how old an entry it
+    is willing to accept.
+
+    Pooled FrameBuffers are retained while cached and released on eviction;
+    get() returns them retained on behalf of the caller.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def sizeof(value):
+        if isinstance(value, FrameBuffer):
+            return value.nbytes
+        if isinstance(value, np.ndarray):
+            # A view keeps the whole (padded) capture buffer alive
+            base = value
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            return base.nbytes
+        if hasattr(value, "nbytes"):
+            return value.nbytes
+        return len(value)
+
+    def get(self, key, max_age):
+        """
+        Returns a (value, age) tuple for an entry no older than max_age
+        seconds, or None.
+        """
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or now - entry[0] > max_age:
+                self.misses += 1
+                return None
+
+            self.__entries[key] = self.__entries.pop(key)
+            self.hits += 1
+            if isinstance(entry[1], FrameBuffer):
+                entry[1].retain()
+            return entry[1], now - entry[0]
+
+    def put(self, key, value):
+        size = FrameCache.sizeof(value)
+        if size > self.max_bytes:
+            return
+
+        if isinstance(value, FrameBuffer):
+            value.retain()
+
+        evicted = []
+        with self.__lock:
+            if key in self.__entries:
+                replaced = self.__entries.pop(key)
+                self.__bytes -= replaced[2]
+                evicted.append(replaced)
+
+            self.__entries[key] = (time.time(), value, size)
+            self.__bytes += size
+
+            while self.__bytes > self.max_bytes:
+                _, entry = self.__entries.popitem(last=False)
+                self.__bytes -= entry[2]
+                evicted.append(entry)
+                self.evictions += 1
+
+        FrameCache.__release(evicted)
+
+    @staticmethod
+    def __release(entries):
+        for _, value, _ in entries:
+            if isinstance(value, FrameBuffer):
+                value.release()
+
+    def clear(self):
+        with self.__lock:
+            evicted = self.__entries.values()
+            self.__entries.clear()
+            self.__bytes = 0
+        FrameCache.__release(evicted)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,161 @@
+import threading
+from Camera import Camera
+from VideoBroadcaster import Broadcaster
+
+
+class FrameSlot(object):
+    """
+    Holds only the most recently published frame. Readers always get the
+    newest frame, so a slow reader skips frames instead of building a
+    backlog.
+    """
+
+    def __init__(self):
+        self.__cond = threading.Condition()
+        self.__seq = 0
+        self.__frame = None
+        self.__listeners = set()
+        self.closed = False
+        self.published = 0
+
+    def add_listener(self, listener):
+        with self.__cond:
+            self.__listeners.add(listener)
+
+    def remove_listener(self, listener):
+        with self.__cond:
+            self.__listeners.discard(listener)
+
+    def __notify(self):
+        self.__cond.notify_all()
+        for listener in self.__listeners:
+            listener()
+
+    def publish(self, frame):
+        with self.__cond:
+            self.__seq += 1
+            self.__frame = frame
+            self.published += 1
+            self.__notify()
+
+    def close(self):
+        with self.__cond:
+            self.closed = True
+            self.__notify()
+
+    def reset(self):
+        with self.__cond:
+            self.__frame = None
+            self.closed = False
+
+    def reader(self):
+        return FrameSlotReader(self)
+
+    def _wait(self, after, timeout):
+        with self.__cond:
+            if self.__seq <= after and not self.closed:
+                self.__cond.wait(timeout)
+
+            if self.closed:
+                return None, after
+            if self.__seq <= after or self.__frame is None:
+                return [], after
+            return [self.__frame], self.__seq
+
+
+class FrameSlotReader(object):
+    def __init__(self, slot):
+        self.__slot = slot
+        self.__seq = 0
+        self.__listener = None
+        self.skips = 0
+
+    def listen(self, listener):
+        """
+        Registers a callable that is invoked (from the encoder's thread)
+        whenever a new frame is published. Pass None to unregister.
+        """
+        if self.__listener is not None:
+            self.__slot.remove_listener(self.__listener)
+        self.__listener = listener
+        if listener is not None:
+            self.__slot.add_listener(listener)
+
+    def read(self, timeout=None):
+        """
+        Blocks for up to timeout seconds for a frame newer than the last one
+        read. Returns a list holding that frame (empty on timeout), or None
+        once the stream has ended.
+        """
+        frames, seq = self.__slot._wait(self.__seq, timeout)
+        if frames and self.__seq > 0:
+            self.skips += seq - self.__seq - 1
+        self.__seq = seq
+        return frames
+
+
+class MjpegOutput(object):
+    """
+    File-like sink for the camera's MJPEG encoder. Reassembles the encoder's
+    writes into whole JPEG frames and publishes each one to the FrameSlot.
+    """
+
+    def __init__(self, slot):
+        self.__slot = slot
+        self.__parts = []
+
+    def write(self, data):
+        if data.startswith(b"\xff\xd8"):
+            self.__parts = []
+        self.__parts.append(data)
+        if data.endswith(b"\xff\xd9"):
+            self.__slot.publish(b"".join(self.__parts))
+            self.__parts = []
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.__slot.close()
+
+
+class MjpegBroadcaster(Broadcaster):
+    """
+    Runs the camera's MJPEG encoder on the video port. Each frame is JPEG
+    encoded once (on the GPU) and shared by every viewer.
+    """
+
+    MAX_RESOLUTION = (1280, 720)
+    MAX_FRAMERATE = 30
+
+    def __init__(self, splitter_port=2, linger=5.0):
+        Broadcaster.__init__(self, splitter_port, linger)
+        self.__slot = FrameSlot()
+
+    def _start_encoder(self, resolution=(640, 480), framerate=15, quality=80, sensor_mode=0):
+        resolution = (min(resolution[0], MjpegBroadcaster.MAX_RESOLUTION[0]),
+                      min(resolution[1], MjpegBroadcaster.MAX_RESOLUTION[1]))
+        framerate = min(framerate, MjpegBroadcaster.MAX_FRAMERATE)
+
+        Camera.session.configure(resolution=resolution, framerate=framerate, sensor_mode=sensor_mode)
+        Camera.session.start_recording(MjpegOutput(self.__slot),
+                                       splitter_port=self.splitter_port,
+                                       format="mjpeg",
+                                       resize=resolution,
+                                       quality=quality)
+
+    def _reader(self):
+        return self.__slot.reader()
+
+    def _reset(self):
+        self.__slot.reset()
+
+    def _ended(self):
+        return self.__slot.closed
+
+    def _end(self):
+        self.__slot.close()
+
+    def _stats(self):
+        return {"frames": self.__slot.published}
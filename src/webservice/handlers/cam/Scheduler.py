@@ -0,0 +1,235 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+import metrics
+from webmodel import ProcessingException
+
+
+class CameraBusyException(ProcessingException):
+    def __init__(self, reason, retry_after):
+        ProcessingException.__init__(self, reason, 503, headers={
+            "Retry-After": str(int(math.ceil(max(retry_after, 1.0))))
+        })
+        self.retry_after = retry_after
+
+
+class CameraNotAvailableException(CameraBusyException):
+    def __init__(self, retry_after=1.0):
+        CameraBusyException.__init__(self, "Camera is busy", retry_after)
+
+
+class CameraQueueFullException(CameraBusyException):
+    def __init__(self, retry_after):
+        CameraBusyException.__init__(self, "Camera queue is full", retry_after)
+
+
+class CameraDeadlineException(CameraBusyException):
+    def __init__(self, retry_after):
+        CameraBusyException.__init__(self, "Camera job deadline expired while queued", retry_after)
+
+
+class CameraJob(object):
+    def __init__(self, seq, name, priority, deadline, estimate, config=None):
+        self.seq = seq
+        self.name = name
+        self.priority = priority
+        self.deadline = deadline
+        self.estimate = estimate
+        self.config = config
+        self.submitted = time.time()
+        self.started = None
+        self.skips = 0
+
+    def key(self):
+        # Higher priority first, then first come first served
+        return (-self.priority, self.seq)
+
+
+class CameraScheduler(object):
+    """
+    Serializes access to the camera. Jobs wait in a bounded queue and are run
+    one at a time in priority order, FIFO within a priority. A job can carry a
+    deadline after which it gives up waiting, and a rough estimate of how long
+    it will hold the camera, which is used to produce Retry-After hints.
+
+    Jobs run on the submitting thread; the scheduler only decides whose turn
+    it is.
+
+    Jobs can also carry the sensor configuration they need (anything
+    comparable, e.g. sensor mode, resolution and frame rate), changing which
+    restarts the camera pipeline. Within the first window jobs of the same
+    priority, one needing the configuration of the job that ran last is let
+    ahead of jobs needing another one, so mixed requests run in batches.
+    Jobs are only passed over when they would still make their deadline, and
+    at most max_skips times each.
+    """
+
+    def __init__(self, max_queue=16, window=8, max_skips=4, reconfigure_cost=lambda: 0.5):
+        self.max_queue = max_queue
+        self.window = window
+        self.max_skips = max_skips
+        self.reconfigure_cost = reconfigure_cost
+        self.__cond = threading.Condition()
+        self.__queue = []
+        self.__seq = itertools.count()
+        self.__running = None
+        self.__next = None
+        self.__config = None
+        self.completed = 0
+        self.expired = 0
+        self.rejected = 0
+        self.reordered = 0
+        self.reconfigures_saved = 0
+        self.seconds_saved = 0.0
+
+    def __estimated_wait(self, now):
+        wait = sum(job.estimate for _, _, job in self.__queue)
+        if self.__running is not None:
+            wait += max(0.0, self.__running.started + self.__running.estimate - now)
+        return wait
+
+    def __can_skip(self, job, ahead, now):
+        if job.skips >= self.max_skips:
+            return False
+        return job.deadline is None or now + ahead.estimate < job.deadline
+
+    def __choose(self, now):
+        """
+        Returns the job to run next, along with the jobs it goes ahead of.
+        """
+        ordered = [entry[2] for entry in heapq.nsmallest(self.window, self.__queue)]
+        head = ordered[0]
+        if self.__config is None or head.config is None or head.config == self.__config:
+            return head, []
+
+        for index, job in enumerate(ordered[1:], 1):
+            if job.priority != head.priority:
+                break
+            if job.config != self.__config:
+                continue
+            skipped = ordered[:index]
+            if all(self.__can_skip(other, job, now) for other in skipped):
+                return job, skipped
+            break
+        return head, []
+
+    def __update(self):
+        # Whose turn it is is only decided while the camera is free, so every
+        # waiter agrees on it
+        self.__next = None
+        if self.__running is None and len(self.__queue) > 0:
+            self.__next = self.__choose(time.time())
+        self.__cond.notify_all()
+
+    def __remove(self, job):
+        self.__queue = [entry for entry in self.__queue if entry[2] is not job]
+        heapq.heapify(self.__queue)
+        self.__update()
+
+    def __start(self, job, skipped):
+        self.__running = job
+        self.__remove(job)
+        job.started = time.time()
+        self.__config = job.config
+
+        if len(skipped) > 0:
+            for other in skipped:
+                other.skips += 1
+            saved = self.reconfigure_cost()
+            self.reordered += 1
+            self.reconfigures_saved += 1
+            self.seconds_saved += saved
+            metrics.REORDERED_JOBS.inc(job=job.name)
+            metrics.RECONFIGURE_SECONDS_SAVED.inc(saved)
+
+    def __wait_turn(self, job):
+        while self.__next is None or self.__next[0] is not job:
+            if job.deadline is None:
+                self.__cond.wait()
+                continue
+
+            remaining = job.deadline - time.time()
+            if remaining <= 0:
+                self.__remove(job)
+                self.expired += 1
+                raise CameraDeadlineException(self.__estimated_wait(time.time()))
+            self.__cond.wait(remaining)
+
+        self.__start(*self.__next)
+
+    def run(self, fn, priority=0, timeout=None, estimate=0.0, wait=True, name="capture", config=None):
+        """
+        Waits for the camera to become available to this job and runs fn(),
+        returning its result. Raises a CameraBusyException (503) when the
+        queue is full, when wait is False and the camera is in use, or when
+        the job's timeout expires before it gets to run. Jobs that don't pass
+        a config forget the current one, as they may change the pipeline.
+        """
+        now = time.time()
+        with self.__cond:
+            if not wait and (self.__running is not None or len(self.__queue) > 0):
+                self.rejected += 1
+                raise CameraNotAvailableException(self.__estimated_wait(now))
+
+            if len(self.__queue) >= self.max_queue:
+                self.rejected += 1
+                raise CameraQueueFullException(self.__estimated_wait(now))
+
+            deadline = now + timeout if timeout is not None else None
+            job = CameraJob(next(self.__seq), name, priority, deadline, estimate, config)
+            heapq.heappush(self.__queue, job.key() + (job, ))
+            self.__update()
+            metrics.JOBS_IN_FLIGHT.inc(job=name)
+
+            try:
+                self.__wait_turn(job)
+            except CameraBusyException:
+                metrics.JOBS_IN_FLIGHT.dec(job=name)
+                raise
+
+        metrics.record("queue", job.started - job.submitted, metrics.QUEUE_WAIT_SECONDS, job=name)
+        try:
+            return fn()
+        finally:
+            metrics.JOB_SECONDS.observe(time.time() - job.started, job=name)
+            metrics.JOBS_IN_FLIGHT.dec(job=name)
+            with self.__cond:
+                self.__running = None
+                self.completed += 1
+                self.__update()
+
+    def depth(self):
+        with self.__cond:
+            return len(self.__queue)
+
+    def stats(self):
+        now = time.time()
+        with self.__cond:
+            by_priority = {}
+            for _, _, job in self.__queue:
+                by_priority[job.priority] = by_priority.get(job.priority, 0) + 1
+
+            running = None
+            if self.__running is not None:
+                running = {
+                    "name": self.__running.name,
+                    "priority": self.__running.priority,
+                    "elapsed": now - self.__running.started,
+                    "estimate": self.__running.estimate
+                }
+
+            return {
+                "depth": len(self.__queue),
+                "max_depth": self.max_queue,
+                "by_priority": by_priority,
+                "running": running,
+                "estimated_wait": self.__estimated_wait(now),
+                "completed": self.completed,
+                "expired": self.expired,
+                "rejected": self.rejected,
+                "reordered": self.reordered,
+                "reconfigures_saved": self.reconfigures_saved,
+                "seconds_saved": self.seconds_saved
+            }
@@ -0,0 +1,322 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+
+class Sequence(object):
+    """
+    A submitted sequence of timed captures: frames slots, interval seconds
+    apart, each capturing every exposure in brackets.
+    """
+
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    CANCELLED = "cancelled"
+    FAILED = "failed"
+
+    FINISHED = (COMPLETED, CANCELLED, FAILED)
+
+    def __init__(self, spec, id=None):
+        self.id = id if id is not None else uuid.uuid4().hex
+        self.spec = spec
+        self.state = Sequence.PENDING
+        self.created = time.time()
+        self.start = self.created + spec.get("delay", 0)
+        self.finished = None
+        self.next_slot = 0
+        self.captured = 0
+        self.skipped = 0
+        self.failed = 0
+        self.error = None
+        self.files = []
+
+    def due(self, slot):
+        return self.start + slot * self.spec["interval"]
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "state": self.state,
+            "frames": self.spec["frames"],
+            "interval": self.spec["interval"],
+            "brackets": len(self.spec["brackets"]),
+            "created": self.created,
+            "start": self.start,
+            "finished": self.finished,
+            "next_slot": self.next_slot,
+            "next_due": self.due(self.next_slot) if self.state not in Sequence.FINISHED else None,
+            "captured": self.captured,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "error": self.error
+        }
+
+    def to_dict(self):
+        d = self.summary()
+        d["spec"] = self.spec
+        d["files"] = list(self.files)
+        return d
+
+    @staticmethod
+    def from_dict(d):
+        sequence = Sequence(d["spec"], d["id"])
+        for name in ("state", "created", "start", "finished", "next_slot", "captured", "skipped", "failed", "error", "files"):
+            setattr(sequence, name, d[name])
+        return sequence
+
+
+class SequenceEvents(object):
+    """
+    Follows the sequencer's events, optionally for a single sequence (the
+    reader then ends once that sequence has finished). Has the read/listen
+    interface of the camera stream readers.
+    """
+
+    def __init__(self, sequencer, sequence_id=None):
+        self.__sequencer = sequencer
+        self.__sequence_id = sequence_id
+        self.__cursor = sequencer.last_event()
+        self.__listener = None
+        self.__ended = False
+
+    def read(self, timeout=None):
+        if self.__ended:
+            return None
+        events = self.__sequencer._read(self.__cursor, timeout)
+        if len(events) > 0:
+            self.__cursor = events[-1][0]
+
+        selected = []
+        for _, event in events:
+            if self.__sequence_id is None or event["id"] == self.__sequence_id:
+                selected.append(event)
+                if self.__sequence_id is not None and event["state"] in Sequence.FINISHED:
+                    self.__ended = True
+        return selected
+
+    def listen(self, listener):
+        if self.__listener is not None:
+            self.__sequencer.remove_listener(self.__listener)
+        self.__listener = listener
+        if listener is not None:
+            self.__sequencer.add_listener(listener)
+
+
+class Sequencer(object):
+    """
+    Runs sequences on their own threads, each capture going through the
+    camera scheduler like any other request. Every sequence is saved to
+    directory as JSON whenever it changes, along with the files it
+    captured, and unfinished sequences are picked up again by resume().
+
+    capture(sequence, slot, exposure) does the actual work and returns the
+    encoded data along with its file extension.
+    """
+
+    MAX_ACTIVE = 8
+    MAX_EVENTS = 256
+
+    # Consecutive failed exposures after which a sequence gives up
+    MAX_CONSECUTIVE_FAILURES = 5
+
+    def __init__(self, directory, capture):
+        self.directory = directory
+        self.capture = capture
+        self.log = logging.getLogger(__name__)
+        self.__lock = threading.Lock()
+        self.__events_changed = threading.Condition(threading.Lock())
+        self.__sequences = {}
+        self.__cancels = {}
+        self.__events = deque(maxlen=Sequencer.MAX_EVENTS)
+        self.__event_seq = 0
+        self.__listeners = set()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def __path(self, sequence_id, name=None):
+        if name is None:
+            return os.path.join(self.directory, "%s.json" % sequence_id)
+        return os.path.join(self.directory, sequence_id, name)
+
+    def __save(self, sequence):
+        # Written to the side first so a crash never leaves a truncated file
+        path = self.__path(sequence.id)
+        with self.__lock:
+            state = json.dumps(sequence.to_dict(), indent=4)
+        with open(path + ".tmp", "w") as f:
+            f.write(state)
+        os.rename(path + ".tmp", path)
+
+    def __changed(self, sequence):
+        self.__save(sequence)
+        with self.__lock:
+            event = sequence.summary()
+        with self.__events_changed:
+            self.__event_seq += 1
+            self.__events.append((self.__event_seq, event))
+            self.__events_changed.notify_all()
+            listeners = list(self.__listeners)
+        for listener in listeners:
+            listener()
+
+    def resume(self):
+        """
+        Loads the saved sequences, restarting any that hadn't finished. Slots
+        that came due while the server was down are skipped.
+        """
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    sequence = Sequence.from_dict(json.load(f))
+            except (IOError, ValueError, KeyError):
+                self.log.warn("Skipping unreadable sequence '%s'" % name, exc_info=True)
+                continue
+
+            with self.__lock:
+                self.__sequences[sequence.id] = sequence
+            if sequence.state not in Sequence.FINISHED:
+                self.log.info("Resuming sequence '%s' at slot %s" % (sequence.id, sequence.next_slot))
+                self.__start(sequence)
+
+    def submit(self, spec):
+        sequence = Sequence(spec)
+        with self.__lock:
+            active = len([s for s in self.__sequences.values() if s.state not in Sequence.FINISHED])
+            if active >= Sequencer.MAX_ACTIVE:
+                return None
+            self.__sequences[sequence.id] = sequence
+
+        os.makedirs(os.path.join(self.directory, sequence.id))
+        self.__changed(sequence)
+        self.__start(sequence)
+        return sequence
+
+    def __start(self, sequence):
+        cancel = threading.Event()
+        with self.__lock:
+            self.__cancels[sequence.id] = cancel
+        runner = threading.Thread(target=self.__run, args=(sequence, cancel), name="sequence-%s" % sequence.id[:8])
+        runner.daemon = True
+        runner.start()
+
+    def cancel(self, sequence_id):
+        with self.__lock:
+            cancel = self.__cancels.get(sequence_id)
+            sequence = self.__sequences.get(sequence_id)
+        if cancel is not None:
+            cancel.set()
+        return sequence
+
+    def __run(self, sequence, cancel):
+        spec = sequence.spec
+        interval = spec["interval"]
+        failures = 0
+        try:
+            while sequence.next_slot < spec["frames"] and not cancel.is_set():
+                slot = sequence.next_slot
+                due = sequence.due(slot)
+                if interval > 0 and time.time() > due + interval:
+                    with self.__lock:
+                        sequence.skipped += 1
+                        sequence.next_slot += 1
+                    continue
+
+                if cancel.wait(max(due - time.time(), 0)):
+                    break
+                if sequence.state == Sequence.PENDING:
+                    with self.__lock:
+                        sequence.state = Sequence.RUNNING
+                    self.__changed(sequence)
+
+                for bracket, exposure in enumerate(spec["brackets"]):
+                    if cancel.is_set():
+                        break
+                    try:
+                        data, extension = self.capture(sequence, slot, exposure)
+                        name = "%05d_%02d.%s" % (slot, bracket, extension)
+                        with open(self.__path(sequence.id, name), "wb") as f:
+                            f.write(data)
+                        with self.__lock:
+                            sequence.files.append(name)
+                            sequence.captured += 1
+                        failures = 0
+                    except Exception as ex:
+                        self.log.warn("Sequence '%s' failed to capture slot %s" % (sequence.id, slot), exc_info=True)
+                        with self.__lock:
+                            sequence.failed += 1
+                            sequence.error = str(ex)
+                        failures += 1
+
+                if failures >= Sequencer.MAX_CONSECUTIVE_FAILURES:
+                    with self.__lock:
+                        sequence.state = Sequence.FAILED
+                    break
+
+                with self.__lock:
+                    sequence.next_slot += 1
+                self.__changed(sequence)
+        except Exception as ex:
+            self.log.error("Sequence '%s' stopped" % sequence.id, exc_info=True)
+            with self.__lock:
+                sequence.state = Sequence.FAILED
+                sequence.error = str(ex)
+
+        with self.__lock:
+            if sequence.state not in Sequence.FINISHED:
+                sequence.state = Sequence.CANCELLED if cancel.is_set() else Sequence.COMPLETED
+            sequence.finished = time.time()
+            self.__cancels.pop(sequence.id, None)
+        self.__changed(sequence)
+
+    def get(self, sequence_id, details=True):
+        with self.__lock:
+            sequence = self.__sequences.get(sequence_id)
+            if sequence is None:
+                return None
+            return sequence.to_dict() if details else sequence.summary()
+
+    def file_path(self, sequence_id, name):
+        with self.__lock:
+            sequence = self.__sequences.get(sequence_id)
+            if sequence is None or name not in sequence.files:
+                return None
+        return self.__path(sequence_id, name)
+
+    def list(self):
+        with self.__lock:
+            return sorted([s.summary() for s in self.__sequences.values()], key=lambda s: s["created"])
+
+    def events(self, sequence_id=None):
+        return SequenceEvents(self, sequence_id)
+
+    def last_event(self):
+        with self.__events_changed:
+            return self.__event_seq
+
+    def _read(self, cursor, timeout=None):
+        with self.__events_changed:
+            if self.__event_seq == cursor and timeout is not None and timeout > 0:
+                self.__events_changed.wait(timeout)
+            return [event for event in self.__events if event[0] > cursor]
+
+    def add_listener(self, listener):
+        with self.__events_changed:
+            self.__listeners.add(listener)
+
+    def remove_listener(self, listener):
+        with self.__events_changed:
+            self.__listeners.discard(listener)
+
+    def stats(self):
+        with self.__lock:
+            states = {}
+            for sequence in self.__sequences.values():
+                states[sequence.state] = states.get(sequence.state, 0) + 1
+        return {"sequences": states, "events": self.last_event()}
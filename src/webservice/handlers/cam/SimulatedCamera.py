@@ -0,0 +1,296 @@
+"""
+A picamera compatible camera module with a simulated sensor, so the server
+can be run, tested and benchmarked without a Raspberry Pi.
+
+Frames are deterministic (the same settings always produce the same image)
+and brightness follows iso and shutter speed, while the time taken mimics
+the real camera: opening the sensor, reconfiguring its pipeline, exposing
+for the shutter speed and reading out the sensor.
+"""
+
+import collections
+import threading
+import time
+import numpy as np
+import PIL.Image as Image
+from io import BytesIO
+from BufferPool import padded_resolution
+
+Sensor = collections.namedtuple("Sensor", "resolution pattern stride rows")
+
+# By revision, with the raw data appended to JPEGs captured with bayer=True
+# laid out as that camera module's
+SENSORS = {
+    "ov5647": Sensor((2592, 1944), "GBRG", 3264, 1952),
+    "imx219": Sensor((3280, 2464), "BGGR", 4128, 2480)
+}
+RAW_HEADER_BYTES = 32768
+
+# The sensor cameras opened from now on simulate
+REVISION = "imx219"
+
+# Timings, roughly those of a v2 camera module
+OPEN_SECONDS = 0.5
+RECONFIGURE_SECONDS = 0.15
+AUTO_EXPOSURE_SECONDS = 1.0 / 60
+READOUT_SECONDS = 1.0 / 15
+
+PiVideoFrame = collections.namedtuple("PiVideoFrame", "index frame_type complete")
+
+
+class PiVideoFrameType(object):
+    frame = 0
+    key_frame = 1
+    sps_header = 2
+
+
+class PiCameraError(Exception):
+    pass
+
+
+class PiCameraValueError(PiCameraError, ValueError):
+    pass
+
+
+AWB_MODES = ("off", "auto", "sunlight", "cloudy", "shade", "tungsten", "fluorescent", "incandescent", "flash", "horizon")
+EXPOSURE_MODES = ("off", "auto", "night", "nightpreview", "backlight", "spotlight", "sports", "snow", "beach",
+                  "verylong", "fixedfps", "antishake", "fireworks")
+
+
+class Scene(object):
+    """
+    A fixed test scene (gradients, a row of bars and a scattering of point
+    sources over fixed noise), rendered once per resolution.
+    """
+
+    MAX_SCENES = 4
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__scenes = collections.OrderedDict()
+
+    def render(self, resolution):
+        with self.__lock:
+            scene = self.__scenes.pop(resolution, None)
+            if scene is None:
+                scene = Scene.__render(resolution)
+                if len(self.__scenes) >= Scene.MAX_SCENES:
+                    self.__scenes.popitem(last=False)
+            self.__scenes[resolution] = scene
+            return scene
+
+    @staticmethod
+    def __render(resolution):
+        w, h = resolution
+        rng = np.random.RandomState(w * 10007 + h)
+        y = np.linspace(0.0, 1.0, h, dtype=np.float32)[:, np.newaxis]
+        x = np.linspace(0.0, 1.0, w, dtype=np.float32)[np.newaxis, :]
+        scene = np.empty((h, w, 3), dtype=np.float32)
+        scene[:, :, 0] = 40 + 80 * x
+        scene[:, :, 1] = 40 + 80 * y
+        scene[:, :, 2] = 60 + 40 * (1 - x) * y
+        bars = ((np.arange(w) * 16 // max(w, 1)) % 2 == 0)[np.newaxis, :] & (y[:, 0] > 0.75)[:, np.newaxis]
+        scene[bars] += 60
+        for _ in range(64):
+            sy, sx = rng.randint(0, h), rng.randint(0, w)
+            scene[max(sy - 1, 0):sy + 2, max(sx - 1, 0):sx + 2] += 120
+        scene += rng.normal(0, 2.0, scene.shape).astype(np.float32)
+        return np.clip(scene, 0, 255).astype(np.uint8)
+
+    @staticmethod
+    def lut(gain):
+        return np.clip(np.rint(np.arange(256) * gain), 0, 255).astype(np.uint8)
+
+
+SCENES = Scene()
+
+
+class PiCamera(object):
+    def __init__(self, resolution=None, framerate=30, sensor_mode=0, **kwargs):
+        time.sleep(OPEN_SECONDS)
+        self.__dict__["closed"] = False
+        self.__dict__["revision"] = REVISION
+        self.__dict__["MAX_RESOLUTION"] = SENSORS[REVISION].resolution
+        if resolution is None:
+            resolution = self.MAX_RESOLUTION
+        self.resolution = tuple(resolution)
+        self.framerate = framerate
+        self.sensor_mode = sensor_mode
+        self.hflip = False
+        self.vflip = False
+        self.iso = 0
+        self.shutter_speed = 0
+        self.awb_mode = "auto"
+        self.exposure_mode = "auto"
+        self.frame = None
+        self.__recordings = {}
+        self.__lock = threading.Lock()
+
+    def __setattr__(self, name, value):
+        self.__validate(name, value)
+        # Changing the sensor pipeline restarts it, as on the real camera
+        if name in ("resolution", "framerate", "sensor_mode") and name in self.__dict__:
+            if self.__recordings:
+                raise PiCameraError("Can't change %s while recording" % name)
+            time.sleep(RECONFIGURE_SECONDS)
+        self.__dict__[name] = value
+
+    def __validate(self, name, value):
+        if name == "resolution":
+            w, h = value
+            if w <= 0 or h <= 0 or w > self.MAX_RESOLUTION[0] or h > self.MAX_RESOLUTION[1]:
+                raise PiCameraValueError("Invalid resolution %dx%d" % (w, h))
+        elif name == "sensor_mode" and not 0 <= value <= 7:
+            raise PiCameraValueError("Invalid sensor mode: %s" % value)
+        elif name == "iso" and not 0 <= value <= 1600:
+            raise PiCameraValueError("Invalid iso value: %s" % value)
+        elif name == "awb_mode" and value not in AWB_MODES:
+            raise PiCameraValueError("Invalid auto-white-balance mode: %s" % value)
+        elif name == "exposure_mode" and value not in EXPOSURE_MODES:
+            raise PiCameraValueError("Invalid exposure mode: %s" % value)
+
+    def __check(self):
+        if self.closed:
+            raise PiCameraError("Camera is closed")
+
+    def exposure_seconds(self):
+        if self.shutter_speed:
+            return self.shutter_speed / 1000000.0
+        return AUTO_EXPOSURE_SECONDS
+
+    def __gain(self):
+        # Auto exposure keeps the scene at its nominal brightness
+        if not self.shutter_speed and not self.iso:
+            return 1.0
+        return (self.iso or 100) / 100.0 * self.exposure_seconds() / AUTO_EXPOSURE_SECONDS
+
+    def __render(self, resolution, out):
+        scene = SCENES.render(tuple(resolution))
+        if self.vflip:
+            scene = scene[::-1]
+        if self.hflip:
+            scene = scene[:, ::-1]
+        np.take(Scene.lut(self.__gain()), scene, out=out, mode="clip")
+
+    def capture(self, output, format="rgb", use_video_port=False, resize=None, bayer=False, **kwargs):
+        self.__check()
+        resolution = tuple(resize) if resize is not None else self.resolution
+        if use_video_port:
+            # The next frame of the running video pipeline
+            time.sleep(1.0 / float(self.framerate))
+        else:
+            pixels = float(resolution[0] * resolution[1]) / (self.MAX_RESOLUTION[0] * self.MAX_RESOLUTION[1])
+            time.sleep(self.exposure_seconds() + READOUT_SECONDS * min(pixels, 1.0))
+
+        if format == "rgb":
+            w, h = padded_resolution(resolution)
+            frame = np.frombuffer(output, dtype=np.uint8).reshape((h, w, 3))[:resolution[1], :resolution[0]]
+            self.__render(resolution, frame)
+            return
+
+        frame = np.empty((resolution[1], resolution[0], 3), dtype=np.uint8)
+        self.__render(resolution, frame)
+        jpeg = BytesIO()
+        Image.fromarray(frame).save(jpeg, "JPEG", quality=kwargs.get("quality", 85))
+        output.write(jpeg.getvalue())
+        if bayer and not use_video_port:
+            output.write(self.__raw())
+
+    def __raw(self):
+        sensor = SENSORS[self.revision]
+        w, h = sensor.resolution
+        scene = np.empty((h, w, 3), dtype=np.uint8)
+        self.__render(sensor.resolution, scene)
+
+        # Flipping changes the order the sensor is read out in, and with it
+        # the pattern
+        rows = [sensor.pattern[:2], sensor.pattern[2:]]
+        if self.hflip:
+            rows = [row[::-1] for row in rows]
+        if self.vflip:
+            rows = rows[::-1]
+        mosaic = np.empty((h, w), dtype=np.uint16)
+        for i, channel in enumerate("".join(rows)):
+            y, x = divmod(i, 2)
+            mosaic[y::2, x::2] = scene[y::2, x::2, "RGB".index(channel)]
+        mosaic = (mosaic << 2) | (mosaic >> 6)
+
+        raw = np.zeros(RAW_HEADER_BYTES + sensor.stride * sensor.rows, dtype=np.uint8)
+        raw[:4] = np.frombuffer(b"BRCM", dtype=np.uint8)
+        packed = raw[RAW_HEADER_BYTES:].reshape((sensor.rows, sensor.stride))[:h, :w * 5 // 4]
+        groups = mosaic.reshape((h, w // 4, 4))
+        packed[:, 0::5] = groups[:, :, 0] >> 2
+        packed[:, 1::5] = groups[:, :, 1] >> 2
+        packed[:, 2::5] = groups[:, :, 2] >> 2
+        packed[:, 3::5] = groups[:, :, 3] >> 2
+        packed[:, 4::5] = ((groups & 3) << np.array([0, 2, 4, 6], dtype=np.uint16)).sum(axis=2)
+        return raw.tostring()
+
+    def start_recording(self, output, format="h264", splitter_port=1, resize=None, **kwargs):
+        self.__check()
+        with self.__lock:
+            if splitter_port in self.__recordings:
+                raise PiCameraError("The camera is already recording on port %s" % splitter_port)
+            stop = threading.Event()
+            self.__recordings[splitter_port] = stop
+
+        resolution = tuple(resize) if resize is not None else self.resolution
+        if format == "mjpeg":
+            frames = self.__mjpeg(resolution, kwargs.get("quality", 80))
+        else:
+            frames = self.__h264(resolution, kwargs.get("intra_period", 60))
+
+        def run():
+            interval = 1.0 / float(self.framerate)
+            next_frame = time.time()
+            for frame in frames:
+                next_frame += interval
+                if stop.wait(max(next_frame - time.time(), 0)):
+                    break
+                output.write(frame)
+            flush_op = getattr(output, "flush", None)
+            if callable(flush_op):
+                flush_op()
+
+        recorder = threading.Thread(target=run, name="simulated-encoder-%s" % splitter_port)
+        recorder.daemon = True
+        recorder.start()
+
+    def __mjpeg(self, resolution, quality):
+        w, h = resolution
+        frame = np.empty((h, w, 3), dtype=np.uint8)
+        self.__render(resolution, frame)
+        output = BytesIO()
+        Image.fromarray(frame).save(output, "JPEG", quality=quality)
+        jpeg = output.getvalue()
+        while True:
+            yield jpeg
+
+    def __h264(self, resolution, intra_period):
+        # Stand-in NAL units sized for a typical bitrate, the keyframe (with
+        # its inline headers) ten times the size of the frames that follow
+        frame_bytes = max(resolution[0] * resolution[1] // 100, 64)
+        index = 0
+        while True:
+            if index % intra_period == 0:
+                frame_type, size = PiVideoFrameType.sps_header, frame_bytes * 10
+            else:
+                frame_type, size = PiVideoFrameType.frame, frame_bytes
+            self.frame = PiVideoFrame(index, frame_type, True)
+            yield b"\x00\x00\x00\x01" + (b"%08d" % index) * (size // 8)
+            index += 1
+
+    def stop_recording(self, splitter_port=1):
+        with self.__lock:
+            stop = self.__recordings.pop(splitter_port, None)
+        if stop is None:
+            raise PiCameraError("The camera is not recording on port %s" % splitter_port)
+        stop.set()
+
+    def close(self):
+        with self.__lock:
+            recordings = self.__recordings.values()
+            self.__recordings.clear()
+        for stop in recordings:
+            stop.set()
+        self.__dict__["closed"] = True
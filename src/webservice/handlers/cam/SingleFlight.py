@@ -0,0 +1,70 @@
+import threading
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.callers = 1
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share a key: the first caller runs the
+    function and every caller that arrives while it is still in flight waits
+    for, and receives, that same result (or exception).
+
+    If given, share(result) is called once for every caller that joined an
+    in-flight call (e.g. to take a reference on a pooled buffer) before the
+    result is handed out.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__flights = {}
+        self.executed = 0
+        self.shared = 0
+
+    def do(self, key, fn, share=None):
+        with self.__lock:
+            flight = self.__flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self.__flights[key] = flight
+                self.executed += 1
+            else:
+                flight.callers += 1
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self.__lock:
+                del self.__flights[key]
+                if flight.error is None and share is not None:
+                    for _ in range(flight.callers - 1):
+                        share(flight.result)
+            flight.done.set()
+
+    def in_flight(self):
+        with self.__lock:
+            return len(self.__flights)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight(),
+            "executed": self.executed,
+            "shared": self.shared
+        }
@@ -0,0 +1,140 @@
+import itertools
+import threading
+from collections import deque
+
+
+class StreamBuffer(object):
+    """
+    An in-memory circular buffer of encoded video. A single writer (the
+    encoder) appends chunks, marking the ones that start a keyframe, and
+    never blocks; once the buffer exceeds max_bytes the oldest chunks are
+    discarded. Any number of StreamReaders follow the buffer independently.
+    """
+
+    def __init__(self, max_bytes=4 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.__cond = threading.Condition()
+        self.__chunks = deque()
+        self.__keyframes = deque()
+        self.__next_seq = 0
+        self.__bytes = 0
+        self.__listeners = set()
+        self.closed = False
+
+    def add_listener(self, listener):
+        with self.__cond:
+            self.__listeners.add(listener)
+
+    def remove_listener(self, listener):
+        with self.__cond:
+            self.__listeners.discard(listener)
+
+    def __notify(self):
+        self.__cond.notify_all()
+        for listener in self.__listeners:
+            listener()
+
+    def write(self, data, keyframe=False):
+        with self.__cond:
+            seq = self.__next_seq
+            self.__next_seq += 1
+            self.__chunks.append((seq, data))
+            self.__bytes += len(data)
+            if keyframe:
+                self.__keyframes.append(seq)
+
+            # Always keep the most recent keyframe so new readers can start
+            while self.__bytes > self.max_bytes and len(self.__chunks) > 1 \
+                    and (len(self.__keyframes) == 0 or self.__chunks[0][0] < self.__keyframes[-1]):
+                _, dropped = self.__chunks.popleft()
+                self.__bytes -= len(dropped)
+
+            while len(self.__keyframes) > 0 and self.__keyframes[0] < self.__chunks[0][0]:
+                self.__keyframes.popleft()
+
+            self.__notify()
+
+    def close(self):
+        with self.__cond:
+            self.closed = True
+            self.__notify()
+
+    def reset(self):
+        with self.__cond:
+            self.__chunks.clear()
+            self.__keyframes.clear()
+            self.__bytes = 0
+            self.closed = False
+
+    def reader(self):
+        return StreamReader(self)
+
+    def _read(self, cursor, timeout):
+        """
+        Returns (chunks, cursor, skipped) where chunks is everything available
+        from cursor onwards. A reader without a cursor, or one that has fallen
+        behind the start of the buffer, is moved to the latest keyframe.
+        """
+        with self.__cond:
+            while True:
+                if self.closed:
+                    return None, cursor, False
+
+                skipped = False
+                if cursor is None or (len(self.__chunks) > 0 and cursor < self.__chunks[0][0]):
+                    if len(self.__keyframes) > 0:
+                        skipped = cursor is not None
+                        cursor = self.__keyframes[-1]
+
+                if cursor is not None and cursor < self.__next_seq:
+                    # Walked from the newest end, a reader keeping up only
+                    # touches the chunks it hasn't seen
+                    count = self.__next_seq - max(cursor, self.__chunks[0][0])
+                    chunks = [data for seq, data in itertools.islice(reversed(self.__chunks), count)]
+                    chunks.reverse()
+                    return chunks, self.__next_seq, skipped
+
+                if timeout is not None and timeout <= 0:
+                    return [], cursor, skipped
+
+                self.__cond.wait(timeout)
+                timeout = 0 if timeout is not None else None
+
+    def stats(self):
+        with self.__cond:
+            return {
+                "chunks": len(self.__chunks),
+                "bytes": self.__bytes,
+                "max_bytes": self.max_bytes,
+                "keyframes": len(self.__keyframes),
+                "written": self.__next_seq
+            }
+
+
+class StreamReader(object):
+    def __init__(self, buffer):
+        self.__buffer = buffer
+        self.__cursor = None
+        self.__listener = None
+        self.skips = 0
+
+    def listen(self, listener):
+        """
+        Registers a callable that is invoked (from the writer's thread)
+        whenever new data may be available. Pass None to unregister.
+        """
+        if self.__listener is not None:
+            self.__buffer.remove_listener(self.__listener)
+        self.__listener = listener
+        if listener is not None:
+            self.__buffer.add_listener(listener)
+
+    def read(self, timeout=None):
+        """
+        Blocks for up to timeout seconds for new data and returns a list of
+        chunks (empty on timeout), or None once the stream has ended.
+        """
+        chunks, self.__cursor, skipped = self.__buffer._read(self.__cursor, timeout)
+        if skipped:
+            self.skips += 1
+        return chunks
@@ -0,0 +1,163 @@
+import threading
+from Camera import Camera
+from StreamBuffer import StreamBuffer
+
+
+class Broadcaster(object):
+    """
+    Runs a single encoder on one of the camera's splitter ports and shares
+    its output between any number of clients. The encoder is started by the
+    first subscriber and stopped a short while after the last one leaves;
+    clients joining a running encoder get it as is, whatever settings they
+    asked for.
+
+    Subclasses provide _start_encoder(), _reader(), _reset(), _ended() and
+    _end().
+    """
+
+    def __init__(self, splitter_port, linger=5.0):
+        self.splitter_port = splitter_port
+        self.linger = linger
+        # __lifecycle serializes starting and stopping the encoder (which can
+        # wait on the camera queue), __lock only guards the state so that
+        # unsubscribe() never blocks
+        self.__lifecycle = threading.Lock()
+        self.__lock = threading.Lock()
+        self.__running = False
+        self.__readers = set()
+        self.__stop_timer = None
+        self.settings = None
+
+    def subscribe(self, priority=0, timeout=None, **settings):
+        with self.__lifecycle:
+            with self.__lock:
+                if self.__stop_timer is not None:
+                    self.__stop_timer.cancel()
+                    self.__stop_timer = None
+                running = self.__running and not self._ended()
+
+            if not running:
+                self.__start(settings, priority, timeout)
+
+            with self.__lock:
+                reader = self._reader()
+                self.__readers.add(reader)
+                return reader
+
+    def unsubscribe(self, reader):
+        with self.__lock:
+            self.__readers.discard(reader)
+            if len(self.__readers) == 0 and self.__running and self.__stop_timer is None:
+                self.__stop_timer = threading.Timer(self.linger, self.__stop)
+                self.__stop_timer.daemon = True
+                self.__stop_timer.start()
+
+    def __start(self, settings, priority, timeout):
+        self._reset()
+        Camera.scheduler.run(lambda: self._start_encoder(**settings),
+                             priority=priority,
+                             timeout=timeout,
+                             estimate=Camera.CAPTURE_OVERHEAD,
+                             name="stream")
+        with self.__lock:
+            self.__running = True
+            self.settings = settings
+
+    def __stop(self):
+        with self.__lifecycle:
+            with self.__lock:
+                self.__stop_timer = None
+                if len(self.__readers) > 0 or not self.__running:
+                    return
+
+            try:
+                Camera.scheduler.run(lambda: Camera.session.stop_recording(self.splitter_port),
+                                     estimate=Camera.CAPTURE_OVERHEAD,
+                                     name="stream stop")
+            finally:
+                with self.__lock:
+                    self.__running = False
+                    self.settings = None
+                    self._end()
+
+    def _stats(self):
+        return {}
+
+    def stats(self):
+        with self.__lock:
+            stats = {
+                "running": self.__running,
+                "clients": len(self.__readers),
+                "skips": sum(reader.skips for reader in self.__readers),
+                "settings": self.settings
+            }
+            stats.update(self._stats())
+            return stats
+
+
+class BroadcastOutput(object):
+    """
+    File-like sink handed to the camera encoder. Every write goes straight
+    into the shared StreamBuffer, flagging the writes that start a new
+    keyframe (the inline SPS header in front of each I-frame).
+    """
+
+    def __init__(self, buffer, frame_op, keyframe_type):
+        self.__buffer = buffer
+        self.__frame_op = frame_op
+        self.__keyframe_type = keyframe_type
+        self.__last_keyframe = None
+
+    def write(self, data):
+        keyframe = False
+        frame = self.__frame_op()
+        if frame is not None and frame.frame_type == self.__keyframe_type and frame.index != self.__last_keyframe:
+            self.__last_keyframe = frame.index
+            keyframe = True
+        self.__buffer.write(data, keyframe)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.__buffer.close()
+
+
+class VideoBroadcaster(Broadcaster):
+    """
+    A single H.264 encoder fanned out through a StreamBuffer. New readers
+    start at the latest keyframe and readers that fall behind skip ahead.
+    """
+
+    def __init__(self, splitter_port=1, buffer_bytes=4 * 1024 * 1024, linger=5.0):
+        Broadcaster.__init__(self, splitter_port, linger)
+        self.__buffer = StreamBuffer(buffer_bytes)
+
+    def _start_encoder(self, resolution=(640, 480), framerate=24, quality=23, sensor_mode=0):
+        resolution = tuple(resolution)
+        camera = Camera.session.configure(resolution=resolution, framerate=framerate, sensor_mode=sensor_mode)
+        keyframe_type = Camera.session.camera_module().PiVideoFrameType.sps_header
+        output = BroadcastOutput(self.__buffer, lambda: camera.frame, keyframe_type)
+        Camera.session.start_recording(output,
+                                       splitter_port=self.splitter_port,
+                                       format="h264",
+                                       resize=resolution,
+                                       quality=quality,
+                                       inline_headers=True,
+                                       intra_period=int(framerate) * 2)
+
+    def _reader(self):
+        return self.__buffer.reader()
+
+    def _reset(self):
+        self.__buffer.reset()
+
+    def _ended(self):
+        return self.__buffer.closed
+
+    def _end(self):
+        self.__buffer.close()
+
+    def _stats(self):
+        return {"buffer": self.__buffer.stats()}
@@ -0,0 +1,118 @@
+import os
+import string
+import threading
+from collections import OrderedDict
+import PIL.Image as Image
+from PIL import ImageFont
+from PIL import ImageDraw
+
+
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FACE = "LiberationSans-Regular.ttf"
+
+_fonts = {}
+_fonts_lock = threading.Lock()
+
+
+def get_font(size, face=DEFAULT_FACE):
+    """
+    Returns the (cached) font for face and size. Relative faces are looked up
+    next to this module rather than in the working directory.
+    """
+    key = (face, size)
+    with _fonts_lock:
+        font = _fonts.get(key)
+        if font is None:
+            font = ImageFont.truetype(os.path.join(FONT_DIR, face), size)
+            _fonts[key] = font
+        return font
+
+
+class TextLayerCache(object):
+    """
+    Renders annotation text into small alpha masks. A format string such as
+    "ISO: {iso}, Time: {time}" is split into its literal and field segments
+    and each segment's mask is cached by its text, so only segments whose
+    value actually changed (typically {time}) get rendered again.
+    """
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self.__lock = threading.Lock()
+        self.__layers = OrderedDict()
+        self.__formatter = string.Formatter()
+        self.hits = 0
+        self.misses = 0
+
+    def __segment(self, text, font, face, size):
+        key = (face, size, text)
+        with self.__lock:
+            layer = self.__layers.get(key)
+            if layer is not None:
+                self.__layers[key] = self.__layers.pop(key)
+                self.hits += 1
+                return layer
+            self.misses += 1
+
+        ascent, descent = font.getmetrics()
+        layer = Image.new("L", (max(font.getsize(text)[0], 1), ascent + descent), 0)
+        ImageDraw.Draw(layer).text((0, 0), text, 255, font=font)
+
+        with self.__lock:
+            self.__layers[key] = layer
+            while len(self.__layers) > self.max_entries:
+                self.__layers.popitem(last=False)
+        return layer
+
+    def __lines(self, text, values):
+        """
+        Formats text with values, returning a list of lines each made up of
+        segment strings.
+        """
+        lines = [[]]
+        for literal, field_name, format_spec, conversion in self.__formatter.parse(text):
+            segments = [literal]
+            if field_name is not None:
+                value = self.__formatter.get_field(field_name, (), values)[0]
+                value = self.__formatter.convert_field(value, conversion)
+                segments.append(self.__formatter.format_field(value, format_spec or ""))
+
+            for segment in segments:
+                parts = segment.split("\n")
+                lines[-1].append(parts[0])
+                for part in parts[1:]:
+                    lines.append([part])
+        return [[segment for segment in line if len(segment) > 0] for line in lines]
+
+    def render(self, text, values, size=16, face=DEFAULT_FACE):
+        """
+        Returns the "L" mode mask of the formatted annotation.
+        """
+        font = get_font(size, face)
+        rows = [[self.__segment(segment, font, face, size) for segment in line] for line in self.__lines(text, values)]
+
+        ascent, descent = font.getmetrics()
+        line_height = ascent + descent
+        width = max([sum(layer.size[0] for layer in row) for row in rows] + [1])
+        mask = Image.new("L", (width, line_height * len(rows)), 0)
+
+        y = 0
+        for row in rows:
+            x = 0
+            for layer in row:
+                mask.paste(layer, (x, y))
+                x += layer.size[0]
+            y += line_height
+        return mask
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "layers": len(self.__layers),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+DEFAULT_LAYERS = TextLayerCache()
+
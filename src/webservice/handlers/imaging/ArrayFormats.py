@@ -0,0 +1,68 @@
+"""
+.npy and FITS files written straight from an array's buffer, a slice of rows
+at a time, rather than built in memory first.
+"""
+
+from io import BytesIO
+import numpy as np
+
+FITS_BLOCK = 2880
+
+
+def npy_header(array):
+    # The data is always written out in C order, see npy_chunks
+    header = np.lib.format.header_data_from_array_1_0(array)
+    header["fortran_order"] = False
+    output = BytesIO()
+    np.lib.format.write_array_header_1_0(output, header)
+    return output.getvalue()
+
+
+def fits_card(key, value, comment=None):
+    if isinstance(value, bool):
+        value = "%20s" % ("T" if value else "F")
+    elif isinstance(value, (int, long)):
+        value = "%20d" % value
+    elif isinstance(value, float):
+        value = "%20s" % repr(value).upper()
+    else:
+        value = "'%-8s'" % str(value).replace("'", "''")
+    card = "%-8s= %s" % (key, value)
+    if comment is not None:
+        card += " / %s" % comment
+    return "%-80s" % card[:80]
+
+
+def fits_header(array, cards=()):
+    """
+    The primary header for array (rows, columns[, channels]) of 16 bit
+    integers, stored as one plane per channel. cards are extra (key, value,
+    comment) entries.
+    """
+    axes = [array.shape[1], array.shape[0]] + list(array.shape[2:])
+    header = [fits_card("SIMPLE", True), fits_card("BITPIX", 16), fits_card("NAXIS", len(axes))]
+    header.extend(fits_card("NAXIS%d" % (i + 1), n) for i, n in enumerate(axes))
+    header.extend(fits_card(*card) for card in cards)
+    header.append("%-80s" % "END")
+    header = "".join(header)
+    return header + " " * (-len(header) % FITS_BLOCK)
+
+
+def fits_padding(array):
+    return b"\0" * (-(array.size * 2) % FITS_BLOCK)
+
+
+def npy_chunks(array, chunk_bytes=256 * 1024):
+    # Views straight into the (C contiguous) array's buffer
+    data = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    for start in range(0, data.size, chunk_bytes):
+        yield memoryview(data[start:start + chunk_bytes])
+
+
+def fits_chunks(array, chunk_bytes=256 * 1024):
+    # FITS is big endian and stores colour planes one after another
+    planes = [array] if array.ndim == 2 else [array[:, :, c] for c in range(array.shape[2])]
+    rows = max(1, chunk_bytes // max(array.shape[1] * 2, 1))
+    for plane in planes:
+        for start in range(0, plane.shape[0], rows):
+            yield np.ascontiguousarray(plane[start:start + rows], dtype=">i2").tostring()
@@ -0,0 +1,122 @@
+"""
+Raw Bayer data as the camera appends it to a JPEG captured with bayer=True:
+a 32KB header starting with BRCM, followed by the sensor's rows packed at 10
+bits per pixel (four pixels in five bytes: the high 8 bits of each, then a
+byte with their low 2 bits), each row and the frame padded like the camera's
+other buffers.
+"""
+
+import collections
+import numpy as np
+
+RawFormat = collections.namedtuple("RawFormat", "size header width height stride rows pattern")
+
+# By camera revision, the pattern is that of the sensor's first two rows
+RAW_FORMATS = {
+    "ov5647": RawFormat(6404096, 32768, 2592, 1944, 3264, 1952, "GBRG"),
+    "imx219": RawFormat(10270208, 32768, 3280, 2464, 4128, 2480, "BGGR")
+}
+
+DEMOSAIC_METHODS = ("bilinear", "superpixel")
+
+BIT_DEPTH = 10
+
+# Where each pixel of a group of four finds its low bits in the fifth byte
+_LOW_BIT_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+
+def extract(data, raw_format):
+    """
+    Returns a (rows, packed bytes) view of the pixel data in the tail of
+    data, without copying it.
+    """
+    if len(data) < raw_format.size:
+        raise ValueError("Capture is too short to hold the raw data")
+    raw = np.frombuffer(data, dtype=np.uint8, count=raw_format.size, offset=len(data) - raw_format.size)
+    if raw[:4].tostring() != b"BRCM":
+        raise ValueError("Raw data header not found")
+    rows = raw[raw_format.header:].reshape((raw_format.rows, raw_format.stride))
+    return rows[:raw_format.height, :raw_format.width * 5 // 4]
+
+
+def unpack10(packed, width):
+    """
+    Unpacks rows of 10 bit packed pixels into a (rows, width) uint16 array.
+    """
+    groups = packed.reshape((packed.shape[0], width // 4, 5))
+    pixels = np.empty((packed.shape[0], width // 4, 4), dtype=np.uint16)
+    np.left_shift(groups[:, :, :4], 2, out=pixels, dtype=np.uint16)
+    pixels |= (groups[:, :, 4:5] >> _LOW_BIT_SHIFTS) & 3
+    return pixels.reshape((packed.shape[0], width))
+
+
+def flip_pattern(pattern, hflip=False, vflip=False):
+    rows = [pattern[:2], pattern[2:]]
+    if hflip:
+        rows = [row[::-1] for row in rows]
+    if vflip:
+        rows = rows[::-1]
+    return "".join(rows)
+
+
+def _offsets(pattern, channel):
+    return [divmod(i, 2) for i, c in enumerate(pattern) if c == channel]
+
+
+def superpixel(raw, pattern):
+    """
+    Folds every 2x2 cell into one RGB pixel (averaging its two greens), at
+    half the resolution and without any interpolation.
+    """
+    (ry, rx), = _offsets(pattern, "R")
+    (by, bx), = _offsets(pattern, "B")
+    (g1y, g1x), (g2y, g2x) = _offsets(pattern, "G")
+    h, w = raw.shape[0] // 2 * 2, raw.shape[1] // 2 * 2
+
+    rgb = np.empty((h // 2, w // 2, 3), dtype=np.uint16)
+    rgb[:, :, 0] = raw[ry:h:2, rx:w:2]
+    green = raw[g1y:h:2, g1x:w:2].astype(np.uint32)
+    green += raw[g2y:h:2, g2x:w:2]
+    rgb[:, :, 1] = (green + 1) >> 1
+    rgb[:, :, 2] = raw[by:h:2, bx:w:2]
+    return rgb
+
+
+def bilinear(raw, pattern):
+    """
+    Fills in each pixel's two missing colours from the average of its
+    neighbours of that colour, at full resolution.
+    """
+    h, w = raw.shape[0] // 2 * 2, raw.shape[1] // 2 * 2
+    # Reflecting at the edges keeps the mosaic's layout, so every pixel has
+    # the same neighbours all the way to the border
+    padded = np.pad(raw[:h, :w], 1, mode="reflect").astype(np.uint32)
+    rgb = np.empty((h, w, 3), dtype=np.uint16)
+
+    def mean(y, x, offsets):
+        # The neighbours at offsets of the pixels at (y::2, x::2)
+        total = sum(padded[1 + y + dy:1 + y + dy + h:2, 1 + x + dx:1 + x + dx + w:2] for dy, dx in offsets)
+        # Two or four of them, so dividing is a shift
+        return (total + len(offsets) // 2) >> (len(offsets) // 2)
+
+    for i, channel in enumerate(pattern):
+        y, x = divmod(i, 2)
+        cell = rgb[y::2, x::2]
+        cell[:, :, "RGB".index(channel)] = raw[y:h:2, x:w:2]
+        if channel == "G":
+            # Red and blue are in the same row and column, one either side
+            row, column = pattern[2 * y + (1 - x)], pattern[2 * (1 - y) + x]
+            cell[:, :, "RGB".index(row)] = mean(y, x, ((0, -1), (0, 1)))
+            cell[:, :, "RGB".index(column)] = mean(y, x, ((-1, 0), (1, 0)))
+        else:
+            cell[:, :, 1] = mean(y, x, ((-1, 0), (1, 0), (0, -1), (0, 1)))
+            cell[:, :, "RGB".index("B" if channel == "R" else "R")] = mean(y, x, ((-1, -1), (-1, 1), (1, -1), (1, 1)))
+    return rgb
+
+
+def demosaic(raw, pattern, method="bilinear"):
+    if method == "superpixel":
+        return superpixel(raw, pattern)
+    if method == "bilinear":
+        return bilinear(raw, pattern)
+    raise ValueError("Unknown demosaic method '%s'" % method)
@@ -0,0 +1,128 @@
+"""
+Dark, bias and flat field correction of 8 bit captures, with hot pixels
+replaced by the median of their neighbours.
+
+Masters are float32 arrays shaped like the frames they correct. They are
+folded into a Calibration once, so that correcting a frame is a multiply and
+a subtract per pixel, done in place a block of rows at a time.
+"""
+
+import numpy as np
+
+KINDS = ("bias", "dark", "flat")
+
+# Flat field values below this are taken as dead rather than boosted
+MIN_FLAT = 0.05
+
+# A dark pixel this far above its channel's median is always hot, however
+# noisy the rest of the frame is
+MIN_HOT_LEVEL = 10.0
+
+# More than this fraction of hot pixels means light got in, only the
+# hottest are kept
+MAX_HOT_FRACTION = 0.005
+
+# Same channel neighbours a hot pixel is replaced from
+NEIGHBOURS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy != 0 or dx != 0]
+
+
+def hot_pixels(dark, sigma=5.0):
+    """
+    Flat indices into dark of the pixels more than sigma (robust) standard
+    deviations above their channel's median.
+    """
+    channels = dark.reshape((-1, dark.shape[-1] if dark.ndim == 3 else 1))
+    median = np.median(channels, axis=0)
+    spread = 1.4826 * np.median(np.abs(channels - median), axis=0)
+    excess = channels - (median + np.maximum(sigma * spread, MIN_HOT_LEVEL))
+    hot = np.flatnonzero(excess > 0)
+    limit = int(excess.size * MAX_HOT_FRACTION)
+    if len(hot) > limit:
+        hot = hot[np.argpartition(excess.reshape(-1)[hot], len(hot) - limit)[len(hot) - limit:]]
+        hot.sort()
+    return hot.astype(np.int32)
+
+
+def normalize_flat(flat, offset=None):
+    """
+    Scales a master flat (less its offset) to a mean of one per channel.
+    """
+    flat = flat.astype(np.float32)
+    if offset is not None:
+        flat -= offset
+    mean = flat.reshape((-1, flat.shape[-1] if flat.ndim == 3 else 1)).mean(axis=0)
+    flat /= np.maximum(mean, 1e-6).reshape((1, 1, -1) if flat.ndim == 3 else ())
+    return flat
+
+
+class Calibration(object):
+    """
+    The offset (bias or dark), flat and hot pixels for one set of capture
+    settings, prepared for apply().
+    """
+
+    def __init__(self, shape, offset=None, flat=None, hot=None, block_rows=64):
+        self.shape = tuple(shape)
+        self.block_rows = block_rows
+        self.applied = [name for name, value in (("offset", offset), ("flat", flat), ("hot", hot)) if value is not None]
+
+        # (frame - offset) / flat == frame * gain - offset * gain
+        self.gain = None
+        if flat is not None:
+            self.gain = 1 / np.maximum(flat, MIN_FLAT)
+        self.offset = offset
+        if offset is not None and self.gain is not None:
+            self.offset = offset * self.gain
+
+        self.hot = None
+        if hot is not None and len(hot) > 0:
+            self.hot = Calibration.__neighbours(self.shape, hot)
+
+    @staticmethod
+    def __neighbours(shape, hot):
+        h, w = shape[:2]
+        channels = shape[2] if len(shape) == 3 else 1
+        y, rest = np.divmod(hot, w * channels)
+        x, c = np.divmod(rest, channels)
+        ny = np.clip(y + np.array([dy for dy, _ in NEIGHBOURS])[:, np.newaxis], 0, h - 1)
+        nx = np.clip(x + np.array([dx for _, dx in NEIGHBOURS])[:, np.newaxis], 0, w - 1)
+        if len(shape) == 2:
+            return (y, x), (ny, nx)
+        return (y, x, c), (ny, nx, c)
+
+    @property
+    def nbytes(self):
+        total = 0
+        for array in (self.offset, self.gain):
+            if array is not None:
+                total += array.nbytes
+        if self.hot is not None:
+            total += sum(a.nbytes for a in self.hot[0] + self.hot[1])
+        return total
+
+    def apply(self, frame):
+        """
+        Corrects frame, an 8 bit array of the calibration's shape, in place.
+        """
+        if frame.shape != self.shape:
+            raise ValueError("Calibration is for %s frames, not %s" % (self.shape, frame.shape))
+
+        if self.offset is not None or self.gain is not None:
+            scratch = np.empty((self.block_rows, ) + self.shape[1:], dtype=np.float32)
+            for start in range(0, self.shape[0], self.block_rows):
+                block = frame[start:start + self.block_rows]
+                values = scratch[:block.shape[0]]
+                if self.gain is not None:
+                    np.multiply(block, self.gain[start:start + self.block_rows], out=values)
+                else:
+                    values[...] = block
+                if self.offset is not None:
+                    values -= self.offset[start:start + self.block_rows]
+                np.clip(values, 0, 255, out=values)
+                values += 0.5
+                np.copyto(block, values, casting="unsafe")
+
+        if self.hot is not None:
+            pixels, neighbours = self.hot
+            frame[pixels] = np.median(frame[neighbours], axis=0)
+        return frame
@@ -0,0 +1,185 @@
+import ctypes
+import ctypes.util
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from io import BytesIO
+import PIL.Image as Image
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import process
+import metrics
+from webmodel import ContentTypes, ProcessingException
+
+
+# Output content type -> (PIL format name, default quality)
+FORMATS = {
+    ContentTypes.PNG: ("PNG", None),
+    ContentTypes.JPEG: ("JPEG", 85),
+    ContentTypes.WEBP: ("WEBP", 80)
+}
+
+ALIASES = {
+    "JPG": ContentTypes.JPEG
+}
+
+
+def parse_format(name, default=ContentTypes.PNG):
+    if name is None:
+        return default
+    name = ALIASES.get(name.upper(), name.upper())
+    if name not in FORMATS:
+        raise ProcessingException("Unsupported image format '%s'" % name, 400)
+    return name
+
+
+def encode_image(img, content_type, quality=None, compress_level=None):
+    fmt, default_quality = FORMATS[content_type]
+    options = {}
+    if fmt == "PNG":
+        if compress_level is not None:
+            options["compress_level"] = max(0, min(9, compress_level))
+    else:
+        options["quality"] = quality if quality is not None else default_quality
+
+    output = BytesIO()
+    img.save(output, fmt, **options)
+    return output.getvalue()
+
+
+def _encode_raw(mode, size, data, content_type, quality, compress_level):
+    # Runs in the encoder processes, so it takes plain (picklable) pixel data
+    start = time.time()
+    img = Image.frombuffer(mode, size, data, "raw", mode, 0, 1)
+    encoded = encode_image(img, content_type, quality, compress_level)
+    return encoded, time.time() - start
+
+
+# From linux/prctl.h
+PR_SET_PDEATHSIG = 1
+
+
+def _exit_with(parent):
+    """
+    Makes the calling (worker) process exit once parent does, so it isn't
+    left behind holding whatever it inherited.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL) == 0 and os.getppid() == parent:
+            return
+    except (OSError, AttributeError):
+        pass
+
+    # Without prctl (or if the parent is already gone), poll for it instead
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1.0)
+        os._exit(1)
+
+    watcher = threading.Thread(target=watch, name="parent-watch")
+    watcher.daemon = True
+    watcher.start()
+
+
+def _worker(call_queue, result_queue, parent):
+    _exit_with(parent)
+    process._process_worker(call_queue, result_queue)
+
+
+class EncoderPool(ProcessPoolExecutor):
+    """
+    A ProcessPoolExecutor whose workers exit with the process that started
+    them.
+    """
+
+    def _adjust_process_count(self):
+        for _ in range(len(self._processes), self._max_workers):
+            p = multiprocessing.Process(target=_worker, args=(self._call_queue, self._result_queue, os.getpid()))
+            p.start()
+            self._processes.add(p)
+
+
+class ImageEncoder(object):
+    """
+    Encodes images to PNG/JPEG/WEBP. With processes > 0 the encoding runs in
+    a pool of worker processes, so it neither holds the GIL nor the camera
+    and the next capture can proceed while the previous frame is encoded.
+    Per-format timings are kept for reporting.
+    """
+
+    def __init__(self, processes=2):
+        self.processes = processes
+        self.__pool = None
+        self.__lock = threading.Lock()
+        self.__stats = {}
+
+    def __get_pool(self):
+        with self.__lock:
+            if self.__pool is None:
+                self.__pool = EncoderPool(max_workers=self.processes)
+            return self.__pool
+
+    def start(self):
+        """
+        Starts the worker processes now rather than on the first encode. A
+        server has to start them before it listens, or they inherit its
+        sockets.
+        """
+        if self.processes > 0:
+            self.__get_pool().submit(os.getpid).result()
+
+    def __record(self, content_type, seconds, size):
+        with self.__lock:
+            stats = self.__stats.setdefault(content_type, {"count": 0, "seconds": 0.0, "max_seconds": 0.0, "bytes": 0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes"] += size
+
+    def submit(self, img, content_type=ContentTypes.PNG, quality=None, compress_level=None):
+        """
+        Starts encoding img and returns a future of the encoded bytes. The
+        pixels are copied before returning, so img may be reused right away.
+        """
+        if self.processes > 0:
+            future = self.__get_pool().submit(_encode_raw, img.mode, img.size, img.tobytes(), content_type, quality, compress_level)
+        else:
+            future = Future()
+            start = time.time()
+            future.set_result((encode_image(img, content_type, quality, compress_level), time.time() - start))
+
+        result = Future()
+
+        def done(f):
+            try:
+                encoded, seconds = f.result()
+            except Exception as e:
+                result.set_exception(e)
+                return
+            self.__record(content_type, seconds, len(encoded))
+            result.set_result(encoded)
+
+        future.add_done_callback(done)
+        return result
+
+    def encode(self, img, content_type=ContentTypes.PNG, quality=None, compress_level=None):
+        with metrics.span("encode"):
+            return self.submit(img, content_type, quality, compress_level).result()
+
+    def shutdown(self):
+        with self.__lock:
+            if self.__pool is not None:
+                self.__pool.shutdown()
+                self.__pool = None
+
+    def stats(self):
+        with self.__lock:
+            stats = {}
+            for content_type, s in self.__stats.items():
+                stats[content_type] = dict(s, mean_seconds=s["seconds"] / s["count"])
+            return stats
+
+
+DEFAULT_ENCODER = ImageEncoder()
@@ -0,0 +1,180 @@
+"""
+A search for the shutter speed and ISO that bring a luma percentile (the
+median by default) to a target level, without clipping more than a given
+fraction of the highlights.
+
+The search works on exposure, the product of shutter speed and gain, in
+microseconds at ISO 100. It keeps a bracket of the nearest probes found too
+dark and too bright and steps by the ratio the last probes predict, falling
+back to bisecting the bracket. Probes are taken at the highest ISO allowed, so
+they are as short as possible; the final settings use the lowest ISO that
+reaches the exposure.
+"""
+
+import math
+import time
+import Statistics
+
+MIN_ISO = 100
+
+# The shortest shutter speed the search will use, in microseconds
+MIN_SHUTTER_SPEED = 100
+
+# Largest factor a single step may change the exposure by (four stops)
+MAX_STEP = 16.0
+
+# A bracket narrower than this (a sixth of a stop) can't be split usefully
+MIN_BRACKET = 2 ** (1 / 6.0)
+
+
+class ExposureSearch:
+    def __init__(self, target=118, percentile=50, tolerance=8, max_clipped=0.01, max_shutter_speed=6000000,
+                 max_iso=800, max_probes=8, shutter_speed=None, iso=None):
+        self.target = target
+        self.percentile = percentile
+        self.tolerance = tolerance
+        self.max_clipped = max_clipped
+        self.max_shutter_speed = max_shutter_speed
+        self.max_iso = max_iso
+        self.max_probes = max_probes
+        self.min_exposure = float(MIN_SHUTTER_SPEED)
+        self.max_exposure = max_shutter_speed * max_iso / float(MIN_ISO)
+
+        if shutter_speed is not None:
+            self.exposure = shutter_speed * (iso or MIN_ISO) / float(MIN_ISO)
+        else:
+            # Half way, in stops, between the limits
+            self.exposure = math.sqrt(self.min_exposure * self.max_exposure)
+        self.exposure = min(max(self.exposure, self.min_exposure), self.max_exposure)
+
+        self.probes = []
+        self.status = None
+        self.started = None
+        self.seconds = 0.0
+        self.__dark = None
+        self.__bright = None
+
+    def __split(self, exposure, iso):
+        """
+        (shutter speed, ISO) for exposure, starting from the given ISO and
+        only moving off it where the shutter speed runs into its limits.
+        """
+        shutter_speed = exposure * MIN_ISO / iso
+        if shutter_speed > self.max_shutter_speed:
+            shutter_speed = self.max_shutter_speed
+        elif shutter_speed < MIN_SHUTTER_SPEED:
+            shutter_speed = MIN_SHUTTER_SPEED
+        iso = int(round(min(max(exposure * MIN_ISO / shutter_speed, MIN_ISO), self.max_iso)))
+        return int(round(shutter_speed)), iso
+
+    def start(self):
+        # Once the camera is ours, so queueing isn't counted
+        self.started = time.time()
+
+    def probe(self):
+        """
+        The (shutter speed, ISO) to take the next probe with.
+        """
+        return self.__split(self.exposure, self.max_iso)
+
+    def settings(self):
+        """
+        The chosen (shutter speed, ISO), once update() has returned True.
+        """
+        return self.__split(self.best()["exposure"], MIN_ISO)
+
+    def best(self):
+        # The probe nearest the target that doesn't clip, else the darkest one
+        usable = [p for p in self.probes if p["clipped"] <= self.max_clipped]
+        if len(usable) == 0:
+            return min(self.probes, key=lambda p: p["exposure"])
+        return min(usable, key=lambda p: abs(math.log((p["level"] + 0.5) / (self.target + 0.5))))
+
+    def update(self, frame):
+        """
+        Measures a probe frame taken with the settings probe() returned.
+        Returns True once the search is over.
+        """
+        luma = Statistics.histograms(frame)[-1]
+        summary = Statistics.summarize(luma, (self.percentile, ))
+        level = summary["percentiles"]["%g" % self.percentile]
+        clipped = summary["clipped"]["high"]
+        shutter_speed, iso = self.probe()
+        probe = {
+            "ss": shutter_speed,
+            "iso": iso,
+            "exposure": self.exposure,
+            "level": level,
+            "clipped": clipped
+        }
+        self.probes.append(probe)
+        self.seconds = time.time() - self.started
+
+        self.status = self.__judge(probe)
+        if self.status is None and len(self.probes) >= self.max_probes:
+            self.status = "probes"
+        return self.status is not None
+
+    def __judge(self, probe):
+        exposure, level = probe["exposure"], probe["level"]
+        if probe["clipped"] > self.max_clipped or level > self.target + self.tolerance:
+            if exposure <= self.min_exposure:
+                return "overexposed"
+            if self.__bright is None or exposure < self.__bright["exposure"]:
+                self.__bright = probe
+        elif level < self.target - self.tolerance:
+            if exposure >= self.max_exposure:
+                return "underexposed"
+            if self.__dark is None or exposure > self.__dark["exposure"]:
+                self.__dark = probe
+        else:
+            return "converged"
+
+        if self.__dark is not None and self.__bright is not None:
+            if self.__bright["exposure"] / self.__dark["exposure"] < MIN_BRACKET:
+                # Typically the highlights clip before the level is reached
+                return "clipped" if self.__bright["clipped"] > self.max_clipped else "bracketed"
+
+        self.exposure = self.__next(probe)
+        return None
+
+    def __slope(self):
+        # How the level responds to exposure, in log-log terms, from the last
+        # two probes: 1 for linear output, nearer 0.45 for gamma encoded
+        if len(self.probes) >= 2:
+            a, b = self.probes[-2:]
+            if 0 < a["level"] < 255 and 0 < b["level"] < 255 and a["exposure"] != b["exposure"]:
+                slope = math.log(float(b["level"]) / a["level"]) / math.log(b["exposure"] / a["exposure"])
+                return min(max(slope, 0.25), 2.0)
+        return 1.0
+
+    def __next(self, probe):
+        level = probe["level"]
+        if probe["clipped"] > self.max_clipped and level <= self.target + self.tolerance:
+            # The level is fine but the highlights aren't, take a stop off
+            step = 0.5
+        elif level <= 0:
+            step = MAX_STEP
+        elif level >= 255:
+            step = 1 / MAX_STEP
+        else:
+            step = (float(self.target) / level) ** (1 / self.__slope())
+        exposure = probe["exposure"] * min(max(step, 1 / MAX_STEP), MAX_STEP)
+        exposure = min(max(exposure, self.min_exposure), self.max_exposure)
+
+        low = self.__dark["exposure"] if self.__dark is not None else None
+        high = self.__bright["exposure"] if self.__bright is not None else None
+        if (low is not None and exposure <= low) or (high is not None and exposure >= high):
+            exposure = math.sqrt((low or self.min_exposure) * (high or self.max_exposure))
+        return exposure
+
+    def report(self):
+        shutter_speed, iso = self.settings()
+        return {
+            "ss": shutter_speed,
+            "iso": iso,
+            "status": self.status,
+            "level": self.best()["level"],
+            "seconds": self.seconds,
+            "probes": [dict((k, v) for k, v in p.items() if k != "exposure") for p in self.probes]
+        }
@@ -0,0 +1,321 @@
+from datetime import datetime
+import numpy as np
+from PIL import ImageColor
+import metrics
+from webmodel import ProcessingException
+import Annotation
+
+
+class Stage(object):
+    """
+    A single post-capture processing step working on a (height, width[, 3])
+    uint8 array. Stages must not modify their input in place (it may be a
+    view of a frame shared with other requests); they return either a view
+    or a new array.
+
+    Stages are stably sorted by rank before running: geometry (crop, bin)
+    first so later stages touch fewer pixels, then band reduction (channel,
+    grey), then everything else in request order, and overlays last.
+    """
+    rank = 2
+
+    def name(self):
+        return type(self).__name__.lower()
+
+    def key(self):
+        raise NotImplementedError
+
+    def apply(self, data, context):
+        raise NotImplementedError
+
+
+class Crop(Stage):
+    rank = 0
+
+    def __init__(self, x, y, width, height):
+        self.x, self.y, self.width, self.height = int(x), int(y), int(width), int(height)
+        if min(self.x, self.y) < 0 or min(self.width, self.height) <= 0:
+            raise ProcessingException("Invalid crop %s,%s,%s,%s" % (x, y, width, height), 400)
+
+    def key(self):
+        return ("crop", self.x, self.y, self.width, self.height)
+
+    def apply(self, data, context):
+        data = data[self.y:self.y + self.height, self.x:self.x + self.width]
+        if data.size == 0:
+            raise ProcessingException("Crop lies outside of the image", 400)
+        return data
+
+
+class Bin(Stage):
+    rank = 0
+
+    def __init__(self, factor):
+        self.factor = int(factor)
+        if self.factor < 1:
+            raise ProcessingException("Invalid bin factor '%s'" % factor, 400)
+
+    def key(self):
+        return ("bin", self.factor)
+
+    def apply(self, data, context):
+        return bin_array(data, self.factor)
+
+
+def bin_array(data, factor):
+    """
+    Averages factor x factor pixel blocks, dropping any partial block at the
+    right and bottom edges.
+    """
+    if factor == 1:
+        return data
+    h = data.shape[0] // factor
+    w = data.shape[1] // factor
+    if h == 0 or w == 0:
+        raise ProcessingException("Bin factor %s is larger than the image" % factor, 400)
+
+    blocks = data[:h * factor, :w * factor].reshape((h, factor, w, factor) + data.shape[2:])
+    summed = blocks.sum(axis=(1, 3), dtype=np.uint32)
+    summed += (factor * factor) // 2
+    summed //= factor * factor
+    return summed.astype(data.dtype)
+
+
+class Channel(Stage):
+    rank = 1
+    CHANNELS = {"r": 0, "g": 1, "b": 2}
+
+    def __init__(self, channel):
+        if channel not in Channel.CHANNELS:
+            raise ProcessingException("Invalid image color channel '%s' specified" % channel, 400)
+        self.channel = channel
+
+    def key(self):
+        return ("channel", self.channel)
+
+    def apply(self, data, context):
+        if data.ndim == 2:
+            raise ProcessingException("Cannot select a color channel of a greyscale image", 400)
+        return data[:, :, Channel.CHANNELS[self.channel]]
+
+
+class Grey(Stage):
+    rank = 1
+
+    def key(self):
+        return ("grey", )
+
+    def apply(self, data, context):
+        if data.ndim == 2:
+            return data
+
+        # ITU-R 601-2 luma, same as PIL's convert("L")
+        weights = np.array([299, 587, 114], dtype=np.uint32)
+        grey = np.dot(data, weights)
+        grey += 500
+        grey //= 1000
+        return grey.astype(np.uint8)
+
+
+class PointStage(Stage):
+    """
+    A per-pixel tone mapping. Consecutive point stages are fused into one
+    lookup table so the image is only traversed once.
+    """
+
+    def transform(self, lut, percentile_op):
+        """
+        Given the float lookup table built so far, returns the table with this
+        stage applied. percentile_op(p) returns the p'th percentile of the
+        data as mapped through the table so far.
+        """
+        raise NotImplementedError
+
+
+class Gamma(PointStage):
+    def __init__(self, gamma):
+        self.gamma = float(gamma)
+        if self.gamma <= 0:
+            raise ProcessingException("Invalid gamma '%s'" % gamma, 400)
+
+    def key(self):
+        return ("gamma", self.gamma)
+
+    def transform(self, lut, percentile_op):
+        return 255.0 * np.power(np.clip(lut, 0, 255) / 255.0, 1.0 / self.gamma)
+
+
+class Stretch(PointStage):
+    def __init__(self, low=0.5, high=99.5):
+        self.low = float(low)
+        self.high = float(high)
+        if not 0 <= self.low < self.high <= 100:
+            raise ProcessingException("Invalid stretch percentiles %s,%s" % (low, high), 400)
+
+    def key(self):
+        return ("stretch", self.low, self.high)
+
+    def transform(self, lut, percentile_op):
+        low = percentile_op(self.low)
+        high = percentile_op(self.high)
+        if high <= low:
+            return lut
+        return (lut - low) * (255.0 / (high - low))
+
+
+class FusedPointStages(Stage):
+    def __init__(self, stages):
+        self.stages = stages
+
+    def name(self):
+        return "+".join(stage.name() for stage in self.stages)
+
+    def key(self):
+        return tuple(stage.key() for stage in self.stages)
+
+    def apply(self, data, context):
+        identity = np.arange(256, dtype=np.float64)
+        state = {"lut": identity, "cdf": None}
+
+        def percentile_op(p):
+            # Every point stage is monotonic, so percentiles of the mapped data
+            # are the mapped percentiles of the input histogram
+            if state["cdf"] is None:
+                histogram = np.bincount(data.ravel(), minlength=256)
+                state["cdf"] = np.cumsum(histogram) / float(max(data.size, 1))
+            index = min(np.searchsorted(state["cdf"], p / 100.0), 255)
+            return state["lut"][index]
+
+        for stage in self.stages:
+            state["lut"] = stage.transform(state["lut"], percentile_op)
+
+        lut = np.clip(np.rint(state["lut"]), 0, 255).astype(np.uint8)
+        return np.take(lut, data)
+
+
+class Sharpen(Stage):
+    def __init__(self, amount=1.0):
+        self.amount = float(amount)
+
+    def key(self):
+        return ("sharpen", self.amount)
+
+    def apply(self, data, context):
+        # Unsharp mask against a separable 3x3 box blur
+        values = data.astype(np.float32)
+        padded = np.pad(values, ((1, 1), (1, 1)) + ((0, 0), ) * (data.ndim - 2), mode="edge")
+        rows = padded[:-2] + padded[1:-1] + padded[2:]
+        blur = rows[:, :-2] + rows[:, 1:-1] + rows[:, 2:]
+        blur /= 9.0
+
+        values -= blur
+        values *= self.amount
+        values += data
+        np.clip(values, 0, 255, out=values)
+        return values.astype(np.uint8)
+
+
+class Annotate(Stage):
+    rank = 3
+
+    def __init__(self, text, size=16, color="white", time_format="%Y-%m-%d %H:%M:%S"):
+        self.text = text
+        self.size = size
+        self.color = color
+        self.time_format = time_format
+        try:
+            self.rgb = ImageColor.getrgb(color)[:3]
+        except ValueError:
+            raise ProcessingException("Invalid annotation color '%s'" % color, 400)
+
+    def key(self):
+        return ("annotate", self.text, self.size, self.color, self.time_format)
+
+    def apply(self, data, context):
+        if context.get("source") is not None and np.may_share_memory(data, context["source"]):
+            data = data.copy()
+
+        values = dict(context.get("values", {}))
+        values["time"] = datetime.now().strftime(self.time_format)
+        mask = np.asarray(Annotation.DEFAULT_LAYERS.render(self.text, values, self.size))
+        h = min(mask.shape[0], data.shape[0])
+        w = min(mask.shape[1], data.shape[1])
+        alpha = mask[:h, :w].astype(np.float32) / 255.0
+
+        region = data[:h, :w]
+        if data.ndim == 3:
+            alpha = alpha[:, :, np.newaxis]
+            color = np.array(self.rgb, dtype=np.float32)
+        else:
+            color = np.float32((self.rgb[0] * 299 + self.rgb[1] * 587 + self.rgb[2] * 114) / 1000.0)
+        region[:] = np.rint(region * (1.0 - alpha) + color * alpha).astype(np.uint8)
+        return data
+
+
+STAGES = {
+    "crop": Crop,
+    "bin": Bin,
+    "channel": Channel,
+    "grey": Grey,
+    "gamma": Gamma,
+    "stretch": Stretch,
+    "sharpen": Sharpen
+}
+
+
+class Pipeline(object):
+    """
+    An ordered set of post-capture stages that run as NumPy operations on the
+    raw capture array, before any PIL conversion. Requested as
+
+        pipeline=crop:x,y,w,h|bin:2|channel:r|grey|gamma:2.2|stretch:0.5,99.5|sharpen:1.0
+    """
+
+    def __init__(self, stages=None):
+        self.stages = Pipeline.__plan(stages if stages is not None else [])
+
+    @staticmethod
+    def parse(spec):
+        stages = []
+        if spec is None or len(spec.strip()) == 0:
+            return stages
+
+        for part in spec.split("|"):
+            name, _, args = part.strip().partition(":")
+            if name not in STAGES:
+                raise ProcessingException("Unknown pipeline stage '%s'" % name, 400)
+            args = [arg for arg in args.split(",") if len(arg) > 0]
+            try:
+                stages.append(STAGES[name](*args))
+            except (TypeError, ValueError):
+                raise ProcessingException("Invalid arguments for pipeline stage '%s'" % part, 400)
+        return stages
+
+    @staticmethod
+    def __plan(stages):
+        ordered = sorted(stages, key=lambda stage: stage.rank)
+
+        planned = []
+        for stage in ordered:
+            if isinstance(stage, PointStage):
+                if len(planned) > 0 and isinstance(planned[-1], FusedPointStages):
+                    planned[-1].stages.append(stage)
+                else:
+                    planned.append(FusedPointStages([stage]))
+            else:
+                planned.append(stage)
+        return planned
+
+    def key(self):
+        return tuple(stage.key() for stage in self.stages)
+
+    def run(self, data, values=None):
+        """
+        Runs the stages over data (which is never modified) and returns the
+        result, which is data itself when there is nothing to do.
+        """
+        context = {"source": data, "values": values if values is not None else {}}
+        for stage in self.stages:
+            with metrics.span(stage.name()):
+                data = stage.apply(data, context)
+        return data
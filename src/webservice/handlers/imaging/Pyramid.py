@@ -0,0 +1,61 @@
+import numpy as np
+from Pipeline import bin_array
+
+
+def halve(data):
+    """
+    Averages 2x2 pixel blocks. An odd last row or column is averaged with a
+    copy of itself rather than dropped, so every level covers the whole image.
+    """
+    h, w = data.shape[:2]
+    if h % 2 or w % 2:
+        data = np.pad(data, ((0, h % 2), (0, w % 2)) + ((0, 0), ) * (data.ndim - 2), mode="edge")
+    return bin_array(data, 2)
+
+
+class Pyramid(object):
+    """
+    Power of two levels of an image, each built from the one below it. Level
+    0 fits in a single tile, level max_zoom is the image itself.
+    """
+
+    def __init__(self, data, tile_size=256):
+        self.tile_size = tile_size
+        levels = [data]
+        while max(levels[-1].shape[:2]) > tile_size:
+            levels.append(halve(levels[-1]))
+        self.levels = levels[::-1]
+        self.max_zoom = len(self.levels) - 1
+        self.nbytes = sum(level.nbytes for level in self.levels)
+
+    def tiles(self, z):
+        """
+        Returns the number of (columns, rows) of tiles at level z.
+        """
+        h, w = self.levels[z].shape[:2]
+        return -(-w // self.tile_size), -(-h // self.tile_size)
+
+    def tile(self, z, x, y):
+        """
+        Returns the tile at column x and row y of level z (smaller than
+        tile_size along the right and bottom edges), or None when there is
+        no such tile.
+        """
+        if z < 0 or z > self.max_zoom:
+            return None
+        columns, rows = self.tiles(z)
+        if x < 0 or y < 0 or x >= columns or y >= rows:
+            return None
+        size = self.tile_size
+        return self.levels[z][y * size:(y + 1) * size, x * size:(x + 1) * size]
+
+    def info(self):
+        h, w = self.levels[-1].shape[:2]
+        return {
+            "width": w,
+            "height": h,
+            "tile_size": self.tile_size,
+            "max_zoom": self.max_zoom,
+            "levels": [{"width": level.shape[1], "height": level.shape[0], "tiles": self.tiles(z)}
+                       for z, level in enumerate(self.levels)]
+        }
@@ -0,0 +1,360 @@
+import math
+import time
+import numpy as np
+from Pipeline import bin_array
+
+
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def to_grey(data):
+    if data.ndim == 3:
+        return np.dot(data, LUMA)
+    return data.astype(np.float32)
+
+
+def hann_window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def radial_window(shape):
+    # Raised cosine over the largest centred circle, unlike a separable
+    # window it rotates with the image
+    h, w = shape
+    ys, xs = np.ogrid[0:h, 0:w]
+    radius = np.hypot(ys - (h - 1) / 2.0, xs - (w - 1) / 2.0) / (min(h, w) / 2.0)
+    return np.where(radius < 1, 0.5 + 0.5 * np.cos(math.pi * np.minimum(radius, 1)), 0).astype(np.float32)
+
+
+def sample(image, ys, xs):
+    """
+    Bilinear samples of image at the (float) coordinates ys, xs, which are
+    clamped to the image so the edges repeat.
+    """
+    h, w = image.shape[:2]
+    ys = np.clip(ys, 0, h - 1)
+    xs = np.clip(xs, 0, w - 1)
+    y0 = np.minimum(ys.astype(np.intp), max(h - 2, 0))
+    x0 = np.minimum(xs.astype(np.intp), max(w - 2, 0))
+    y1 = np.minimum(y0 + 1, h - 1)
+    x1 = np.minimum(x0 + 1, w - 1)
+    fy = (ys - y0).astype(np.float32)
+    fx = (xs - x0).astype(np.float32)
+    if image.ndim == 3:
+        fy = fy[..., np.newaxis]
+        fx = fx[..., np.newaxis]
+
+    top = image[y0, x0] * (1 - fx) + image[y0, x1] * fx
+    bottom = image[y1, x0] * (1 - fx) + image[y1, x1] * fx
+    return top * (1 - fy) + bottom * fy
+
+
+class Transform(object):
+    """
+    A rotation by angle (radians) about centre followed by a shift, mapping
+    reference coordinates onto frame coordinates.
+    """
+
+    def __init__(self, dy=0.0, dx=0.0, angle=0.0, centre=(0.0, 0.0), peak=1.0):
+        self.dy = dy
+        self.dx = dx
+        self.angle = angle
+        self.centre = centre
+        self.peak = peak
+
+    def rotate(self, y, x):
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        return sin * x + cos * y, cos * x - sin * y
+
+    def to_frame(self, ys, xs):
+        cy, cx = self.centre
+        ry, rx = self.rotate(ys - cy, xs - cx)
+        return ry + cy + self.dy, rx + cx + self.dx
+
+    def to_reference(self, ys, xs):
+        cy, cx = self.centre
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        y = ys - cy - self.dy
+        x = xs - cx - self.dx
+        return cos * y - sin * x + cy, cos * x + sin * y + cx
+
+
+def _vertex(a, b, c):
+    # Sub-sample offset of the peak of a Gaussian through three samples
+    a, b, c = np.log(np.maximum([a, b, c], 1e-12))
+    d = a - 2 * b + c
+    if d >= 0:
+        return 0.0
+    return 0.5 * (a - c) / d
+
+
+class PhaseCorrelator(object):
+    """
+    Finds the translation of an image against a reference of the same size
+    by phase correlation. The cross power spectrum is tapered with a
+    Gaussian so the correlation peak has a known shape, which is then
+    located to a fraction of a pixel.
+    """
+
+    def __init__(self, reference, sigma=1.0):
+        self.shape = reference.shape
+        self.window = hann_window(self.shape)
+        fy = np.fft.fftfreq(self.shape[0])[:, np.newaxis]
+        fx = np.fft.rfftfreq(self.shape[1])[np.newaxis, :]
+        self.taper = np.exp(-2 * (math.pi * sigma) ** 2 * (fy ** 2 + fx ** 2))
+        self.reference = np.conj(self.__spectrum(reference))
+        self.perfect = np.fft.irfft2(self.taper, self.shape)[0, 0]
+
+    def __spectrum(self, image):
+        image = image - image.mean()
+        image *= self.window
+        return np.fft.rfft2(image)
+
+    def correlate(self, image):
+        """
+        Returns (dy, dx, peak) such that image(p) ~ reference(p - (dy, dx)),
+        peak being the height of the (normalized) correlation peak.
+        """
+        cross = self.__spectrum(image) * self.reference
+        cross /= np.maximum(np.abs(cross), 1e-12)
+        cross *= self.taper
+        surface = np.fft.irfft2(cross, self.shape)
+
+        h, w = self.shape
+        py, px = np.unravel_index(np.argmax(surface), self.shape)
+        peak = surface[py, px]
+        dy = py + _vertex(surface[(py - 1) % h, px], peak, surface[(py + 1) % h, px])
+        dx = px + _vertex(surface[py, (px - 1) % w], peak, surface[py, (px + 1) % w])
+        if dy > h / 2.0:
+            dy -= h
+        if dx > w / 2.0:
+            dx -= w
+        return dy, dx, peak / self.perfect
+
+
+class Registrar(object):
+    """
+    Registers frames against a reference frame. A coarse shift (and,
+    optionally, rotation) is found on binned copies of the whole frame, then
+    refined to a fraction of a pixel on full resolution patches: one at the
+    centre, or with rotation five spread over the frame whose shifts are
+    fitted with a rigid transform. Only spectra of the reference are kept,
+    never frames.
+    """
+
+    def __init__(self, reference, downsample=4, roi_size=256, rotation=False, angles=360):
+        self.shape = reference.shape[:2]
+        self.downsample = max(1, min(downsample, min(self.shape) // 16))
+        self.rotation = rotation
+        self.angles = angles
+        self.centre = ((self.shape[0] - 1) / 2.0, (self.shape[1] - 1) / 2.0)
+        self.frames = 0
+        self.seconds = 0.0
+        self.max_shift = 0.0
+        self.max_angle = 0.0
+        self.peaks = 0.0
+
+        small = to_grey(bin_array(reference, self.downsample))
+        self.small_centre = ((small.shape[0] - 1) / 2.0, (small.shape[1] - 1) / 2.0)
+        self.coarse = PhaseCorrelator(small)
+
+        if rotation:
+            self.radial_window = radial_window(small.shape)
+            self.polar = PhaseCorrelator(self.__polar(small))
+
+        h, w = self.shape
+        ph, pw = min(roi_size, h), min(roi_size, w)
+        offsets = [(0, 0)]
+        if rotation:
+            offsets += [(-h / 4.0, -w / 4.0), (-h / 4.0, w / 4.0), (h / 4.0, -w / 4.0), (h / 4.0, w / 4.0)]
+        self.patches = []
+        for oy, ox in offsets:
+            y = min(max(int(round(self.centre[0] + oy - ph / 2.0)), 0), h - ph)
+            x = min(max(int(round(self.centre[1] + ox - pw / 2.0)), 0), w - pw)
+            self.patches.append(((y, x, ph, pw), PhaseCorrelator(to_grey(reference[y:y + ph, x:x + pw]))))
+
+    def __polar(self, image):
+        # Polar resampling of the (translation invariant) magnitude spectrum,
+        # a rotation of the image becomes a shift along the angle axis.
+        # Sampled in cycles per pixel, as the two axes of a non-square
+        # spectrum have a different resolution.
+        magnitude = np.abs(np.fft.fftshift(np.fft.fft2((image - image.mean()) * self.radial_window)))
+        magnitude = np.log1p(magnitude)
+        h, w = magnitude.shape
+        radii = np.linspace(0.03, 0.45, max(16, min(h, w) // 2))
+        thetas = np.arange(self.angles) * (math.pi / self.angles)
+        ys = h // 2 + h * radii[np.newaxis, :] * np.sin(thetas)[:, np.newaxis]
+        xs = w // 2 + w * radii[np.newaxis, :] * np.cos(thetas)[:, np.newaxis]
+        return sample(magnitude, ys, xs).astype(np.float32)
+
+    def __angle(self, small):
+        steps = self.polar.correlate(self.__polar(small))[0]
+        angle = steps * math.pi / self.angles
+        # The magnitude spectrum is symmetric, so only small rotations can be told apart
+        return (angle + math.pi / 2) % math.pi - math.pi / 2
+
+    def register(self, frame):
+        start = time.time()
+        small = to_grey(bin_array(frame, self.downsample))
+
+        angle = 0.0
+        if self.rotation:
+            angle = self.__angle(small)
+            ys, xs = np.mgrid[0:small.shape[0], 0:small.shape[1]].astype(np.float32)
+            derotate = Transform(angle=angle, centre=self.small_centre)
+            small = sample(small, *derotate.to_frame(ys, xs))
+
+        # Shifts measured on derotated images are in reference orientation
+        dy, dx, peak = self.coarse.correlate(small)
+        transform = Transform(angle=angle, centre=self.centre, peak=peak)
+        transform.dy, transform.dx = transform.rotate(dy * self.downsample, dx * self.downsample)
+
+        for _ in range(2 if self.rotation else 1):
+            transform = self.__refine(frame, transform)
+
+        self.frames += 1
+        self.seconds += time.time() - start
+        self.max_shift = max(self.max_shift, math.hypot(transform.dy, transform.dx))
+        self.max_angle = max(self.max_angle, abs(transform.angle))
+        self.peaks += transform.peak
+        return transform
+
+    def __refine(self, frame, transform):
+        if not self.rotation:
+            # Whole pixel shifts can simply be sliced out of the frame
+            transform = Transform(int(round(transform.dy)), int(round(transform.dx)), 0.0, self.centre, transform.peak)
+
+        cy, cx = self.centre
+        measured = []
+        for (y, x, h, w), correlator in self.patches:
+            if self.rotation:
+                ys, xs = np.mgrid[y:y + h, x:x + w].astype(np.float32)
+                patch = sample(frame, *transform.to_frame(ys, xs))
+            else:
+                fy, fx = y + transform.dy, x + transform.dx
+                if fy < 0 or fx < 0 or fy + h > self.shape[0] or fx + w > self.shape[1]:
+                    continue
+                patch = frame[fy:fy + h, fx:fx + w]
+
+            ry, rx, peak = correlator.correlate(to_grey(patch))
+            measured.append((y + (h - 1) / 2.0 - cy, x + (w - 1) / 2.0 - cx, ry, rx, max(peak, 1e-6)))
+
+        if len(measured) == 0:
+            return transform
+        qy, qx, ry, rx, peaks = np.array(measured).T
+
+        # Residual displacement r(q) = e + w x q for a small extra rotation w
+        if len(measured) >= 3:
+            ones, zeros = np.ones_like(qy), np.zeros_like(qy)
+            a = np.concatenate([np.c_[ones, zeros, qx], np.c_[zeros, ones, -qy]]) * np.tile(peaks, 2)[:, np.newaxis]
+            b = np.concatenate([ry, rx]) * np.tile(peaks, 2)
+            ey, ex, omega = np.linalg.lstsq(a, b, rcond=-1)[0]
+        else:
+            ey, ex, omega = np.average(ry, weights=peaks), np.average(rx, weights=peaks), 0.0
+
+        ey, ex = transform.rotate(ey, ex)
+        return Transform(transform.dy + ey, transform.dx + ex, transform.angle + omega, self.centre, float(peaks.mean()))
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "seconds": self.seconds,
+            "max_shift": self.max_shift,
+            "max_angle": math.degrees(self.max_angle),
+            "mean_peak": self.peaks / self.frames if self.frames > 0 else 0.0
+        }
+
+
+def warp(frame, transform, out=None, strip_rows=64):
+    """
+    Resamples frame onto the reference grid, a strip of rows at a time so
+    the coordinate arrays stay small.
+    """
+    h, w = frame.shape[:2]
+    if out is None:
+        out = np.empty(frame.shape, dtype=np.float32)
+
+    xs = np.arange(w, dtype=np.float32)[np.newaxis, :]
+    for y0 in range(0, h, strip_rows):
+        ys = np.arange(y0, min(y0 + strip_rows, h), dtype=np.float32)[:, np.newaxis]
+        fy, fx = transform.to_frame(ys + np.zeros_like(xs), xs + np.zeros_like(ys))
+        out[y0:y0 + ys.shape[0]] = sample(frame, fy, fx)
+    return out
+
+
+class Drizzle(object):
+    """
+    Drops registered frames onto an output grid scale times finer than the
+    reference. Every input pixel is mapped into the output and its value
+    split between the four nearest output pixels with bilinear weights;
+    values and weights are summed with np.bincount a strip of rows at a time.
+    Output pixels no frame landed on come out as 0.
+    """
+
+    def __init__(self, shape, scale=2.0, strip_rows=64):
+        self.scale = scale
+        self.strip_rows = strip_rows
+        self.channels = shape[2] if len(shape) == 3 else 1
+        self.out_shape = (int(round(shape[0] * scale)), int(round(shape[1] * scale)))
+        size = self.out_shape[0] * self.out_shape[1]
+        self.sum = np.zeros((self.channels, size), dtype=np.float32)
+        self.weight = np.zeros(size, dtype=np.float32)
+        self.count = 0
+
+    def add(self, frame, transform):
+        self.count += 1
+        h, w = frame.shape[:2]
+        oh, ow = self.out_shape
+        values = frame.reshape(h, w, self.channels)
+        xs = np.arange(w, dtype=np.float32)[np.newaxis, :]
+
+        for y0 in range(0, h, self.strip_rows):
+            rows = min(self.strip_rows, h - y0)
+            ys = np.arange(y0, y0 + rows, dtype=np.float32)[:, np.newaxis]
+            ry, rx = transform.to_reference(ys + np.zeros_like(xs), xs + np.zeros_like(ys))
+
+            # Pixel centres of the reference onto pixel centres of the output
+            oy = (ry + 0.5) * self.scale - 0.5
+            ox = (rx + 0.5) * self.scale - 0.5
+            iy = np.floor(oy)
+            ix = np.floor(ox)
+            fy = (oy - iy).ravel()
+            fx = (ox - ix).ravel()
+            iy = iy.astype(np.intp).ravel()
+            ix = ix.astype(np.intp).ravel()
+
+            source = np.arange(iy.size)
+            index = []
+            weight = []
+            pixels = []
+            for cy, cx, wy, wx in ((0, 0, 1 - fy, 1 - fx), (0, 1, 1 - fy, fx), (1, 0, fy, 1 - fx), (1, 1, fy, fx)):
+                y = iy + cy
+                x = ix + cx
+                valid = (y >= 0) & (y < oh) & (x >= 0) & (x < ow)
+                index.append((y * ow + x)[valid])
+                weight.append((wy * wx)[valid])
+                pixels.append(source[valid])
+            index = np.concatenate(index)
+            if index.size == 0:
+                continue
+            weight = np.concatenate(weight)
+            pixels = np.concatenate(pixels)
+            strip = values[y0:y0 + rows].reshape(-1, self.channels)
+
+            lo = index.min()
+            hi = index.max() + 1
+            index -= lo
+            self.weight[lo:hi] += np.bincount(index, weights=weight, minlength=hi - lo)
+            for c in range(self.channels):
+                self.sum[c, lo:hi] += np.bincount(index, weights=weight * strip[pixels, c], minlength=hi - lo)
+
+    def result(self):
+        data = np.zeros_like(self.sum)
+        np.divide(self.sum, self.weight, out=data, where=self.weight > 0)
+        data = data.reshape((self.channels, ) + self.out_shape)
+        if self.channels == 1:
+            return data[0]
+        return np.moveaxis(data, 0, -1).copy()
+
+    def stats(self):
+        return {"frames": self.count, "coverage": float(np.count_nonzero(self.weight)) / self.weight.size}
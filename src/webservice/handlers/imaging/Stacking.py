@@ -0,0 +1,235 @@
+import numpy as np
+
+
+class Accumulator(object):
+    """
+    Combines a series of equally shaped frames into one float32 image, in the
+    units of the input. add() may be handed read-only views of pooled
+    buffers and must not hold on to them.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def add(self, frame):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"frames": self.count}
+
+
+class MeanAccumulator(Accumulator):
+    """
+    Running (Welford) mean, memory doesn't grow with the number of frames.
+    """
+
+    def __init__(self):
+        Accumulator.__init__(self)
+        self.mean = None
+        self.delta = None
+
+    def add(self, frame):
+        self.count += 1
+        if self.mean is None:
+            self.mean = frame.astype(np.float32)
+            self.delta = np.empty_like(self.mean)
+            return
+
+        np.subtract(frame, self.mean, out=self.delta)
+        self.delta /= self.count
+        self.mean += self.delta
+
+    def result(self):
+        return self.mean
+
+
+class SigmaClipAccumulator(Accumulator):
+    """
+    Sigma clipped mean in constant memory. Each pixel keeps a running
+    (Welford) mean and variance of the samples accepted so far and their
+    count; a new sample is rejected when it lies more than kappa standard
+    deviations from that mean.
+
+    The first few frames have nothing to be judged against, so they are held
+    back until warmup frames have arrived and then each is judged against
+    the statistics of the others.
+
+    That is 10 bytes per sample (two float32 planes and a uint16 count) plus
+    the warmup frames, about 360MB for 3264x2464 RGB frames. The work is done
+    a block of rows at a time so temporaries stay small.
+    """
+
+    # Floor for the standard deviation, so 8 bit quantization on an
+    # otherwise constant pixel doesn't count as an outlier
+    MIN_SIGMA = 1.0
+
+    def __init__(self, kappa=3.0, warmup=5, block_rows=64):
+        Accumulator.__init__(self)
+        self.kappa = kappa
+        self.warmup = max(warmup, 3)
+        self.block_rows = block_rows
+        self.rejected = 0
+        self.mean = None
+        self.__pending = []
+
+    def __allocate(self, frame):
+        shape = frame.shape
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.m2 = np.zeros(shape, dtype=np.float32)
+        self.n = np.zeros(shape, dtype=np.uint16)
+        block = (min(self.block_rows, shape[0]), ) + shape[1:]
+        self.delta = np.empty(block, dtype=np.float32)
+        self.scratch = np.empty(block, dtype=np.float32)
+        self.mask = np.empty(block, dtype=np.bool_)
+
+    def __blocks(self):
+        for start in range(0, self.mean.shape[0], self.block_rows):
+            rows = slice(start, start + self.block_rows)
+            size = len(range(*rows.indices(self.mean.shape[0])))
+            yield rows, self.delta[:size], self.scratch[:size], self.mask[:size]
+
+    def __include(self, frame, mask, rows, delta, scratch):
+        # Welford update of the accepted statistics with the pixels in mask
+        mean, m2, n = self.mean[rows], self.m2[rows], self.n[rows]
+        n += mask
+        np.subtract(frame, mean, out=delta)
+        delta *= mask
+        np.divide(delta, np.maximum(n, 1), out=scratch)
+        mean += scratch
+        np.subtract(frame, mean, out=scratch)
+        scratch *= delta
+        m2 += scratch
+
+    def __threshold(self, dof):
+        """
+        kappa widened to the Student t quantile for dof degrees of freedom
+        (Cornish-Fisher), so the few samples behind an estimate don't get
+        good ones rejected. Below 4 the quantile grows so fast nothing would
+        be rejected, so it stops there.
+        """
+        z = self.kappa
+        dof = np.maximum(np.asarray(dof, dtype=np.float32), 4)
+        return z + (z ** 3 + z) / (4 * dof) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * dof * dof)
+
+    def __accept(self, frame, mean, m2, n, delta, scratch, mask):
+        # The spread of a new sample about a mean of n: the variance of the
+        # samples plus that of their mean
+        n = np.maximum(n, 2)
+        np.divide(m2, n - 1, out=scratch)
+        scratch *= (n + 1.0) / n
+        np.sqrt(scratch, out=scratch)
+        np.maximum(scratch, SigmaClipAccumulator.MIN_SIGMA, out=scratch)
+        scratch *= self.__threshold(n - 1)
+        np.subtract(frame, mean, out=delta)
+        np.abs(delta, out=delta)
+        np.less_equal(delta, scratch, out=mask)
+        self.rejected += mask.size - np.count_nonzero(mask)
+        return mask
+
+    def __settle(self):
+        pending, self.__pending = self.__pending, []
+        if len(pending) == 0:
+            return
+
+        # Judge every held back frame against the statistics of the others
+        n = len(pending) - 1
+        for rows, delta, scratch, mask in self.__blocks():
+            frames = [frame[rows] for frame in pending]
+            accepted = []
+            if n >= 2:
+                total = np.sum(frames, axis=0, dtype=np.float64)
+                squares = np.sum(np.square(frames, dtype=np.float64), axis=0)
+                for frame in frames:
+                    mean = (total - frame) / n
+                    m2 = np.maximum(squares - np.square(frame, dtype=np.float64) - n * np.square(mean), 0)
+                    accepted.append(self.__accept(frame, mean, m2, n, delta, scratch, mask).copy())
+            else:
+                accepted = [np.ones(mask.shape, dtype=np.bool_) for _ in frames]
+
+            # A pixel that rejected all of them keeps them all
+            none = ~np.logical_or.reduce(accepted)
+            for frame, accept in zip(frames, accepted):
+                accept |= none
+                self.__include(frame, accept, rows, delta, scratch)
+
+    def add(self, frame):
+        self.count += 1
+        if self.mean is None:
+            self.__allocate(frame)
+
+        if self.count <= self.warmup:
+            self.__pending.append(np.array(frame))
+            if self.count == self.warmup:
+                self.__settle()
+            return
+
+        # Judged against the earlier samples, before it counts towards them
+        for rows, delta, scratch, mask in self.__blocks():
+            block = frame[rows]
+            self.__accept(block, self.mean[rows], self.m2[rows], self.n[rows], delta, scratch, mask)
+            self.__include(block, mask, rows, delta, scratch)
+
+    def result(self):
+        self.__settle()
+        return self.mean
+
+    def stats(self):
+        return {"frames": self.count, "rejected": self.rejected}
+
+
+class MedianAccumulator(Accumulator):
+    """
+    Approximate per-pixel median in bounded memory. Frames are collected in
+    chunks of chunk_size and each full chunk is reduced to its median; chunk
+    medians are in turn reduced chunk_size at a time, level by level (a
+    median of medians). Up to chunk_size frames the result is exact.
+    """
+
+    def __init__(self, chunk_size=8):
+        Accumulator.__init__(self)
+        self.chunk_size = max(chunk_size, 2)
+        self.__chunk = None
+        self.__filled = 0
+        self.__levels = []
+
+    def __push(self, level, median):
+        if len(self.__levels) == level:
+            self.__levels.append([])
+        self.__levels[level].append(median)
+        if len(self.__levels[level]) == self.chunk_size:
+            medians = np.array(self.__levels[level])
+            self.__levels[level] = []
+            self.__push(level + 1, np.median(medians, axis=0, overwrite_input=True).astype(np.float32))
+
+    def add(self, frame):
+        self.count += 1
+        if self.__chunk is None:
+            self.__chunk = np.empty((self.chunk_size, ) + frame.shape, dtype=frame.dtype)
+
+        self.__chunk[self.__filled] = frame
+        self.__filled += 1
+        if self.__filled == self.chunk_size:
+            self.__push(0, np.median(self.__chunk, axis=0).astype(np.float32))
+            self.__filled = 0
+
+    def result(self):
+        carry = None
+        if self.__filled > 0:
+            carry = np.median(self.__chunk[:self.__filled], axis=0).astype(np.float32)
+
+        for medians in self.__levels:
+            if carry is not None:
+                medians = medians + [carry]
+            if len(medians) > 0:
+                carry = np.median(np.array(medians), axis=0).astype(np.float32)
+        return carry
+
+
+METHODS = {
+    "mean": MeanAccumulator,
+    "median": MedianAccumulator,
+    "sigmaclip": SigmaClipAccumulator
+}
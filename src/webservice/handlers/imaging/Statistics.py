@@ -0,0 +1,57 @@
+"""
+Exposure statistics of 8 bit frames, all derived from per channel histograms
+so that the pixels are only gone over once.
+"""
+
+import numpy as np
+
+CHANNELS = ("r", "g", "b")
+
+# Rec. 601 luma weights, in 1/256ths
+LUMA_WEIGHTS = (77, 150, 29)
+
+
+def histograms(data, block_rows=64):
+    """
+    Returns the 256 bin histograms of each channel of data (rows, columns,
+    channels) and of its luma. Each block of rows gets a single bincount over
+    its values offset by 256 per channel; bincount works on a 64 bit copy of
+    its input, which stays in cache at this size.
+    """
+    channels = data.shape[2]
+    offsets = np.arange(channels + 1, dtype=np.uint16) * 256
+    counts = np.zeros(256 * (channels + 1), dtype=np.intp)
+    for start in range(0, data.shape[0], block_rows):
+        block = data[start:start + block_rows]
+        values = np.empty(block.shape[:2] + (channels + 1,), dtype=np.uint16)
+        values[:, :, :channels] = block
+        luma = values[:, :, channels]
+        np.multiply(values[:, :, 0], LUMA_WEIGHTS[0], out=luma)
+        for c in range(1, channels):
+            luma += values[:, :, c] * np.uint16(LUMA_WEIGHTS[c])
+        luma += 128
+        luma >>= 8
+        values += offsets
+        counts += np.bincount(values.ravel(), minlength=counts.size)
+    return counts.reshape((channels + 1, 256))
+
+
+def summarize(histogram, percentiles=(1, 5, 50, 95, 99)):
+    """
+    Mean, extremes, percentiles and the fraction of pixels clipped at either
+    end of a 256 bin histogram, as plain Python numbers.
+    """
+    pixels = int(histogram.sum())
+    occupied = np.flatnonzero(histogram)
+    cdf = np.cumsum(histogram)
+    indices = np.searchsorted(cdf, [p / 100.0 * pixels for p in percentiles])
+    return {
+        "mean": float(np.dot(histogram, np.arange(256))) / max(pixels, 1),
+        "min": int(occupied[0]) if len(occupied) > 0 else None,
+        "max": int(occupied[-1]) if len(occupied) > 0 else None,
+        "percentiles": dict(("%g" % p, int(min(i, 255))) for p, i in zip(percentiles, indices)),
+        "clipped": {
+            "low": float(histogram[0]) / max(pixels, 1),
+            "high": float(histogram[255]) / max(pixels, 1)
+        }
+    }
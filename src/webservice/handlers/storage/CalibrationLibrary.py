@@ -0,0 +1,149 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+import numpy as np
+
+
+class CalibrationLibrary(object):
+    """
+    Master bias, dark and flat frames saved as float32 .npy files, with the
+    hot pixel map of each dark alongside, and indexed in an SQLite database
+    by the settings they were captured with.
+    """
+
+    COLUMNS = (
+        ("kind", "TEXT NOT NULL"),
+        ("iso", "INTEGER"),
+        ("ss", "INTEGER"),
+        ("md", "INTEGER"),
+        ("hres", "INTEGER"),
+        ("vres", "INTEGER"),
+        ("hflip", "INTEGER"),
+        ("vflip", "INTEGER"),
+        ("temperature", "REAL"),
+        ("frames", "INTEGER"),
+        ("method", "TEXT"),
+        ("hot_pixels", "INTEGER")
+    )
+
+    # Settings a master has to share with the frames it's applied to
+    MATCH = ("iso", "md", "hres", "vres", "hflip", "vflip")
+
+    MAX_RESULTS = 1000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__lock = threading.Lock()
+        if not os.path.isdir(os.path.join(directory, "masters")):
+            os.makedirs(os.path.join(directory, "masters"))
+
+        self.__db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        with self.__lock, self.__db:
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS masters (id TEXT PRIMARY KEY, created REAL NOT NULL, %s)"
+                              % ", ".join("%s %s" % column for column in CalibrationLibrary.COLUMNS))
+            self.__db.execute("CREATE INDEX IF NOT EXISTS masters_settings ON masters (kind, iso, md, hres, vres)")
+
+    def path(self, record, suffix="npy"):
+        return os.path.join(self.directory, "masters", "%s.%s" % (record["id"], suffix))
+
+    def __save(self, path, array):
+        # Written to the side first so a crash never leaves a truncated file
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, array)
+        os.rename(temp, path)
+
+    def put(self, kind, master, metadata, hot=None):
+        """
+        Saves a master (and for darks its hot pixel indices) and returns its
+        index record. Unknown metadata keys are ignored.
+        """
+        record = {
+            "id": uuid.uuid4().hex,
+            "created": time.time(),
+            "kind": kind
+        }
+        for name, _ in CalibrationLibrary.COLUMNS[1:]:
+            record[name] = metadata.get(name)
+        record["hot_pixels"] = len(hot) if hot is not None else None
+
+        self.__save(self.path(record), master.astype(np.float32))
+        if hot is not None:
+            self.__save(self.path(record, "hot.npy"), hot)
+
+        names = sorted(record.keys())
+        with self.__lock, self.__db:
+            self.__db.execute("INSERT INTO masters (%s) VALUES (%s)" % (", ".join(names), ", ".join("?" * len(names))),
+                              [record[name] for name in names])
+        return self.get(record["id"])
+
+    def load(self, record):
+        """
+        Returns (master, hot pixel indices or None) for an index record.
+        """
+        hot = None
+        if record["hot_pixels"] is not None:
+            hot = np.load(self.path(record, "hot.npy"))
+        return np.load(self.path(record)), hot
+
+    def get(self, master_id):
+        with self.__lock:
+            row = self.__db.execute("SELECT * FROM masters WHERE id = ?", (master_id, )).fetchone()
+        return CalibrationLibrary.__record(row) if row is not None else None
+
+    def find(self, kind, settings, temperature=None, ss=None):
+        """
+        The master of a kind captured with the same settings, preferring the
+        nearest shutter speed to ss (when given) and then the nearest
+        temperature, then the newest.
+        """
+        clauses = ["kind = ?"] + ["%s IS ?" % name for name in CalibrationLibrary.MATCH]
+        values = [kind] + [settings.get(name) for name in CalibrationLibrary.MATCH]
+        order = []
+        if ss is not None:
+            clauses.append("ss IS NOT NULL")
+            order.append("ABS(ss - ?)")
+            values.append(ss)
+        if temperature is not None:
+            order.extend(["temperature IS NULL", "ABS(temperature - ?)"])
+            values.append(temperature)
+        order.append("created DESC")
+
+        with self.__lock:
+            row = self.__db.execute("SELECT * FROM masters WHERE %s ORDER BY %s LIMIT 1"
+                                    % (" AND ".join(clauses), ", ".join(order)), values).fetchone()
+        return CalibrationLibrary.__record(row) if row is not None else None
+
+    def query(self, filters=None, limit=100, offset=0):
+        clauses = []
+        values = []
+        for name, value in (filters or {}).items():
+            if name not in dict(CalibrationLibrary.COLUMNS) and name != "id":
+                raise ValueError("Unknown master property '%s'" % name)
+            clauses.append("%s = ?" % name)
+            values.append(value)
+
+        where = ("WHERE %s" % " AND ".join(clauses)) if len(clauses) > 0 else ""
+        with self.__lock:
+            total = self.__db.execute("SELECT COUNT(*) FROM masters %s" % where, values).fetchone()[0]
+            rows = self.__db.execute("SELECT * FROM masters %s ORDER BY created DESC LIMIT ? OFFSET ?" % where,
+                                     values + [min(limit, CalibrationLibrary.MAX_RESULTS), offset]).fetchall()
+        return total, [CalibrationLibrary.__record(row) for row in rows]
+
+    @staticmethod
+    def __record(row):
+        record = dict(zip(row.keys(), row))
+        for name in ("hflip", "vflip"):
+            if record[name] is not None:
+                record[name] = bool(record[name])
+        return record
+
+    def stats(self):
+        with self.__lock:
+            rows = self.__db.execute("SELECT kind, COUNT(*) FROM masters GROUP BY kind").fetchall()
+        return dict((row[0], row[1]) for row in rows)
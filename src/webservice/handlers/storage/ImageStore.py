@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class ImageStore(object):
+    """
+    Content addressed store for encoded images. Each file is written once,
+    under objects/ named by the SHA-256 of its contents, however many times
+    it is stored, and indexed in an SQLite database along with the settings
+    it was captured with.
+    """
+
+    # Metadata kept for every image, all of them can be queried on
+    COLUMNS = (
+        ("iso", "INTEGER"),
+        ("ss", "INTEGER"),
+        ("awb", "TEXT"),
+        ("ex", "TEXT"),
+        ("md", "INTEGER"),
+        ("hres", "INTEGER"),
+        ("vres", "INTEGER"),
+        ("hflip", "INTEGER"),
+        ("vflip", "INTEGER"),
+        ("pipeline", "TEXT"),
+        ("source", "TEXT")
+    )
+
+    EXTENSIONS = {
+        "PNG": "png",
+        "JPEG": "jpeg",
+        "WEBP": "webp",
+        "NPY": "npy"
+    }
+
+    MAX_RESULTS = 1000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log = logging.getLogger(__name__)
+        self.__lock = threading.Lock()
+        if not os.path.isdir(os.path.join(directory, "objects")):
+            os.makedirs(os.path.join(directory, "objects"))
+
+        # A single connection shared by the request threads, serialised by the lock
+        self.__db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.__db.row_factory = sqlite3.Row
+        with self.__lock, self.__db:
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("CREATE TABLE IF NOT EXISTS images (id TEXT PRIMARY KEY, content_type TEXT NOT NULL, "
+                              "size INTEGER NOT NULL, captured REAL NOT NULL, %s)"
+                              % ", ".join("%s %s" % column for column in ImageStore.COLUMNS))
+            self.__db.execute("CREATE INDEX IF NOT EXISTS images_captured ON images (captured)")
+            self.__db.execute("CREATE INDEX IF NOT EXISTS images_exposure ON images (iso, ss)")
+
+    def path(self, record):
+        return os.path.join(self.directory, "objects", record["id"][:2],
+                            "%s.%s" % (record["id"], ImageStore.EXTENSIONS[record["content_type"]]))
+
+    def put(self, data, content_type, metadata, captured=None):
+        """
+        Stores data unless an identical file is already there and returns
+        its index record. Unknown metadata keys are ignored.
+        """
+        record = {
+            "id": hashlib.sha256(data).hexdigest(),
+            "content_type": content_type,
+            "size": len(data),
+            "captured": captured if captured is not None else time.time()
+        }
+        for name, _ in ImageStore.COLUMNS:
+            record[name] = metadata.get(name)
+
+        path = self.path(record)
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    # Created by a concurrent put
+                    pass
+            # Written to the side first so a crash never leaves a truncated file
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(temp, path)
+
+        names = sorted(record.keys())
+        with self.__lock, self.__db:
+            self.__db.execute("INSERT OR IGNORE INTO images (%s) VALUES (%s)" % (", ".join(names), ", ".join("?" * len(names))),
+                              [record[name] for name in names])
+        return self.get(record["id"])
+
+    def get(self, image_id):
+        with self.__lock:
+            row = self.__db.execute("SELECT * FROM images WHERE id = ?", (image_id, )).fetchone()
+        return ImageStore.__record(row) if row is not None else None
+
+    def query(self, filters=None, since=None, until=None, limit=100, offset=0, newest_first=True):
+        """
+        Finds images captured in [since, until) whose metadata equals every
+        value in filters.
+        """
+        clauses = []
+        values = []
+        for name, value in (filters or {}).items():
+            if name not in dict(ImageStore.COLUMNS) and name != "content_type":
+                raise ValueError("Unknown image property '%s'" % name)
+            clauses.append("%s = ?" % name)
+            values.append(value)
+        if since is not None:
+            clauses.append("captured >= ?")
+            values.append(since)
+        if until is not None:
+            clauses.append("captured < ?")
+            values.append(until)
+
+        where = ("WHERE %s" % " AND ".join(clauses)) if len(clauses) > 0 else ""
+        with self.__lock:
+            total = self.__db.execute("SELECT COUNT(*) FROM images %s" % where, values).fetchone()[0]
+            rows = self.__db.execute("SELECT * FROM images %s ORDER BY captured %s LIMIT ? OFFSET ?"
+                                     % (where, "DESC" if newest_first else "ASC"),
+                                     values + [min(limit, ImageStore.MAX_RESULTS), offset]).fetchall()
+        return total, [ImageStore.__record(row) for row in rows]
+
+    @staticmethod
+    def __record(row):
+        record = dict(zip(row.keys(), row))
+        for name in ("hflip", "vflip"):
+            if record[name] is not None:
+                record[name] = bool(record[name])
+        return record
+
+    def stats(self):
+        with self.__lock:
+            row = self.__db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+        return {"images": row[0], "bytes": row[1]}
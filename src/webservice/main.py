@@ -4,14 +4,18 @@ California Institute of Technology.  All rights reserved
 """
 import json
 import logging
+import signal
 import sys, os
+import time
 import traceback
 from tornado import gen, web, ioloop
+from tornado.iostream import StreamClosedError
 from tornado.options import define, options, parse_command_line
 import ConfigParser
 import pkg_resources
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ThreadPoolExecutor
 import webmodel
+import metrics
 from webmodel import RequestObject, ProcessingException, ContentTypes
 import importlib
 
@@ -22,28 +26,46 @@ class BaseRequestHandler(web.RequestHandler):
     def initialize(self, thread_pool):
         self.logger = logging.getLogger('nexus')
         self.request_thread_pool = thread_pool
+        self.client_closed = False
 
-    @web.asynchronous
-    def get(self):
+    def on_connection_close(self):
+        self.client_closed = True
 
-        self.request_thread_pool.apply_async(self.run)
+    def handler_name(self):
+        return type(self).__name__
 
-    def run(self):
+    @gen.coroutine
+    def get(self, *args, **kwargs):
         self.set_header("Access-Control-Allow-Origin", "*")
         reqObject = RequestObject(self)
+        metrics.REQUESTS_IN_FLIGHT.inc(handler=self.handler_name())
         try:
-            result = self.do_get(reqObject)
+            result = yield self.do_get(reqObject)
             self.async_callback(result)
+        except StreamClosedError:
+            self.logger.info("Client disconnected")
         except ProcessingException as e:
-            self.async_onerror_callback(e.reason, e.code)
+            self.async_onerror_callback(e.reason, e.code, e.headers)
         except Exception as e:
             self.async_onerror_callback(str(e), 500)
+        finally:
+            metrics.REQUESTS_IN_FLIGHT.dec(handler=self.handler_name())
+            metrics.REQUEST_SECONDS.observe(self.request.request_time(), handler=self.handler_name(), code=self.get_status())
 
-    def async_onerror_callback(self, reason, code=500):
+    def async_onerror_callback(self, reason, code=500, headers=None):
         self.logger.error("Error processing request", exc_info=True)
 
+        if self._headers_written:
+            # Too late to report the error to the client (e.g. mid-stream)
+            if not self._finished:
+                self.finish()
+            return
+
         self.set_header("Content-Type", "application/json")
         self.set_status(code)
+        if headers is not None:
+            for name, value in headers.items():
+                self.set_header(name, value)
 
         response = {
             "error": reason,
@@ -56,27 +78,68 @@ class BaseRequestHandler(web.RequestHandler):
     def async_callback(self, result):
         self.finish()
 
-    ''' Override me for standard handlers! '''
+    ''' Override me for standard handlers! May return a Future. '''
     def do_get(self, reqObject):
         pass
 
 
 
 class ModularHandlerWrapper(BaseRequestHandler):
+    STREAM_CONTENT_TYPES = {
+        ContentTypes.H264: "video/h264",
+        ContentTypes.EVENTS: "text/event-stream",
+        ContentTypes.ZIP: "application/zip",
+        ContentTypes.FITS: "application/fits"
+    }
+
+    CHUNK_CONTENT_TYPES = dict(STREAM_CONTENT_TYPES, **{
+        ContentTypes.JSON: "application/json",
+        ContentTypes.TEXT: "text/plain; charset=utf-8",
+        ContentTypes.PNG: "image/png",
+        ContentTypes.JPEG: "image/jpeg",
+        ContentTypes.WEBP: "image/webp",
+        ContentTypes.CSV: "text/csv",
+        ContentTypes.NETCDF: "application/x-netcdf"
+    })
+
+    CHUNK_SIZE = 256 * 1024
+
     def initialize(self, thread_pool, clazz=None):
         BaseRequestHandler.initialize(self, thread_pool)
         self.__clazz = clazz
 
+    def handler_name(self):
+        return self.__clazz.name()
+
+    @gen.coroutine
     def do_get(self, request):
         instance = self.__clazz.instance()
+        timings = metrics.RequestTimings()
+        submitted = time.time()
 
-        results = instance.handle(request)
+        def handle():
+            metrics.record("pool", time.time() - submitted, metrics.POOL_WAIT_SECONDS)
+            with metrics.POOL_BUSY.track(), metrics.span("handle"):
+                return instance.handle(request, **self.path_kwargs)
+
+        # Handlers block on the camera, so they run on the request pool while
+        # all response I/O stays on the IOLoop. Named groups in the handler's
+        # path are passed on as keyword arguments
+        results = yield self.request_thread_pool.submit(metrics.run_timed, timings, handle)
+        self.set_header("Server-Timing", timings.header())
 
         try:
             self.set_status(results.status_code)
         except AttributeError:
             pass
 
+        headers = {}
+        headers_op = getattr(results, "getHeaders", None)
+        if callable(headers_op):
+            headers = headers_op()
+            for name, value in headers.items():
+                self.set_header(name, value)
+
         useContentType = request.get_content_type()
 
         content_type_op = getattr(results, "getContentType", None)
@@ -88,19 +151,52 @@ class ModularHandlerWrapper(BaseRequestHandler):
         if callable(is_streamable_op):
             is_streamable = is_streamable_op()
 
+        chunks_op = getattr(results, "iterChunks", None)
+
         if is_streamable:
-            self.__process_results_stream(results, useContentType)
+            yield self.__process_results_stream(results, useContentType, headers)
+        elif callable(chunks_op):
+            yield self.__process_results_chunks(chunks_op(), useContentType, headers)
         else:
-            self.__process_results_static(results, useContentType)
-
-    def __process_results_stream(self, results, useContentType):
-        print "Writing stream"
-        self.set_header("Content-Type", "video/h264")
-        self.set_header("Transfer-Encoding", "chunked")
-        self.set_header("Connection", "Keep - Alive")
-        results.stream(self)
-
-    def __process_results_static(self, results, useContentType):
+            self.__process_results_static(results, useContentType, request)
+
+        raise gen.Return(results)
+
+    @gen.coroutine
+    def __process_results_stream(self, results, useContentType, headers):
+        self.logger.info("Writing stream")
+        # Without a Content-Length Tornado takes care of the chunked framing
+        if "Content-Type" not in headers:
+            self.set_header("Content-Type", ModularHandlerWrapper.STREAM_CONTENT_TYPES.get(useContentType, "application/octet-stream"))
+        if "Cache-Control" not in headers:
+            self.set_header("Cache-Control", "no-cache")
+        yield results.stream(self)
+
+    @gen.coroutine
+    def __process_results_chunks(self, chunks, useContentType, headers):
+        if "Content-Type" not in headers:
+            self.set_header("Content-Type", ModularHandlerWrapper.CHUNK_CONTENT_TYPES.get(useContentType, "application/octet-stream"))
+        # A single buffer is written out a slice at a time
+        if isinstance(chunks, (bytes, bytearray, memoryview)):
+            view = memoryview(chunks)
+            self.set_header("Content-Length", len(view))
+            chunks = (view[start:start + ModularHandlerWrapper.CHUNK_SIZE] for start in range(0, len(view), ModularHandlerWrapper.CHUNK_SIZE))
+
+        # Chunks go to the connection as they are rather than through write(),
+        # which would copy them into its buffer. Waiting for each one to be
+        # sent keeps no more than about a chunk per response in memory.
+        # Chunked transfer encoding frames a chunk by concatenating it, which
+        # memoryviews don't support, so without a length they're copied
+        sized = "Content-Length" in self._headers
+        self.flush()
+        for chunk in chunks:
+            if self.client_closed:
+                break
+            if not sized and isinstance(chunk, memoryview):
+                chunk = chunk.tobytes()
+            yield self.request.connection.write(chunk)
+
+    def __process_results_static(self, results, useContentType, request):
         if useContentType == ContentTypes.JSON:
             self.set_header("Content-Type", "application/json")
             try:
@@ -108,12 +204,14 @@ class ModularHandlerWrapper(BaseRequestHandler):
             except AttributeError:
                 traceback.print_exc(file=sys.stdout)
                 self.write(json.dumps(results, indent=4))
-        elif useContentType in (ContentTypes.PNG, ContentTypes.JPEG):
+        elif useContentType in (ContentTypes.PNG, ContentTypes.JPEG, ContentTypes.WEBP):
 
             if useContentType == ContentTypes.PNG:
                 self.set_header("Content-Type", "image/png")
             elif useContentType == ContentTypes.JPEG:
                 self.set_header("Content-Type", "image/jpeg")
+            elif useContentType == ContentTypes.WEBP:
+                self.set_header("Content-Type", "image/webp")
 
             try:
                 self.write(results.toImage())
@@ -121,6 +219,21 @@ class ModularHandlerWrapper(BaseRequestHandler):
                 traceback.print_exc(file=sys.stdout)
                 raise ProcessingException(reason="Unable to convert results to an Image.")
 
+        elif useContentType == ContentTypes.TEXT:
+            self.set_header("Content-Type", "text/plain; charset=utf-8")
+            try:
+                self.write(results.toText())
+            except AttributeError:
+                traceback.print_exc(file=sys.stdout)
+                raise ProcessingException(reason="Unable to convert results to text.")
+        elif useContentType == ContentTypes.NPY:
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Disposition", "filename=\"download.npy\"")
+            try:
+                self.write(results.toNpy())
+            except AttributeError:
+                traceback.print_exc(file=sys.stdout)
+                raise ProcessingException(reason="Unable to convert results to NPY.")
         elif useContentType == ContentTypes.CSV:
             self.set_header("Content-Type", "text/csv")
             self.set_header("Content-Disposition", "filename=\"%s\"" % request.get_argument('filename', "download.csv"))
@@ -156,6 +269,56 @@ class ModularHandlerWrapper(BaseRequestHandler):
 
 
 
+def make_app(webconfig, request_thread_pool, **settings):
+    """
+    Loads the handler modules, runs their initializers and returns the
+    application serving them from request_thread_pool.
+    """
+    log = logging.getLogger(__name__)
+    handlers = []
+
+    moduleDirs = webconfig.get("modules", "module_dirs").split(",")
+    for moduleDir in moduleDirs:
+        log.info("Loading modules from %s" % moduleDir)
+        importlib.import_module(moduleDir)
+
+    for initializer in webmodel.AVAILABLE_INITIALIZERS:
+        initializer.init(webconfig)
+
+    for clazzWrapper in webmodel.AVAILABLE_HANDLERS:
+        handlers.append(
+            (clazzWrapper.path(), ModularHandlerWrapper,
+             dict(clazz=clazzWrapper, thread_pool=request_thread_pool)))
+
+    staticDir = webconfig.get("static", "static_dir")
+    staticEnabled = webconfig.get("static", "static_enabled") == "true"
+    if staticEnabled:
+        handlers.append(
+            (r'/(.*)', web.StaticFileHandler, {'path': staticDir, "default_filename": "index.html"}))
+
+    return web.Application(handlers, **settings)
+
+
+def serve(app, port, **kwargs):
+    """
+    Serves app until SIGTERM or SIGINT stops the IOLoop, then shuts down
+    whatever the initializers started.
+    """
+    io_loop = ioloop.IOLoop.current()
+
+    def stop(signum, frame):
+        io_loop.add_callback_from_signal(io_loop.stop)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    app.listen(port, **kwargs)
+    try:
+        io_loop.start()
+    finally:
+        for initializer in reversed(webmodel.AVAILABLE_INITIALIZERS):
+            initializer.shutdown()
+
+
 """
 class SayHiHandler(tornado.web.RequestHandler):
     def get(self):
@@ -179,39 +342,16 @@ if __name__ == "__main__":
     define("address", default=webconfig.get("global", "server.socket_host"), help="Bind to the given address")
     parse_command_line()
 
-    staticDir = webconfig.get("static", "static_dir")
-    staticEnabled = webconfig.get("static", "static_enabled") == "true"
-
     log.info("Initializing on host address '%s'" % options.address)
     log.info("Initializing on port '%s'" % options.port)
     log.info("Starting web server in debug mode: %s" % options.debug)
 
     max_request_threads = webconfig.getint("global", "server.max_simultaneous_requests")
     log.info("Initializing request ThreadPool to %s" % max_request_threads)
-    request_thread_pool = ThreadPool(processes=max_request_threads)
-
-    handlers = []
-
-    moduleDirs = webconfig.get("modules", "module_dirs").split(",")
-    for moduleDir in moduleDirs:
-        log.info("Loading modules from %s" % moduleDir)
-        importlib.import_module(moduleDir)
-
-    for clazzWrapper in webmodel.AVAILABLE_HANDLERS:
-        handlers.append(
-            (clazzWrapper.path(), ModularHandlerWrapper,
-             dict(clazz=clazzWrapper, thread_pool=request_thread_pool)))
-
-    if staticEnabled:
-        handlers.append(
-            (r'/(.*)', web.StaticFileHandler, {'path': staticDir, "default_filename": "index.html"}))
+    request_thread_pool = ThreadPoolExecutor(max_workers=max_request_threads)
+    metrics.POOL_SIZE.set(max_request_threads)
 
-    app = web.Application(
-        handlers,
-        default_host=options.address,
-        debug=options.debug
-    )
-    app.listen(options.port)
+    app = make_app(webconfig, request_thread_pool, default_host=options.address, debug=options.debug)
 
     log.info("Starting HTTP listener...")
-    ioloop.IOLoop.current().start()
+    serve(app, options.port)
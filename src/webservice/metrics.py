@@ -0,0 +1,251 @@
+"""
+Timing histograms, gauges and per request spans, exposed in the Prometheus
+text format by /metrics and per request in a Server-Timing header.
+"""
+
+import bisect
+import re
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join("%s=\"%s\"" % (name, _escape(value)) for name, value in pairs)
+
+
+def _number(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description), "# TYPE %s %s" % (self.name, self.kind)]
+        lines.extend("%s%s %s" % (name, labels, _number(value)) for name, labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.label_names, key), value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    @contextmanager
+    def track(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket in zip(self.buckets, counts):
+                    cumulative += bucket
+                    samples.append((self.name + "_bucket", _labels(self.label_names, key, [("le", _number(bound))]), cumulative))
+                samples.append((self.name + "_bucket", _labels(self.label_names, key, [("le", "+Inf")]), count))
+                samples.append((self.name + "_sum", _labels(self.label_names, key), total))
+                samples.append((self.name + "_count", _labels(self.label_names, key), count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = OrderedDict()
+        self.__collectors = OrderedDict()
+
+    def __add(self, metric):
+        with self.__lock:
+            return self.__metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labels=()):
+        return self.__add(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.__add(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.__add(Histogram(name, description, labels, buckets))
+
+    def collector(self, prefix, fn):
+        """
+        Registers fn, returning a (nested) dict of statistics such as the
+        ones reported by /status, whose numbers are exported as gauges named
+        after their path in the dict.
+        """
+        with self.__lock:
+            self.__collectors[prefix] = fn
+
+    def render(self):
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+            collectors = list(self.__collectors.items())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        for prefix, fn in collectors:
+            for name, value in sorted(flatten(prefix, fn())):
+                lines.append("# TYPE %s gauge" % name)
+                lines.append("%s %s" % (name, _number(value)))
+        return "\n".join(lines) + "\n"
+
+
+def flatten(prefix, stats):
+    """
+    Returns a (name, value) pair for every number in a nested dict.
+    """
+    if isinstance(stats, bool):
+        return [(prefix, int(stats))]
+    if isinstance(stats, (int, long, float)):
+        return [(prefix, stats)]
+    if isinstance(stats, dict):
+        flat = []
+        for key, value in stats.items():
+            flat.extend(flatten("%s_%s" % (prefix, re.sub(r"[^a-zA-Z0-9_]", "_", str(key))), value))
+        return flat
+    return []
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("camera_stage_seconds", "Time spent in each stage of handling a request", ["stage"])
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("camera_queue_wait_seconds", "Time camera jobs waited for their turn", ["job"])
+JOB_SECONDS = REGISTRY.histogram("camera_job_seconds", "Time camera jobs held the camera", ["job"])
+JOBS_IN_FLIGHT = REGISTRY.gauge("camera_jobs_in_flight", "Camera jobs queued or running", ["job"])
+REQUEST_SECONDS = REGISTRY.histogram("http_request_seconds", "Time taken to handle requests, including any streaming", ["handler", "code"])
+REQUESTS_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "Requests being handled", ["handler"])
+RECONFIGURES = REGISTRY.counter("camera_reconfigures_total", "Camera pipeline restarts for a change of sensor mode, resolution or frame rate")
+REORDERED_JOBS = REGISTRY.counter("camera_reordered_jobs_total", "Camera jobs let ahead of others to share the current sensor configuration", ["job"])
+RECONFIGURE_SECONDS_SAVED = REGISTRY.counter("camera_reconfigure_seconds_saved_total", "Estimated camera time saved by the pipeline restarts avoided")
+AUTOEXPOSE_PROBES = REGISTRY.counter("camera_autoexpose_probes_total", "Probe frames taken by exposure searches")
+CALIBRATED_FRAMES = REGISTRY.counter("calibrated_frames_total", "Captures corrected with calibration masters")
+POOL_WAIT_SECONDS = REGISTRY.histogram("request_pool_wait_seconds", "Time requests waited for a request thread")
+POOL_BUSY = REGISTRY.gauge("request_pool_busy_threads", "Request threads running a handler")
+POOL_SIZE = REGISTRY.gauge("request_pool_threads", "Size of the request thread pool")
+
+
+class RequestTimings(object):
+    """
+    The spans recorded while handling a single request, summed by name.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__spans = OrderedDict()
+
+    def add(self, name, seconds):
+        with self.__lock:
+            self.__spans[name] = self.__spans.get(name, 0.0) + seconds
+
+    def header(self):
+        with self.__lock:
+            return ", ".join("%s;dur=%.1f" % (name, 1000 * seconds) for name, seconds in self.__spans.items())
+
+
+_current = threading.local()
+
+
+def current():
+    return getattr(_current, "timings", None)
+
+
+def run_timed(timings, fn, *args, **kwargs):
+    """
+    Runs fn with the spans it records on this thread also added to timings.
+    """
+    previous = current()
+    _current.timings = timings
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _current.timings = previous
+
+
+def record(name, seconds, histogram=STAGE_SECONDS, **labels):
+    if not labels:
+        labels = {"stage": name}
+    histogram.observe(seconds, **labels)
+    timings = current()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def span(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
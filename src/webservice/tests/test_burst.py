@@ -0,0 +1,83 @@
+"""
+Bursts through the simulated camera, with an encoder that fails on demand.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import unittest
+from concurrent.futures import Future
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "handlers"))
+
+import BurstHandler
+from cam.Camera import Camera
+from cam import SimulatedCamera
+from webmodel import ContentTypes
+
+
+class FailingEncoder(object):
+    """
+    Encodes nothing, failing the frames from fail_from on.
+    """
+
+    def __init__(self, fail_from):
+        self.fail_from = fail_from
+        self.submitted = 0
+
+    def submit(self, img, content_type, quality=None, compress_level=None):
+        future = Future()
+        if self.submitted >= self.fail_from:
+            future.set_exception(IOError("Encoder failed"))
+        else:
+            future.set_result(b"frame")
+        self.submitted += 1
+        return future
+
+
+class BurstTest(unittest.TestCase):
+    def setUp(self):
+        self.encoder = BurstHandler.DEFAULT_ENCODER
+        self.outstanding = Camera.buffers.stats()["outstanding"]
+        Camera.session.set_camera_module(SimulatedCamera)
+
+    def tearDown(self):
+        BurstHandler.DEFAULT_ENCODER = self.encoder
+        Camera.session.set_camera_module(None)
+
+    def read_all(self, burst):
+        frames = []
+        while True:
+            read = burst.read()
+            if read is None:
+                return frames
+            frames.extend(read)
+            time.sleep(0.01)
+
+    def test_encoder_failure_stops_burst(self):
+        BurstHandler.DEFAULT_ENCODER = FailingEncoder(fail_from=2)
+        burst = BurstHandler.Burst(50, 10, ContentTypes.PNG, resolution=(64, 48))
+        start = time.time()
+        burst.start()
+        frames = self.read_all(burst)
+
+        # The frames before the failure, none after it
+        self.assertEqual([index for index, _, _ in frames], [0, 1])
+        self.assertIsInstance(burst.error, IOError)
+        # The capture stopped rather than running the full five seconds
+        self.assertLess(time.time() - start, 2.0)
+        self.assertLessEqual(BurstHandler.DEFAULT_ENCODER.submitted, 4)
+
+        # The frame being captured as it was cancelled goes back to the pool too
+        deadline = time.time() + 1.0
+        while Camera.buffers.stats()["outstanding"] > self.outstanding and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(Camera.buffers.stats()["outstanding"], self.outstanding)
+
+
+if __name__ == "__main__":
+    unittest.main()
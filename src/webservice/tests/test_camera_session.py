@@ -0,0 +1,207 @@
+"""
+CameraSession against a fake picamera module that counts how often the
+camera is opened and its pipeline restarted, and takes a while to do either.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import time
+import unittest
+from fractions import Fraction
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "handlers"))
+
+from cam.Camera import Camera, CameraException, CameraSettingsException
+from cam.CameraSession import CameraSession, CameraPipelineLockedException
+
+
+class FakePiCameraModule(object):
+    """
+    Stands in for the picamera module, its PiCamera counting the calls made
+    on the class.
+    """
+
+    OPEN_SECONDS = 0.05
+    RECONFIGURE_SECONDS = 0.02
+
+    def __init__(self):
+        module = self
+        self.opens = 0
+        self.reconfigures = []
+        self.controls = []
+        self.fail_capture = False
+
+        class PiCamera(object):
+            MAX_RESOLUTION = (3280, 2464)
+
+            def __init__(self, resolution=None, framerate=30, sensor_mode=0):
+                time.sleep(FakePiCameraModule.OPEN_SECONDS)
+                module.opens += 1
+                self.__dict__.update(resolution=tuple(resolution), framerate=framerate, sensor_mode=sensor_mode,
+                                     closed=False, recording=set())
+
+            def __setattr__(self, name, value):
+                if name in CameraSession.PIPELINE_SETTINGS:
+                    if self.recording:
+                        raise RuntimeError("Can't change %s while recording" % name)
+                    time.sleep(FakePiCameraModule.RECONFIGURE_SECONDS)
+                    module.reconfigures.append(name)
+                else:
+                    if name == "awb_mode" and value not in ("auto", "sunlight"):
+                        raise ValueError("Invalid auto-white-balance mode: %s" % value)
+                    module.controls.append(name)
+                self.__dict__[name] = value
+
+            def capture(self, output, format="rgb", **kwargs):
+                if module.fail_capture:
+                    raise RuntimeError("Timed out waiting for capture to end")
+
+            def start_recording(self, output, splitter_port=1, **kwargs):
+                self.recording.add(splitter_port)
+
+            def stop_recording(self, splitter_port=1):
+                self.recording.discard(splitter_port)
+
+            def close(self):
+                self.__dict__["closed"] = True
+
+        self.PiCamera = PiCamera
+
+
+class CameraSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.module = FakePiCameraModule()
+        self.session = CameraSession(self.module)
+
+    def test_opens_once(self):
+        self.session.configure(resolution=(640, 480), framerate=24)
+        self.session.configure(resolution=(640, 480), framerate=24)
+        self.session.configure(resolution=(640, 480), framerate=24, iso=200)
+        self.assertEqual(self.module.opens, 1)
+        self.assertEqual(self.module.reconfigures, [])
+        self.assertEqual(self.session.opens, 1)
+        self.assertEqual(self.session.reconfigures, 0)
+
+    def test_reconfigures_only_what_changed(self):
+        self.session.configure(resolution=(640, 480), framerate=24, sensor_mode=0)
+        self.session.configure(resolution=(1920, 1080), framerate=24, sensor_mode=0)
+        self.session.configure(resolution=(1920, 1080), framerate=10, sensor_mode=1)
+        self.session.configure(resolution=(1920, 1080), framerate=10, sensor_mode=1)
+        self.assertEqual(self.module.opens, 1)
+        self.assertEqual(self.module.reconfigures, ["resolution", "sensor_mode", "framerate"])
+        self.assertEqual(self.session.reconfigures, 2)
+        # Timed, rather than left at the estimate
+        self.assertLess(self.session.reconfigure_seconds, CameraSession.RECONFIGURE_ESTIMATE)
+
+    def test_updates_controls(self):
+        self.session.configure(resolution=(640, 480), iso=400, hflip=True)
+        self.assertEqual(sorted(self.module.controls), ["hflip", "iso"])
+        self.session.configure(resolution=(640, 480), iso=400, hflip=True)
+        self.assertEqual(self.session.updates, 2)
+
+        # Settings not given go back to their defaults
+        camera = self.session.configure(resolution=(640, 480))
+        self.assertEqual(self.session.updates, 4)
+        self.assertEqual((camera.iso, camera.hflip), (0, False))
+
+    def test_recording_locks_pipeline(self):
+        self.session.configure(resolution=(640, 480), framerate=24)
+        self.session.start_recording(object(), splitter_port=1)
+        camera = self.session.configure(resolution=(1920, 1080), framerate=24, iso=100)
+        self.assertEqual(self.module.reconfigures, [])
+        self.assertEqual(camera.resolution, (640, 480))
+        self.assertEqual(camera.iso, 100)
+        self.assertEqual(self.session.resolution(), (640, 480))
+
+        self.session.stop_recording(splitter_port=1)
+        camera = self.session.configure(resolution=(1920, 1080), framerate=24)
+        self.assertEqual(self.module.reconfigures, ["resolution"])
+        self.assertEqual(camera.resolution, (1920, 1080))
+        self.assertEqual(self.module.opens, 1)
+
+    def test_recording_refuses_what_the_pipeline_cant_deliver(self):
+        self.session.configure(resolution=(640, 480), framerate=24, sensor_mode=4)
+        self.session.start_recording(object(), splitter_port=1)
+
+        # A six second exposure doesn't fit in a 1/24s frame
+        self.assertRaises(CameraPipelineLockedException, self.session.configure,
+                          resolution=(1920, 1080), framerate=Fraction(1, 6), shutter_speed=6000000)
+        self.assertRaises(CameraPipelineLockedException, self.session.configure,
+                          resolution=(640, 480), framerate=24, sensor_mode=2)
+        self.assertRaises(CameraPipelineLockedException, self.session.configure,
+                          resolution=(3280, 2464), framerate=24, exact_resolution=True)
+        self.assertRaises(CameraPipelineLockedException, self.session.configure,
+                          resolution=(640, 480), framerate=30, min_framerate=30)
+
+        # Nothing was changed for the refused requests
+        self.assertEqual(self.module.reconfigures, [])
+        self.assertEqual(self.module.controls, [])
+        self.assertTrue(self.session.recording())
+
+        # What the running pipeline can do still goes through
+        camera = self.session.configure(resolution=(1920, 1080), framerate=1, shutter_speed=40000)
+        self.assertEqual(camera.shutter_speed, 40000)
+        self.session.configure(resolution=(640, 480), framerate=10, sensor_mode=0, min_framerate=10)
+        self.session.configure(resolution=(640, 480), framerate=24, sensor_mode=4, exact_resolution=True)
+        self.assertEqual(self.module.opens, 1)
+
+        self.session.stop_recording(splitter_port=1)
+        camera = self.session.configure(resolution=(1920, 1080), framerate=Fraction(1, 6), shutter_speed=6000000)
+        self.assertEqual(camera.shutter_speed, 6000000)
+
+    def test_reopens_after_invalidate(self):
+        self.session.configure(resolution=(640, 480))
+        self.session.invalidate()
+        self.assertFalse(self.session.is_open())
+        self.session.configure(resolution=(640, 480))
+        self.assertEqual(self.module.opens, 2)
+
+    def test_rejected_setting_keeps_camera(self):
+        self.session.configure(resolution=(640, 480), awb_mode="sunlight")
+        self.assertRaises(ValueError, self.session.configure, resolution=(640, 480), awb_mode="bogus")
+        self.assertTrue(self.session.is_open())
+        camera = self.session.configure(resolution=(640, 480), awb_mode="sunlight")
+        self.assertEqual(camera.awb_mode, "sunlight")
+        self.assertEqual(self.module.opens, 1)
+
+
+class CameraErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.module = FakePiCameraModule()
+        Camera.session.set_camera_module(self.module)
+
+    def tearDown(self):
+        Camera.session.set_camera_module(None)
+
+    def test_invalid_settings_keep_session(self):
+        Camera().capture(resolution=(64, 48)).release()
+        self.assertRaises(CameraSettingsException, Camera().capture, resolution=(64, 48), awb_mode="bogus")
+        self.assertTrue(Camera.session.is_open())
+        Camera().capture(resolution=(64, 48)).release()
+        self.assertEqual(self.module.opens, 1)
+
+    def test_locked_pipeline_keeps_stream(self):
+        Camera.session.configure(resolution=(640, 480), framerate=24)
+        Camera.session.start_recording(object(), splitter_port=1)
+        self.assertRaises(CameraPipelineLockedException, Camera().capture_raw)
+        self.assertRaises(CameraPipelineLockedException, Camera().capture, resolution=(64, 48), shutter_speed=6000000)
+        self.assertTrue(Camera.session.recording())
+        Camera().capture(resolution=(64, 48), shutter_speed=10000).release()
+        self.assertEqual(self.module.opens, 1)
+
+    def test_device_error_invalidates_session(self):
+        Camera().capture(resolution=(64, 48)).release()
+        self.module.fail_capture = True
+        self.assertRaises(CameraException, Camera().capture, resolution=(64, 48))
+        self.assertFalse(Camera.session.is_open())
+        self.module.fail_capture = False
+        Camera().capture(resolution=(64, 48)).release()
+        self.assertEqual(self.module.opens, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+"""
+Raw captures through the simulated camera, for each camera module revision.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "handlers"))
+
+from cam.Camera import Camera
+from cam import SimulatedCamera
+from imaging import Bayer
+
+
+class RawCaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.revision = SimulatedCamera.REVISION
+
+    def tearDown(self):
+        SimulatedCamera.REVISION = self.revision
+        Camera.session.set_camera_module(None)
+
+    def capture(self, revision):
+        SimulatedCamera.REVISION = revision
+        Camera.session.set_camera_module(SimulatedCamera)
+        return Camera().capture_raw(hflip=True)
+
+    def check(self, revision):
+        data, captured_revision = self.capture(revision)
+        self.assertEqual(captured_revision, revision)
+        raw_format = Bayer.RAW_FORMATS[revision]
+        self.assertEqual(Camera.session.resolution(), (raw_format.width, raw_format.height))
+
+        array = Bayer.unpack10(Bayer.extract(data, raw_format), raw_format.width)
+        self.assertEqual(array.shape, (raw_format.height, raw_format.width))
+        self.assertTrue(0 < array.mean() < 1 << Bayer.BIT_DEPTH)
+
+    def test_ov5647(self):
+        self.check("ov5647")
+
+    def test_imx219(self):
+        self.check("imx219")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,7 +13,9 @@ import logging
 import re
 from pytz import UTC, timezone
 import types
+from datetime import timedelta
 import numpy as np
+from tornado import gen, ioloop, locks
 
 AVAILABLE_HANDLERS = []
 AVAILABLE_INITIALIZERS = []
@@ -26,9 +28,15 @@ class ContentTypes(object):
     XML = "XML"
     PNG = "PNG"
     JPEG = "JPEG"
+    WEBP = "WEBP"
     NETCDF = "NETCDF"
     ZIP = "ZIP"
     H264 = "H264"
+    MJPEG = "MJPEG"
+    NPY = "NPY"
+    EVENTS = "EVENTS"
+    TEXT = "TEXT"
+    FITS = "FITS"
 
 class RequestParameters:
     OUTPUT = "output"
@@ -44,6 +52,52 @@ def service_handler(clazz):
     return clazz
 
 
+def service_initializer(clazz):
+    log = logging.getLogger(__name__)
+    try:
+        wrapper = InitializerWrapper(clazz)
+        log.info("Adding initializer '%s'" % wrapper.clazz())
+        AVAILABLE_INITIALIZERS.append(wrapper)
+    except Exception as ex:
+        log.warn("Initializer '%s' is invalid and will be skipped (reason: %s)" % (clazz, ex.message), exc_info=True)
+    return clazz
+
+
+class InitializerWrapper:
+    def __init__(self, clazz):
+        self.__log = logging.getLogger(__name__)
+        self.__has_been_run = False
+        self.__clazz = clazz
+        self.__instance = None
+        self.validate()
+
+    def validate(self):
+        if "init" not in self.__clazz.__dict__ or not type(self.__clazz.__dict__["init"]) == types.FunctionType:
+            raise Exception("Method 'init' has not been declared")
+
+    def clazz(self):
+        return self.__clazz
+
+    def has_been_run(self):
+        return self.__has_been_run
+
+    def init(self, config):
+        if self.__has_been_run:
+            self.__log.info("Initializer '%s' has already been run" % self.__clazz)
+            return
+        self.__has_been_run = True
+        self.__instance = self.__clazz()
+        self.__instance.init(config)
+
+    def shutdown(self):
+        """
+        Runs the initializer's optional shutdown(), to stop what init() started.
+        """
+        shutdown_op = getattr(self.__instance, "shutdown", None)
+        if callable(shutdown_op):
+            shutdown_op()
+
+
 class HandlerModuleWrapper:
     def __init__(self, clazz):
         self.__instance = None
@@ -88,7 +142,7 @@ class HandlerModuleWrapper:
 
             return self.__instance
         else:
-            instance = self.__clazz()
+            return self.__clazz()
 
     def isValid(self):
         try:
@@ -100,9 +154,10 @@ class HandlerModuleWrapper:
 
 
 class ProcessingException(Exception):
-    def __init__(self, reason="", code=500):
+    def __init__(self, reason="", code=500, headers=None):
         self.reason = reason
         self.code = code
+        self.headers = headers if headers is not None else {}
         Exception.__init__(self, reason)
 
 class RequestObject:
@@ -116,6 +171,9 @@ class RequestObject:
     def get_argument(self, name, default=None):
         return self.requestHandler.get_argument(name, default=default)
 
+    def get_header(self, name, default=None):
+        return self.requestHandler.request.headers.get(name, default)
+
     def get_content_type(self):
         return self.get_argument(RequestParameters.OUTPUT, "JSON")
 
@@ -250,8 +308,9 @@ class CustomEncoder(json.JSONEncoder):
 
 
 class SimpleResults:
-    def __init__(self, result):
+    def __init__(self, result, indent=4):
         self.result = result
+        self.indent = indent
 
     def isStream(self):
         return False
@@ -260,4 +319,33 @@ class SimpleResults:
         pass
 
     def toJson(self):
-        return json.dumps(self.result, indent=4, cls=CustomEncoder)
\ No newline at end of file
+        return json.dumps(self.result, indent=self.indent, cls=CustomEncoder)
+
+
+class AsyncReader:
+    """
+    Lets a coroutine follow one of the camera stream readers (anything with
+    read(timeout) and listen(listener)) without tying up a thread. Must be
+    created on the IOLoop.
+    """
+    def __init__(self, reader):
+        self.__reader = reader
+        self.__data = locks.Event()
+        io_loop = ioloop.IOLoop.current()
+        self.__listener = lambda: io_loop.add_callback(self.__data.set)
+        reader.listen(self.__listener)
+
+    @gen.coroutine
+    def read(self, timeout=1.0):
+        self.__data.clear()
+        chunks = self.__reader.read(timeout=0)
+        if chunks is not None and len(chunks) == 0:
+            try:
+                yield self.__data.wait(timeout=timedelta(seconds=timeout))
+            except gen.TimeoutError:
+                pass
+            chunks = self.__reader.read(timeout=0)
+        raise gen.Return(chunks)
+
+    def close(self):
+        self.__reader.listen(None)